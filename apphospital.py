@@ -7,37 +7,155 @@
 # *** MODIFIED: Appointment status set to 'Completed' upon prescription creation. ***
 # *** MODIFIED: Redesigned HOME_HTML for patient dashboard. ***
 
-from flask import Flask, render_template_string, request, redirect, url_for, session, make_response
-from datetime import datetime, timedelta
+import base64
+import bisect
+import copy
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import importlib
+import io
+import itertools
+import json
+import mimetypes
 import os
+import queue
+import random # Kept for mock fallback
+import re
 import secrets
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as PoolTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bcrypt as bcrypt_backend
+import click
+from flask import Flask, render_template, request, redirect, url_for, session, make_response, g, has_request_context, jsonify, Response, stream_with_context, send_from_directory
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
 from flask_bcrypt import Bcrypt
-import random # Kept for mock fallback
-import json
+from jinja2 import DictLoader, ChoiceLoader, FileSystemBytecodeCache
+from markupsafe import Markup
+from werkzeug.datastructures import CallbackDict
+from werkzeug.http import is_resource_modified
+from werkzeug.security import safe_join
 
-import firebase_admin
-from firebase_admin import credentials, firestore
-from twilio.rest import Client
+try:
+    import fcntl # POSIX file locking for the local ID sequences
+except ImportError:
+    fcntl = None
+try:
+    import brotli # Optional: adds .br variants to the built assets
+except ImportError:
+    brotli = None
+
+# firebase_admin and twilio are imported on first use (see Backend Providers and get_twilio_client)
 
 # --- Twilio Configuration (UPDATED WITH YOUR CREDENTIALS) ---
 TWILIO_ACCOUNT_SID = 'ACe4e5ac754874739f1eb3e55b1b75eaf0'
 TWILIO_AUTH_TOKEN = '1d58013d204f8e129ed98a5f0343127a'
 TWILIO_VERIFY_SERVICE_SID = 'VA759256ff22e07433fab4c330f31a9992' # <<< YOUR SERVICE SID ADDED
+# Connection handling for the shared Twilio client (see get_twilio_client)
+TWILIO_TIMEOUT_SECONDS = float(os.environ.get('TWILIO_TIMEOUT_SECONDS', 10))
+TWILIO_MAX_RETRIES = int(os.environ.get('TWILIO_MAX_RETRIES', 2))
+TWILIO_RETRY_BACKOFF_SECONDS = float(os.environ.get('TWILIO_RETRY_BACKOFF_SECONDS', 0.5))
+TWILIO_POOL_SIZE = int(os.environ.get('TWILIO_POOL_SIZE', 10))
+# Point Verify calls at another host, e.g. a local stand-in server for load tests: http://127.0.0.1:8099
+TWILIO_VERIFY_BASE_URL = os.environ.get('TWILIO_VERIFY_BASE_URL')
 # -------------------------------------------------------------------------
 
 # Your downloaded service account key file
 SERVICE_ACCOUNT_KEY_PATH = 'hospitalsystem-2d1a0-firebase-adminsdk-fbsvc-cd28eac6d3.json'
 
-# Load credentials from the JSON file
-try:
-    cred = credentials.Certificate(SERVICE_ACCOUNT_KEY_PATH)
-    firebase_admin.initialize_app(cred)
-    print("Firebase Admin SDK successfully initialized.")
-    db = firestore.client()
-except Exception as e:
-    print(f"Error initializing Firebase Admin SDK: {e}")
-    db = None
-    print("Falling back to in-memory database simulation.")
+# --- Backend Providers ---
+# Nothing is connected at import time. 'firestore' initializes the Firebase Admin SDK on first
+# use (falling back to the in-memory store if that fails); 'memory' never touches Firebase,
+# which keeps worker start-up and test imports fast. 'sqlite' keeps the same collections in a
+# local SQLite file instead of process memory (see In-Memory Fallback "Database").
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'firestore')
+
+
+class LazyModule:
+    """Stands in for a module that is only imported when one of its attributes is first used."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+firestore = LazyModule('firebase_admin.firestore')
+google_exceptions = LazyModule('google.api_core.exceptions')
+
+
+def transactional(func):
+    """firestore.transactional, applied at call time so defining transactions needs no SDK import."""
+    @functools.wraps(func)
+    def wrapper(transaction, *args, **kwargs):
+        return firestore.transactional(func)(transaction, *args, **kwargs)
+    return wrapper
+
+
+class FirestoreProvider:
+    """Creates the Firestore client the first time it is needed.
+
+    Stands in for the client itself: attribute access is forwarded to it, and the provider is
+    falsy when Firestore is not in use (see StorageProvider).
+    """
+
+    def __init__(self, key_path, enabled=True):
+        self.key_path = key_path
+        self._client = None
+        self._initialized = not enabled
+        self._lock = threading.Lock()
+
+    def client(self):
+        """Returns the Firestore client, or None when using the in-memory store."""
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    # Load credentials from the JSON file
+                    try:
+                        import firebase_admin
+                        from firebase_admin import credentials
+                        cred = credentials.Certificate(self.key_path)
+                        firebase_admin.initialize_app(cred)
+                        print("Firebase Admin SDK successfully initialized.")
+                        self._client = firestore.client()
+                    except Exception as e:
+                        print(f"Error initializing Firebase Admin SDK: {e}")
+                        print("Falling back to in-memory database simulation.")
+                    self._initialized = True
+        return self._client
+
+    def __bool__(self):
+        return self.client() is not None
+
+    def __getattr__(self, attr):
+        client = self.client()
+        if client is None:
+            raise AttributeError(f"No Firestore client ({STORAGE_BACKEND!r} storage backend); cannot use db.{attr}")
+        return getattr(client, attr)
+
+
+if STORAGE_BACKEND not in ('firestore', 'memory', 'sqlite'):
+    raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}; expected 'firestore', 'memory' or 'sqlite'.")
+db = FirestoreProvider(SERVICE_ACCOUNT_KEY_PATH, enabled=STORAGE_BACKEND == 'firestore')
 
 
 # --- CONFIGURATION: PRE-DEFINED PROFILE PICTURES (The "Store Memory") ---
@@ -51,61 +169,1391 @@ PROFILE_PIC_CHOICES = {
 
 
 # --- In-Memory Fallback "Database" ---
-in_memory_db = {
-    'users': [],
-    'appointments': [],
-    'prescriptions': [],
-    'payments': []
+# local_store maps collection names to collections with a common interface: get(pk), put(doc),
+# update(pk, changes), delete(pk), find(**criteria), find_one(**criteria), page(...), len() and
+# iteration, plus local_store.transaction() to apply several writes as one unit. MemoryCollection keeps
+# documents in this process; with STORAGE_BACKEND=sqlite, SqliteCollection stores them in a
+# local SQLite database that every worker on the host shares and that survives restarts.
+
+class MemoryCollection:
+    """Documents keyed by primary key, with secondary indexes kept in sync on every write.
+
+    Indexes map a tuple of field values to the primary keys holding them (a dict is used
+    as an insertion-ordered set), so lookups cost O(matches) instead of a full scan. Ordered
+    indexes map the values of their equality fields to a sorted list of (sort values..., pk)
+    keys, so page() bisects to the cursor instead of sorting every match.
+    Documents are copied on the way in and out, as SqliteCollection's are serialized, so
+    callers may change what they get back; change stored documents through put()/update().
+    """
+
+    def __init__(self, primary_key, indexes=(), ordered_indexes=()):
+        self.primary_key = primary_key
+        self.docs = {}
+        self.indexes = {tuple(fields): {} for fields in indexes}
+        self.ordered_indexes = {(tuple(fields), tuple(sort_fields)): {} for fields, sort_fields in ordered_indexes}
+        self._index_for_fields = {}
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        return iter([copy.deepcopy(doc) for doc in self.docs.values()])
+
+    @staticmethod
+    def _sort_key(pk, doc, sort_fields):
+        return tuple(str(doc.get(f, '')) for f in sort_fields) + (pk,)
+
+    def _add_to_indexes(self, pk, doc):
+        for fields, index in self.indexes.items():
+            index.setdefault(tuple(doc.get(f) for f in fields), {})[pk] = None
+        for (fields, sort_fields), index in self.ordered_indexes.items():
+            bisect.insort(index.setdefault(tuple(doc.get(f) for f in fields), []), self._sort_key(pk, doc, sort_fields))
+
+    def _remove_from_indexes(self, pk, doc):
+        for fields, index in self.indexes.items():
+            key = tuple(doc.get(f) for f in fields)
+            bucket = index.get(key)
+            if bucket is not None:
+                bucket.pop(pk, None)
+                if not bucket:
+                    del index[key]
+        for (fields, sort_fields), index in self.ordered_indexes.items():
+            key = tuple(doc.get(f) for f in fields)
+            keys = index.get(key)
+            if keys is not None:
+                sort_key = self._sort_key(pk, doc, sort_fields)
+                i = bisect.bisect_left(keys, sort_key)
+                if i < len(keys) and keys[i] == sort_key:
+                    del keys[i]
+                if not keys:
+                    del index[key]
+
+    def get(self, pk):
+        doc = self.docs.get(pk)
+        return copy.deepcopy(doc) if doc is not None else None
+
+    def put(self, doc):
+        """Inserts or replaces a document by its primary key."""
+        pk = doc[self.primary_key]
+        existing = self.docs.get(pk)
+        if existing is not None:
+            self._remove_from_indexes(pk, existing)
+        self.docs[pk] = copy.deepcopy(doc)
+        self._add_to_indexes(pk, doc)
+        return doc
+
+    def update(self, pk, changes):
+        """Applies field changes to a stored document. Returns it, or None if missing."""
+        doc = self.docs.get(pk)
+        if doc is None:
+            return None
+        self._remove_from_indexes(pk, doc)
+        doc.update(copy.deepcopy(changes))
+        self._add_to_indexes(pk, doc)
+        return copy.deepcopy(doc)
+
+    def _best_index(self, fields):
+        """Picks the widest index whose fields are all part of the query (cached per field set)."""
+        key = frozenset(fields)
+        if key not in self._index_for_fields:
+            usable = [f for f in self.indexes if set(f) <= key]
+            self._index_for_fields[key] = max(usable, key=len) if usable else ()
+        return self._index_for_fields[key]
+
+    def delete(self, pk):
+        doc = self.docs.pop(pk, None)
+        if doc is not None:
+            self._remove_from_indexes(pk, doc)
+        return doc
+
+    def _find(self, criteria):
+        """The stored (uncopied) documents matching criteria, in insertion order."""
+        fields = self._best_index(criteria)
+        if fields:
+            bucket = self.indexes[fields].get(tuple(criteria[f] for f in fields), {})
+            candidates = [self.docs[pk] for pk in bucket]
+        else:
+            candidates = list(self.docs.values())
+        remaining = [(f, v) for f, v in criteria.items() if f not in fields]
+        if not remaining:
+            return candidates
+        return [d for d in candidates if all(d.get(f) == v for f, v in remaining)]
+
+    def find(self, **criteria):
+        """Returns documents whose fields equal all the given values, in insertion order."""
+        return [copy.deepcopy(doc) for doc in self._find(criteria)]
+
+    def find_one(self, **criteria):
+        matches = self._find(criteria)
+        return copy.deepcopy(matches[0]) if matches else None
+
+    def page(self, criteria, sort_fields, after=None, limit=None, descending=True, since=None, until=None):
+        """Returns up to limit matching documents ordered by sort_fields and then primary key, all
+        descending (or ascending), starting after the sort key `after` (see _get_page). since and
+        until are inclusive bounds on the first sort field.
+
+        Uses the ordered index on exactly these criteria and sort fields when there is one;
+        otherwise sorts every match.
+        """
+        sort_fields = tuple(sort_fields)
+        fields = next((f for f, sf in self.ordered_indexes if sf == sort_fields and set(f) == set(criteria)), None)
+        if fields is None:
+            keys = sorted(self._sort_key(d[self.primary_key], d, sort_fields) for d in self._find(criteria))
+        else:
+            keys = self.ordered_indexes[(fields, sort_fields)].get(tuple(criteria[f] for f in fields), [])
+        low = bisect.bisect_left(keys, (str(since),)) if since is not None else 0
+        # No string sorts between until and until + '\0', so this is the end of the keys starting with until.
+        high = bisect.bisect_left(keys, (str(until) + '\0',)) if until is not None else len(keys)
+        if descending:
+            end = min(high, bisect.bisect_left(keys, tuple(after))) if after else high
+            start = max(low, end - limit) if limit else low
+            selected = reversed(keys[start:end])
+        else:
+            start = max(low, bisect.bisect_right(keys, tuple(after))) if after else low
+            end = min(high, start + limit) if limit else high
+            selected = keys[start:end]
+        return [copy.deepcopy(self.docs[key[-1]]) for key in selected]
+
+
+class MemoryStore(dict):
+    """The in-memory collections by name."""
+
+    def __init__(self, schema):
+        super().__init__({name: MemoryCollection(*spec) for name, spec in schema.items()})
+        self._lock = threading.RLock()
+        self.epoch = secrets.token_hex(8) # Identifies this process's copy of the data (see conditional_response)
+
+    def transaction(self):
+        """Context manager for a group of writes; concurrent groups never interleave."""
+        return self._lock
+
+
+class SqliteStore(dict):
+    """The collections as tables of one SQLite database in WAL mode, with a connection per thread."""
+
+    def __init__(self, path, schema):
+        super().__init__({name: SqliteCollection(self, name, *spec) for name, spec in schema.items()})
+        self.path = path
+        self._local = threading.local()
+        self.epoch = None # The data outlives the process
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for collection in self.values():
+                collection.create_schema(conn)
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Runs the block in one write transaction (nested calls join the outer one)."""
+        conn = self.connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute('BEGIN IMMEDIATE') # Take the write lock up front so read-modify-write cannot race
+        self._local.depth = 1
+        try:
+            yield
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+        finally:
+            self._local.depth = 0
+
+
+class SqliteCollection:
+    """MemoryCollection work-alike that stores each document as JSON in a SQLite table.
+
+    Every index becomes an expression index over json_extract(), so find() on indexed fields
+    is an index lookup, and page() on an ordered index walks it from the cursor.
+    Returned documents are copies; change them through put()/update().
+    """
+
+    def __init__(self, store, name, primary_key, indexes=(), ordered_indexes=()):
+        self.store = store
+        self.name = name
+        self.primary_key = primary_key
+        self.indexes = [tuple(fields) for fields in indexes]
+        self.ordered_indexes = [(tuple(fields), tuple(sort_fields)) for fields, sort_fields in ordered_indexes]
+
+    @staticmethod
+    def _field(field):
+        return f"json_extract(doc, '$.{field}')"
+
+    @staticmethod
+    def _sort_field(field):
+        # Missing fields sort as '' to match MemoryCollection; the cursor comparison needs a non-NULL value.
+        return f"IFNULL(json_extract(doc, '$.{field}'), '')"
+
+    def create_schema(self, conn):
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {self.name} (pk TEXT PRIMARY KEY, doc TEXT NOT NULL)')
+        for fields in self.indexes:
+            columns = ', '.join(self._field(f) for f in fields)
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {self.name}_{"_".join(fields)} ON {self.name} ({columns})')
+        for fields, sort_fields in self.ordered_indexes:
+            columns = ', '.join([self._field(f) for f in fields] + [self._sort_field(f) for f in sort_fields] + ['pk'])
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {self.name}_{"_".join(fields)}_by_{"_".join(sort_fields)} '
+                         f'ON {self.name} ({columns})')
+
+    def _select(self, where='', params=(), limit=None):
+        sql = f'SELECT doc FROM {self.name} {where} ORDER BY rowid'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        return [json.loads(row[0]) for row in self.store.connection().execute(sql, params)]
+
+    def __len__(self):
+        return self.store.connection().execute(f'SELECT COUNT(*) FROM {self.name}').fetchone()[0]
+
+    def __iter__(self):
+        return iter(self._select())
+
+    def get(self, pk):
+        docs = self._select('WHERE pk = ?', (pk,))
+        return docs[0] if docs else None
+
+    def put(self, doc):
+        """Inserts or replaces a document by its primary key."""
+        self.store.connection().execute(
+            f'INSERT INTO {self.name} (pk, doc) VALUES (?, ?) ON CONFLICT(pk) DO UPDATE SET doc = excluded.doc',
+            (doc[self.primary_key], json.dumps(doc)))
+        return doc
+
+    def update(self, pk, changes):
+        """Applies field changes to a stored document. Returns it, or None if missing."""
+        with self.store.transaction():
+            doc = self.get(pk)
+            if doc is None:
+                return None
+            doc.update(changes)
+            return self.put(doc)
+
+    def delete(self, pk):
+        with self.store.transaction():
+            doc = self.get(pk)
+            if doc is not None:
+                self.store.connection().execute(f'DELETE FROM {self.name} WHERE pk = ?', (pk,))
+            return doc
+
+    def find(self, **criteria):
+        """Returns documents whose fields equal all the given values, in insertion order."""
+        if not criteria:
+            return self._select()
+        where = 'WHERE ' + ' AND '.join(f'{self._field(f)} IS ?' for f in criteria)
+        return self._select(where, tuple(criteria.values()))
+
+    def find_one(self, **criteria):
+        where = 'WHERE ' + ' AND '.join(f'{self._field(f)} IS ?' for f in criteria) if criteria else ''
+        docs = self._select(where, tuple(criteria.values()), limit=1)
+        return docs[0] if docs else None
+
+    def page(self, criteria, sort_fields, after=None, limit=None, descending=True, since=None, until=None):
+        """MemoryCollection.page(): the query reads an ordered index from the cursor."""
+        conditions = [f'{self._field(f)} IS ?' for f in criteria]
+        params = list(criteria.values())
+        sort_columns = [self._sort_field(f) for f in sort_fields] + ['pk']
+        if since is not None:
+            conditions.append(f'{sort_columns[0]} >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append(f'{sort_columns[0]} <= ?')
+            params.append(until)
+        if after:
+            # SQLite cannot seek an expression index on a row value, so the first sort column is
+            # also bounded on its own; the row value then skips the few ties before the cursor.
+            op = '<' if descending else '>'
+            conditions.append(f'{sort_columns[0]} {op}= ?')
+            conditions.append(f"({', '.join(sort_columns)}) {op} ({', '.join('?' * len(after))})")
+            params.extend([after[0], *after])
+        sql = f'SELECT doc FROM {self.name}'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY ' + ', '.join(f"{c} {'DESC' if descending else 'ASC'}" for c in sort_columns)
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        return [json.loads(row[0]) for row in self.store.connection().execute(sql, params)]
+
+
+# Collection name -> (primary key, indexed field sets[, ordered indexes as (field set, sort fields)])
+LOCAL_SCHEMA = {
+    'users': ('email', [('doctor_id',), ('patient_id',), ('role', 'available')]),
+    'appointments': ('_id', [('doctor_id',), ('patient_id',)],
+                     [(('doctor_id',), ('date', 'time')), (('doctor_id', 'status'), ('date', 'time'))]),
+    'prescriptions': ('_id', [('patient_id',), ('doctor_id',), ('patient_id', 'payment_status')],
+                      [(('patient_id',), ('date',))]),
+    'payments': ('_id', [('doctor_id',), ('patient_id',), ('doctor_id', 'date')],
+                 [(('doctor_id',), ('date', 'timestamp')), ((), ('date', 'timestamp'))]),
+    'monthly_earnings': ('_id', [('doctor_id',)]),
+    'doctor_stats': ('doctor_id', []),
+    'doctor_patients': ('_id', [('doctor_id',)]),
+    'daily_earnings': ('_id', [('doctor_id',)]),
+    'doctor_schedules': ('_id', [('doctor_id',)]),
 }
-PATIENT_ID_COUNTER = 1000
-DOCTOR_ID_COUNTER = 2000
+SQLITE_DB_PATH = os.environ.get('SQLITE_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'hospital.sqlite3'))
 DEFAULT_PRESCRIPTION_FEE = 200 # New constant for default fee
+FIRESTORE_IN_QUERY_LIMIT = 30 # Max values Firestore accepts in a single 'in' filter
+
+
+# --- Storage Backends ---
+# The database helpers further down never branch on the database in use: they call the storage
+# backend, which has one method per collection operation (get_user, save_prescription, page, ...).
+# FirestoreBackend runs them against Firestore; MemoryBackend and SqliteBackend run them against
+# a local store. Writes that belong to a WriteBatch are queued on it: as Firestore batch writes,
+# or as local writes applied together in one local_store.transaction().
+# `storage` chooses the backend the first time it is used, so importing the app never touches
+# Firebase. The benchmark-storage command runs one workload against each backend side by side.
+FIRESTORE_BATCH_LIMIT = 500 # Firestore's per-batch write limit
+
+
+class FirestoreBackend:
+    """Storage backend over a Firestore client (or a FirestoreProvider standing in for one)."""
+
+    name = 'firestore'
+    label = 'Firestore'
+    local = False
+    epoch = None # The data outlives the process
+    # Collections whose Firestore name differs from the one the helpers use
+    COLLECTIONS = {'daily_earnings': 'doctor_daily_earnings'}
+
+    def __init__(self, client):
+        self.client = client
+
+    def collection(self, name):
+        return self.client.collection(self.COLLECTIONS.get(name, name))
+
+    def batch(self):
+        return WriteBatch(firestore_batch=self.client.batch())
+
+    @staticmethod
+    def _docs(query):
+        return [{'_id': doc.id, **doc.to_dict()} for doc in query.stream()]
+
+    def _get(self, collection, doc_id):
+        doc = self.collection(collection).document(doc_id).get()
+        return {'_id': doc.id, **doc.to_dict()} if doc.exists else None
+
+    # Users (keyed by email; user documents carry no _id)
+
+    def get_user(self, email):
+        # The version is read first, so an entry is never newer than the version it is stored with
+        version = current_version(f'user:{email}')
+        cached = user_cache.get(email)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        doc = self.collection('users').document(email).get()
+        if not doc.exists:
+            return None
+        return user_cache.set(email, (version, doc.to_dict()))[1]
+
+    def save_user(self, user_data):
+        self.collection('users').document(user_data['email']).set(user_data)
+
+    def update_user(self, email, changes):
+        self.collection('users').document(email).update(changes)
+
+    def find_doctor(self, doctor_id):
+        docs = self.collection('users').where('doctor_id', '==', doctor_id).where('role', '==', 'doctor').limit(1).stream()
+        return next((doc.to_dict() for doc in docs), None)
+
+    def find_patients(self, patient_ids):
+        """Patient documents by patient_id, loaded in batches of FIRESTORE_IN_QUERY_LIMIT."""
+        patients = {}
+        for start in range(0, len(patient_ids), FIRESTORE_IN_QUERY_LIMIT):
+            chunk = list(patient_ids[start:start + FIRESTORE_IN_QUERY_LIMIT])
+            for doc in self.collection('users').where('patient_id', 'in', chunk).where('role', '==', 'patient').stream():
+                data = doc.to_dict()
+                patients.setdefault(data['patient_id'], data)
+        return patients
+
+    def available_doctors(self):
+        docs = self.collection('users').where('role', '==', 'doctor').where('available', '==', True).stream()
+        return [doc.to_dict() for doc in docs]
 
-# --- Twilio OTP Helper Functions ---
+    def watch_doctors(self, callback):
+        """Starts a snapshot listener on the doctor documents (see DoctorDirectory._on_snapshot)."""
+        return self.collection('users').where('role', '==', 'doctor').on_snapshot(callback)
 
-def send_otp_via_twilio(phone_number, channel='sms'):
-    """Sends OTP via Twilio Verify API. Fallback to mock if Twilio fails."""
-    
-    # Check if credentials are placeholders or invalid for security/testing
-    if not TWILIO_VERIFY_SERVICE_SID or TWILIO_VERIFY_SERVICE_SID.startswith('VAx'):
-        print("\n--- MOCK OTP ALERT (Using mock mode) ---")
-        mock_otp = str(random.randint(100000, 999999))
-        session['mock_otp'] = mock_otp
-        session['otp_phone_number'] = phone_number
-        print(f"MOCK OTP for {phone_number}: {mock_otp}")
-        print(f"-----------------------------------------\n")
-        return True
-        
+    # Appointments
+
+    def appointments_for_doctor(self, doctor_id):
+        return self._docs(self.collection('appointments').where('doctor_id', '==', doctor_id))
+
+    def find_booked_appointment(self, patient_id, doctor_id):
+        # NOTE: This complex query REQUIRES a composite index in Firestore.
+        query = self.collection('appointments')\
+                    .where('patient_id', '==', patient_id)\
+                    .where('doctor_id', '==', doctor_id)\
+                    .where('status', '==', 'Booked')\
+                    .order_by('date', direction=firestore.Query.DESCENDING)\
+                    .order_by('time', direction=firestore.Query.DESCENDING)\
+                    .limit(1)
+        return next(iter(self._docs(query)), None)
+
+    def save_appointment(self, appointment_data, reserve_slot=False, hold_id=None):
+        appointment_ref = self.collection('appointments').document()
+        schedule = _save_appointment_in_transaction(self.client.transaction(), self, appointment_ref,
+                                                    appointment_data, reserve_slot, hold_id)
+        return appointment_ref.id, schedule
+
+    def set_appointment_status(self, doc_id, status, batch):
+        doc_ref = self.collection('appointments').document(doc_id)
+        snapshot = doc_ref.get()
+        if snapshot.exists:
+            appointment = snapshot.to_dict()
+            # The precondition fails the whole batch (WriteBatch.commit raises WriteConflict) if the
+            # appointment changed after this read, so the completed counter is never bumped twice.
+            batch.update(doc_ref, {'status': status}, option=self.client.write_option(last_update_time=snapshot.update_time))
+            delta = completed_delta(appointment.get('status'), status)
+            if delta:
+                batch.set(self.collection('doctor_stats').document(appointment['doctor_id']),
+                          {'doctor_id': appointment['doctor_id'], 'appointments_completed': firestore.Increment(delta)}, merge=True)
+
+    # Prescriptions
+
+    def prescriptions_for_patient(self, patient_id, payment_status=None):
+        query = self.collection('prescriptions').where('patient_id', '==', patient_id)
+        if payment_status:
+            query = query.where('payment_status', '==', payment_status)
+        return self._docs(query)
+
+    def prescriptions_for_doctor(self, doctor_id):
+        return self._docs(self.collection('prescriptions').where('doctor_id', '==', doctor_id))
+
+    def get_prescription(self, prescription_id):
+        return self._get('prescriptions', prescription_id)
+
+    def save_prescription(self, prescription_data, batch):
+        doctor_id = prescription_data['doctor_id']
+        doc_ref = self.collection('prescriptions').document()
+        batch.set(doc_ref, prescription_data)
+        batch.set(self.collection('doctor_stats').document(doctor_id),
+                  {'doctor_id': doctor_id, 'prescriptions_written': firestore.Increment(1)}, merge=True)
+        return doc_ref.id
+
+    def set_prescription_payment_status(self, prescription_id, status, batch):
+        batch.update(self.collection('prescriptions').document(prescription_id), {'payment_status': status})
+
+    # Payments
+
+    def completed_payments_for_patient(self, patient_id):
+        return self._docs(self.collection('payments').where('patient_id', '==', patient_id).where('status', '==', 'Completed'))
+
+    def completed_payments_for_prescriptions(self, patient_id, prescription_ids, dates):
+        """The patient's completed payments that reference one of prescription_ids or fall on one of dates."""
+        payments = {}
+        query = self.collection('payments').where('patient_id', '==', patient_id).where('status', '==', 'Completed')
+        for field, values in (('prescription_id', prescription_ids), ('date', dates)):
+            for start in range(0, len(values), FIRESTORE_IN_QUERY_LIMIT):
+                for doc in query.where(field, 'in', values[start:start + FIRESTORE_IN_QUERY_LIMIT]).stream():
+                    payments.setdefault(doc.id, {'_id': doc.id, **doc.to_dict()})
+        return list(payments.values())
+
+    def payments_for_doctor_on(self, doctor_id, date):
+        return self._docs(self.collection('payments').where('doctor_id', '==', doctor_id).where('date', '==', date))
+
+    def save_payment(self, payment_data, batch):
+        doctor_id = payment_data.get('doctor_id')
+        month_year = payment_data['date'][:7]
+        amount = int(payment_data.get('amount', DEFAULT_PRESCRIPTION_FEE))
+        hour = _payment_hour(payment_data)
+        payment_ref = self.collection('payments').document()
+        batch.set(payment_ref, payment_data)
+        batch.set(self.collection('monthly_earnings').document(monthly_rollup_id(doctor_id, month_year)), {
+            'doctor_id': doctor_id,
+            'month_year': month_year,
+            'count': firestore.Increment(1),
+            'total_earnings': firestore.Increment(amount)
+        }, merge=True)
+        daily = {'doctor_id': doctor_id, 'date': payment_data['date'], 'total_earnings': firestore.Increment(amount)}
+        if hour is not None:
+            daily['hourly'] = {hour: firestore.Increment(amount)}
+        batch.set(self.collection('daily_earnings').document(daily_earnings_id(doctor_id, payment_data['date'])), daily, merge=True)
+        return payment_ref.id
+
+    def iter_payments_for_doctor(self, doctor_id, start=None, end=None):
+        # NOTE: This query REQUIRES a composite index on (doctor_id, date DESC, timestamp DESC).
+        query = self.collection('payments').where('doctor_id', '==', doctor_id)
+        if start:
+            query = query.where('date', '>=', start)
+        if end:
+            query = query.where('date', '<=', end)
+        query = query.order_by('date', direction=firestore.Query.DESCENDING)\
+                     .order_by('timestamp', direction=firestore.Query.DESCENDING)
+        for doc in query.stream():
+            yield doc.to_dict()
+
+    def iter_payments_ledger(self, start=None, end=None, page_size=None):
+        # NOTE: Firestore orders ties by document ID, which keeps the start_after cursor stable.
+        query = self.collection('payments')
+        if start:
+            query = query.where('date', '>=', start)
+        if end:
+            query = query.where('date', '<=', end)
+        query = query.order_by('date').order_by('timestamp').limit(page_size)
+        last_doc = None
+        while True:
+            page = list((query.start_after(last_doc) if last_doc else query).stream())
+            for doc in page:
+                yield {**doc.to_dict(), 'payment_id': doc.id}
+            if len(page) < page_size:
+                return
+            last_doc = page[-1]
+
+    # Rollups and counters
+
+    def monthly_earnings(self, doctor_id):
+        return self._docs(self.collection('monthly_earnings').where('doctor_id', '==', doctor_id))
+
+    def doctor_counters(self, doctor_id):
+        return self._get('doctor_stats', doctor_id) or {}
+
+    def daily_earnings(self, doctor_id, date):
+        return self._get('daily_earnings', daily_earnings_id(doctor_id, date)) or {}
+
+    # Schedules and slot holds
+
+    def get_schedule(self, schedule_key):
+        doc = self.collection('doctor_schedules').document(schedule_key).get()
+        return doc.to_dict() if doc.exists else None
+
+    def place_hold(self, schedule_key, hold):
+        return _place_hold_in_transaction(self.client.transaction(), self.collection('doctor_schedules').document(schedule_key),
+                                          self.collection('slot_holds').document(hold['hold_id']), hold)
+
+    def release_hold(self, schedule_key, hold_id):
+        return _release_hold_in_transaction(self.client.transaction(), self.collection('doctor_schedules').document(schedule_key),
+                                            self.collection('slot_holds').document(hold_id))
+
+    def expired_holds(self, now, limit):
+        """(schedule_key, hold_id) of up to limit holds, placed by any worker, that expired by now."""
+        stale = self.collection('slot_holds').where('expires_at', '<=', now).order_by('expires_at').limit(limit).stream()
+        return [(doc.get('schedule_id'), doc.id) for doc in stale]
+
+    # Paging, ID counters and maintenance
+
+    def page(self, collection, filters, sort_fields, after=None, limit=None):
+        """See MemoryCollection.page; after holds the sort values and then the document ID."""
+        # NOTE: Each filter/sort combination REQUIRES a composite index, e.g.
+        # appointments (doctor_id, status, date DESC, time DESC, __name__ DESC).
+        query = self.collection(collection)
+        for field, value in filters.items():
+            query = query.where(field, '==', value)
+        for field in sort_fields:
+            query = query.order_by(field, direction=firestore.Query.DESCENDING)
+        query = query.order_by(firestore.FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+        if after:
+            query = query.start_after(dict(zip(list(sort_fields) + ['__name__'], after)))
+        return self._docs(query.limit(limit) if limit else query)
+
+    def advance_counter(self, name, start, update):
+        """Moves counters/{name} from current to update(current) in a transaction; returns current."""
+        return _advance_counter_in_transaction(self.client.transaction(), self.collection('counters').document(name), start, update)
+
+    def stream(self, collection, doctor_id=None, fields=None):
+        """Yields a collection's documents (only doctor_id's, if given), reading just fields if given."""
+        query = self.collection(collection)
+        if doctor_id:
+            query = query.where('doctor_id', '==', doctor_id)
+        if fields:
+            query = query.select(fields)
+        return ({'_id': doc.id, **doc.to_dict()} for doc in query.stream())
+
+    def replace_doctor_documents(self, collection, doctor_id, documents):
+        """Makes documents ({doc_id: data}) the collection's only documents for doctor_id (for
+        every doctor when doctor_id is None), in batches of FIRESTORE_BATCH_LIMIT writes."""
+        target = self.collection(collection)
+        existing = target.where('doctor_id', '==', doctor_id) if doctor_id else target
+        # Documents that are not rebuilt are deleted; the rest are overwritten by set().
+        stale = ((doc.reference, None) for doc in existing.select([]).stream() if doc.id not in documents)
+        writes = ((target.document(doc_id), data) for doc_id, data in documents.items())
+        batch, pending = self.client.batch(), 0
+        for doc_ref, data in itertools.chain(stale, writes):
+            if data is None:
+                batch.delete(doc_ref)
+            else:
+                batch.set(doc_ref, data)
+            pending += 1
+            if pending == FIRESTORE_BATCH_LIMIT:
+                batch.commit()
+                batch, pending = self.client.batch(), 0
+        if pending:
+            batch.commit()
+
+
+@transactional
+def _advance_counter_in_transaction(transaction, counter_ref, start, update):
+    snapshot = counter_ref.get(transaction=transaction)
+    current = snapshot.to_dict().get('next', start) if snapshot.exists else start
+    transaction.set(counter_ref, {'next': update(current)})
+    return current
+
+
+@transactional
+def _place_hold_in_transaction(transaction, schedule_ref, hold_ref, hold):
+    schedule = _add_hold(schedule_ref.get(transaction=transaction).to_dict(), hold)
+    transaction.set(schedule_ref, schedule)
+    transaction.set(hold_ref, {'schedule_id': schedule_ref.id, 'patient_id': hold['patient_id'], 'expires_at': hold['expires_at']})
+    return schedule
+
+
+@transactional
+def _release_hold_in_transaction(transaction, schedule_ref, hold_ref):
+    schedule = _without_hold(schedule_ref.get(transaction=transaction).to_dict(), hold_ref.id)
+    if schedule is not None:
+        transaction.set(schedule_ref, schedule)
+    transaction.delete(hold_ref)
+    return schedule
+
+
+@transactional
+def _save_appointment_in_transaction(transaction, backend, appointment_ref, appointment_data, reserve_slot=False, hold_id=None):
+    doctor_id = appointment_data['doctor_id']
+    link_ref = backend.collection('doctor_patients').document(doctor_patient_link_id(doctor_id, appointment_data['patient_id']))
+    first_visit = not link_ref.get(transaction=transaction).exists
+    schedule = None
+    if reserve_slot:
+        schedule_ref = backend.collection('doctor_schedules').document(schedule_id(doctor_id, appointment_data['date']))
+        schedule = _add_booking(schedule_ref.get(transaction=transaction).to_dict(), appointment_ref.id, appointment_data, hold_id)
+        transaction.set(schedule_ref, schedule)
+        if hold_id:
+            transaction.delete(backend.collection('slot_holds').document(hold_id))
+    transaction.set(appointment_ref, appointment_data)
+    counters = {'doctor_id': doctor_id}
+    if first_visit:
+        transaction.set(link_ref, {'doctor_id': doctor_id, 'patient_id': appointment_data['patient_id']})
+        counters['patients_assigned'] = firestore.Increment(1)
+    if appointment_data.get('status') == 'Completed':
+        counters['appointments_completed'] = firestore.Increment(1)
+    if len(counters) > 1:
+        transaction.set(backend.collection('doctor_stats').document(doctor_id), counters, merge=True)
+    return schedule
+
+
+class LocalBackend:
+    """Storage backend over a local store: the FirestoreBackend operations on MemoryStore or
+    SqliteStore collections, with multi-document writes run in one store.transaction()."""
+
+    local = True
+
+    def __init__(self, store):
+        self.store = store
+
+    @property
+    def epoch(self):
+        return self.store.epoch
+
+    def batch(self):
+        return WriteBatch(store=self.store)
+
+    @staticmethod
+    def _new_id():
+        return str(uuid.uuid4())
+
+    # Users
+
+    def get_user(self, email):
+        return self.store['users'].get(email)
+
+    def save_user(self, user_data):
+        if self.store['users'].get(user_data['email']) is None:
+            if user_data['role'] == 'patient' and 'profile_pic_url' not in user_data:
+                user_data['profile_pic_url'] = PROFILE_PIC_CHOICES['default']
+        self.store['users'].put(user_data)
+
+    def update_user(self, email, changes):
+        self.store['users'].update(email, changes)
+
+    def find_doctor(self, doctor_id):
+        return self.store['users'].find_one(doctor_id=doctor_id, role='doctor')
+
+    def find_patients(self, patient_ids):
+        patients = ((pid, self.store['users'].find_one(patient_id=pid, role='patient')) for pid in patient_ids)
+        return {pid: patient for pid, patient in patients if patient}
+
+    def available_doctors(self):
+        return self.store['users'].find(role='doctor', available=True)
+
+    # Appointments
+
+    def appointments_for_doctor(self, doctor_id):
+        return self.store['appointments'].find(doctor_id=doctor_id)
+
+    def find_booked_appointment(self, patient_id, doctor_id):
+        booked = self.store['appointments'].page({'patient_id': patient_id, 'doctor_id': doctor_id, 'status': 'Booked'},
+                                                 ['date', 'time'], limit=1)
+        return booked[0] if booked else None
+
+    def save_appointment(self, appointment_data, reserve_slot=False, hold_id=None):
+        appointment_data['_id'] = self._new_id()
+        doctor_id = appointment_data['doctor_id']
+        links = self.store['doctor_patients']
+        link_id = doctor_patient_link_id(doctor_id, appointment_data['patient_id'])
+        deltas = {'appointments_completed': completed_delta(None, appointment_data.get('status'))}
+        schedule = None
+        with self.store.transaction():
+            if reserve_slot:
+                schedules = self.store['doctor_schedules']
+                schedule_key = schedule_id(doctor_id, appointment_data['date'])
+                schedule = _add_booking(schedules.get(schedule_key), appointment_data['_id'], appointment_data, hold_id)
+                schedules.put({**schedule, '_id': schedule_key})
+            if links.get(link_id) is None:
+                links.put({'_id': link_id, 'doctor_id': doctor_id, 'patient_id': appointment_data['patient_id']})
+                deltas['patients_assigned'] = 1
+            self.store['appointments'].put(appointment_data)
+            self._bump_counters(doctor_id, **deltas)
+        return appointment_data['_id'], schedule
+
+    def set_appointment_status(self, doc_id, status, batch):
+        batch.apply(self._set_appointment_status, doc_id, status)
+
+    def _set_appointment_status(self, doc_id, status):
+        appointments = self.store['appointments']
+        appointment = appointments.get(doc_id)
+        if appointment:
+            delta = completed_delta(appointment.get('status'), status)
+            appointments.update(doc_id, {'status': status})
+            self._bump_counters(appointment['doctor_id'], appointments_completed=delta)
+            print(f"Appointment {doc_id} updated to {status} in the {self.label}.")
+
+    # Prescriptions
+
+    def prescriptions_for_patient(self, patient_id, payment_status=None):
+        criteria = {'patient_id': patient_id}
+        if payment_status:
+            criteria['payment_status'] = payment_status
+        return self.store['prescriptions'].find(**criteria)
+
+    def prescriptions_for_doctor(self, doctor_id):
+        return self.store['prescriptions'].find(doctor_id=doctor_id)
+
+    def get_prescription(self, prescription_id):
+        return self.store['prescriptions'].get(prescription_id)
+
+    def save_prescription(self, prescription_data, batch):
+        prescription_data['_id'] = self._new_id()
+        # Ensure 'amount' is set, default if missing
+        prescription_data['amount'] = int(prescription_data.get('amount', DEFAULT_PRESCRIPTION_FEE))
+        batch.apply(self.store['prescriptions'].put, prescription_data)
+        batch.apply(self._bump_counters, prescription_data['doctor_id'], prescriptions_written=1)
+        return prescription_data['_id']
+
+    def set_prescription_payment_status(self, prescription_id, status, batch):
+        batch.apply(self.store['prescriptions'].update, prescription_id, {'payment_status': status})
+
+    # Payments
+
+    def completed_payments_for_patient(self, patient_id):
+        return self.store['payments'].find(patient_id=patient_id, status='Completed')
+
+    def completed_payments_for_prescriptions(self, patient_id, prescription_ids, dates):
+        wanted_ids, wanted_dates = set(prescription_ids), set(dates)
+        return [p for p in self.completed_payments_for_patient(patient_id)
+                if p.get('prescription_id') in wanted_ids or p.get('date') in wanted_dates]
+
+    def payments_for_doctor_on(self, doctor_id, date):
+        return self.store['payments'].find(doctor_id=doctor_id, date=date)
+
+    def save_payment(self, payment_data, batch):
+        doctor_id = payment_data.get('doctor_id')
+        amount = int(payment_data.get('amount', DEFAULT_PRESCRIPTION_FEE))
+        payment_data['_id'] = self._new_id()
+        batch.apply(self.store['payments'].put, payment_data)
+        batch.apply(self._increment_rollup, doctor_id, payment_data['date'][:7], 1, amount)
+        batch.apply(self._bump_daily_earnings, doctor_id, payment_data['date'], _payment_hour(payment_data), amount)
+        return payment_data['_id']
+
+    def _iter_payments(self, criteria, start, end, page_size, descending):
+        """Yields payments in (date, timestamp, _id) order, one ordered-index page at a time."""
+        sort_fields = ('date', 'timestamp')
+        after = None
+        while True:
+            page = self.store['payments'].page(criteria, sort_fields, after, page_size, descending, start, end)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = tuple(str(page[-1].get(f, '')) for f in sort_fields) + (page[-1]['_id'],)
+
+    def iter_payments_for_doctor(self, doctor_id, start=None, end=None):
+        return self._iter_payments({'doctor_id': doctor_id}, start, end, LEDGER_PAGE_SIZE, descending=True)
+
+    def iter_payments_ledger(self, start=None, end=None, page_size=None):
+        for payment in self._iter_payments({}, start, end, page_size or LEDGER_PAGE_SIZE, descending=False):
+            yield {**payment, 'payment_id': payment['_id']}
+
+    # Rollups and counters
+
+    def monthly_earnings(self, doctor_id):
+        return self.store['monthly_earnings'].find(doctor_id=doctor_id)
+
+    def doctor_counters(self, doctor_id):
+        return self.store['doctor_stats'].get(doctor_id) or {}
+
+    def daily_earnings(self, doctor_id, date):
+        return self.store['daily_earnings'].get(daily_earnings_id(doctor_id, date)) or {}
+
+    def _bump_counters(self, doctor_id, **deltas):
+        stats = self.store['doctor_stats']
+        current = stats.get(doctor_id)
+        if current is None:
+            current = stats.put({'doctor_id': doctor_id, 'patients_assigned': 0, 'prescriptions_written': 0, 'appointments_completed': 0})
+        stats.update(doctor_id, {field: current.get(field, 0) + delta for field, delta in deltas.items()})
+
+    def _increment_rollup(self, doctor_id, month_year, count, amount):
+        rollups = self.store['monthly_earnings']
+        rollup_id = monthly_rollup_id(doctor_id, month_year)
+        rollup = rollups.get(rollup_id)
+        if rollup is None:
+            rollups.put({'_id': rollup_id, 'doctor_id': doctor_id, 'month_year': month_year, 'count': count, 'total_earnings': amount})
+        else:
+            rollups.update(rollup_id, {'count': rollup['count'] + count, 'total_earnings': rollup['total_earnings'] + amount})
+
+    def _bump_daily_earnings(self, doctor_id, date, hour, amount):
+        earnings = self.store['daily_earnings']
+        earnings_id = daily_earnings_id(doctor_id, date)
+        current = earnings.get(earnings_id)
+        if current is None:
+            current = earnings.put({'_id': earnings_id, 'doctor_id': doctor_id, 'date': date, 'total_earnings': 0, 'hourly': {}})
+        hourly = dict(current['hourly'])
+        if hour is not None:
+            hourly[hour] = hourly.get(hour, 0) + amount
+        earnings.update(earnings_id, {'total_earnings': current['total_earnings'] + amount, 'hourly': hourly})
+
+    # Schedules and slot holds
+
+    def get_schedule(self, schedule_key):
+        return self.store['doctor_schedules'].get(schedule_key)
+
+    def place_hold(self, schedule_key, hold):
+        schedules = self.store['doctor_schedules']
+        with self.store.transaction():
+            schedule = _add_hold(schedules.get(schedule_key), hold)
+            schedules.put({**schedule, '_id': schedule_key})
+        return schedule
+
+    def release_hold(self, schedule_key, hold_id):
+        schedules = self.store['doctor_schedules']
+        with self.store.transaction():
+            schedule = _without_hold(schedules.get(schedule_key), hold_id)
+            if schedule is not None:
+                schedules.put(schedule)
+        return schedule
+
+    def expired_holds(self, now, limit):
+        """Local holds are only released from the placing process's reaper heap; nothing to sweep."""
+        return []
+
+    # Paging, ID counters and maintenance
+
+    def page(self, collection, filters, sort_fields, after=None, limit=None):
+        return self.store[collection].page(filters, sort_fields, after, limit)
+
+    def advance_counter(self, name, start, update):
+        """Moves the file-locked sequence ID_SEQUENCE_DIR/{name}.seq from current to update(current); returns current."""
+        os.makedirs(ID_SEQUENCE_DIR, exist_ok=True)
+        with open(os.path.join(ID_SEQUENCE_DIR, f"{name}.seq"), 'a+') as handle:
+            with _exclusive_file_lock(handle):
+                handle.seek(0)
+                stored = handle.read().strip()
+                current = int(stored) if stored else start
+                handle.seek(0)
+                handle.truncate()
+                handle.write(str(update(current)))
+                handle.flush()
+                os.fsync(handle.fileno())
+        return current
+
+    def stream(self, collection, doctor_id=None, fields=None):
+        target = self.store[collection]
+        return iter(target.find(doctor_id=doctor_id) if doctor_id else target)
+
+    def replace_doctor_documents(self, collection, doctor_id, documents):
+        target = self.store[collection]
+        with self.store.transaction():
+            for doc in (target.find(doctor_id=doctor_id) if doctor_id else target):
+                target.delete(doc[target.primary_key])
+            for doc_id, data in documents.items():
+                target.put({**data, target.primary_key: doc_id})
+
+
+class MemoryBackend(LocalBackend):
+    """LocalBackend over a MemoryStore: nothing leaves this process or survives a restart."""
+
+    name = 'memory'
+    label = 'in-memory database'
+
+
+class SqliteBackend(LocalBackend):
+    """LocalBackend over a SqliteStore shared by the workers on one host."""
+
+    name = 'sqlite'
+    label = 'SQLite database'
+
+
+class StorageProvider:
+    """Chooses the storage backend the first time it is used and stands in for it.
+
+    Firestore is used when its client can be created (see FirestoreProvider); otherwise the
+    local backend, which is the in-memory store unless STORAGE_BACKEND=sqlite.
+    """
+
+    def __init__(self, client, local_backend):
+        self._client = client
+        self._local_backend = local_backend
+        self._backend = None
+
+    def backend(self):
+        if self._backend is None:
+            self._backend = FirestoreBackend(self._client) if self._client else self._local_backend
+        return self._backend
+
+    def __getattr__(self, attr):
+        return getattr(self.backend(), attr)
+
+
+if STORAGE_BACKEND == 'sqlite':
+    local_backend = SqliteBackend(SqliteStore(SQLITE_DB_PATH, LOCAL_SCHEMA))
+else:
+    local_backend = MemoryBackend(MemoryStore(LOCAL_SCHEMA))
+local_store = local_backend.store
+storage = StorageProvider(db, local_backend)
+
+
+# --- Process-Wide Document Cache ---
+
+class TTLCache:
+    """Bounded, thread-safe LRU cache whose entries also expire after ttl_seconds.
+
+    Values are deep-copied on the way in and out so callers can mutate what they get
+    back without corrupting the cached copy.
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Returns a copy of the cached value, or None on a miss or expired entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(value)
+
+    def set(self, key, value):
+        """Caches a copy of value and returns value itself."""
+        stored = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, stored)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# Sits in front of Firestore reads of user documents, as (user:{email} version stamp, user) pairs.
+# Writes made by this process invalidate entries, and an entry whose stamp has since moved (a write
+# from another worker on the host) is reloaded; the TTL bounds staleness from other hosts.
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', 2048))
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', 60))
+user_cache = TTLCache(USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL_SECONDS)
+
+# Comma-separated emails allowed to see operational endpoints such as /admin/cache_stats
+ADMIN_EMAILS = {e.strip() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()}
+
+# --- ID Allocation ---
+# Patient and doctor IDs are handed out in blocks (hi/lo): each process reserves ID_BLOCK_SIZE
+# IDs with one coordinated write -- a transaction on counters/{name} in Firestore, or a
+# file-locked sequence under ID_SEQUENCE_DIR on the local backends -- and then numbers users from
+# its block locally. IDs stay unique across worker processes and restarts; a block that is
+# not fully used before a restart simply leaves a gap.
+ID_BLOCK_SIZE = int(os.environ.get('ID_BLOCK_SIZE', 20))
+ID_SEQUENCE_DIR = os.environ.get('ID_SEQUENCE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance'))
+
+
+@contextmanager
+def _exclusive_file_lock(handle):
+    """Holds an exclusive lock on an open file (process-local only where fcntl is unavailable)."""
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
     try:
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-        verification = client.verify.v2.services(TWILIO_VERIFY_SERVICE_SID) \
+        yield
+    finally:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+class IdAllocator:
+    """Allocates sequential integers for one named sequence, reserving them a block at a time."""
+
+    def __init__(self, name, start, block_size):
+        self.name = name
+        self.start = start
+        self.block_size = block_size
+        self._next = 0
+        self._limit = 0
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked worker: never hand out what is left of the parent's block
+                self._next = self._limit = 0
+                self._pid = os.getpid()
+            if self._next >= self._limit:
+                self._next = self._advance(lambda current: current + self.block_size)
+                self._limit = self._next + self.block_size
+            value = self._next
+            self._next += 1
+            return value
+
+    def skip_past(self, value):
+        """Makes sure IDs up to and including value are never allocated (e.g. after seeding data)."""
+        with self._lock:
+            self._advance(lambda current: max(current, value + 1))
+            self._next = self._limit = 0
+
+    def _advance(self, update):
+        """Atomically moves the stored sequence from current to update(current); returns current."""
+        return storage.advance_counter(self.name, self.start, update)
+
+
+patient_id_allocator = IdAllocator('patient_id', 1000, ID_BLOCK_SIZE)
+doctor_id_allocator = IdAllocator('doctor_id', 2000, ID_BLOCK_SIZE)
+
+
+# --- Password Hashing Pool ---
+# bcrypt is deliberately CPU-expensive, so hashing and checking run in a small process pool
+# instead of on the request thread. A bounded number of jobs may be outstanding; beyond that,
+# callers are turned away immediately with PasswordPoolBusy rather than queueing behind a burst.
+PASSWORD_HASH_ROUNDS = int(os.environ.get('PASSWORD_HASH_ROUNDS', 12)) # bcrypt work factor
+PASSWORD_POOL_WORKERS = int(os.environ.get('PASSWORD_POOL_WORKERS', os.cpu_count() or 2)) # 0 = hash inline
+PASSWORD_POOL_MAX_PENDING = int(os.environ.get('PASSWORD_POOL_MAX_PENDING', 32))
+PASSWORD_POOL_TIMEOUT_SECONDS = float(os.environ.get('PASSWORD_POOL_TIMEOUT_SECONDS', 10))
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when the password pool already has PASSWORD_POOL_MAX_PENDING jobs in flight,
+    or when a job does not finish within PASSWORD_POOL_TIMEOUT_SECONDS or loses its worker."""
+
+
+def _hash_password_job(password, rounds):
+    return bcrypt_backend.hashpw(password.encode('utf-8'), bcrypt_backend.gensalt(rounds)).decode('utf-8')
+
+
+def _check_password_job(password_hash, password):
+    return bcrypt_backend.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+
+
+class PasswordHasher:
+    """Dispatches bcrypt hashing/verification to a lazily created process pool."""
+
+    def __init__(self, workers, max_pending, rounds):
+        self.workers = workers
+        self.rounds = rounds
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _reset_pool(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _run(self, job, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordPoolBusy()
+        if self.workers <= 0:
+            try:
+                return job(*args)
+            finally:
+                self._slots.release()
+        try:
+            future = self._pool().submit(job, *args)
+        except (BrokenProcessPool, RuntimeError):
+            self._slots.release()
+            self._reset_pool()
+            raise PasswordPoolBusy()
+        # The slot is held until the job itself finishes, not just until this caller stops
+        # waiting, so jobs abandoned after a timeout still count against max_pending.
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=PASSWORD_POOL_TIMEOUT_SECONDS)
+        except PoolTimeoutError:
+            raise PasswordPoolBusy()
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM-killed); start a fresh pool for the next caller.
+            self._reset_pool()
+            raise PasswordPoolBusy()
+
+    def hash(self, password):
+        return self._run(_hash_password_job, password, self.rounds)
+
+    def check(self, password_hash, password):
+        return self._run(_check_password_job, password_hash, password)
+
+
+password_hasher = PasswordHasher(PASSWORD_POOL_WORKERS, PASSWORD_POOL_MAX_PENDING, PASSWORD_HASH_ROUNDS)
+BUSY_RESPONSE = ("Too many sign-in requests are being processed right now. Please try again in a moment.", 503, {'Retry-After': '2'})
+
+
+# --- Twilio OTP Helper Functions ---
+
+_twilio_client = None
+_twilio_client_lock = threading.Lock()
+
+def make_twilio_client(verify_base_url=None, timeout=TWILIO_TIMEOUT_SECONDS):
+    """Builds a Twilio client with one pooled keep-alive HTTP session, so OTP calls reuse TLS connections.
+
+    Connection failures, 429s and 503s are retried with exponential backoff. Read timeouts are
+    not: the request may already have been accepted, and repeating a Verify create would send a
+    second SMS.
+    """
+    from twilio.rest import Client
+    from twilio.http.http_client import TwilioHttpClient
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    http_client = TwilioHttpClient(pool_connections=True, timeout=timeout)
+    retries = Retry(
+        total=TWILIO_MAX_RETRIES,
+        read=0,
+        backoff_factor=TWILIO_RETRY_BACKOFF_SECONDS,
+        status_forcelist=(429, 503), # Rejected before processing, so a POST is safe to repeat
+        allowed_methods=None,
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=TWILIO_POOL_SIZE, pool_maxsize=TWILIO_POOL_SIZE, max_retries=retries)
+    http_client.session.mount('https://', adapter)
+    http_client.session.mount('http://', adapter)
+    client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=http_client)
+    if verify_base_url:
+        client.verify.base_url = verify_base_url.rstrip('/')
+    return client
+
+
+def get_twilio_client():
+    """Returns the process-wide Twilio client, creating it on first use."""
+    global _twilio_client
+    with _twilio_client_lock:
+        if _twilio_client is None:
+            _twilio_client = make_twilio_client(TWILIO_VERIFY_BASE_URL)
+        return _twilio_client
+
+
+# --- OTP Providers and Background Dispatch ---
+# OTP sends are queued and delivered by background worker threads, so a slow Verify API
+# response never holds up the HTTP request; the OTP pages poll /otp_status for the outcome.
+# Checking a code stays synchronous because the user is waiting on the answer.
+OTP_DISPATCH_WORKERS = int(os.environ.get('OTP_DISPATCH_WORKERS', 4))
+OTP_DISPATCH_QUEUE_SIZE = int(os.environ.get('OTP_DISPATCH_QUEUE_SIZE', 1000))
+OTP_STATUS_TTL_SECONDS = 600
+# Dispatch statuses are polled by whichever worker the request lands on, so unless sessions are
+# kept in this process only (SESSION_BACKEND=memory) they are stored in a local SQLite file.
+OTP_STATUS_SQLITE_PATH = os.environ.get('OTP_STATUS_SQLITE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'otp_status.sqlite3'))
+MOCK_OTP_LATENCY_SECONDS = float(os.environ.get('MOCK_OTP_LATENCY_SECONDS', 0)) # Simulated provider delay for load tests
+
+
+class TwilioVerifyProvider:
+    """Sends and checks codes with the Twilio Verify API."""
+
+    def __init__(self, client_factory=get_twilio_client):
+        self.client_factory = client_factory
+
+    def new_code(self):
+        return None # Verify generates and remembers the code itself
+
+    def send(self, phone_number, channel='sms', code=None):
+        verification = self.client_factory().verify.v2.services(TWILIO_VERIFY_SERVICE_SID) \
             .verifications \
             .create(to=phone_number, channel=channel)
-        
-        session['otp_phone_number'] = phone_number
         print(f"Twilio SMS sent to {phone_number}. Status: {verification.status}")
         return verification.status == 'pending'
-    except Exception as e:
-        print(f"Error sending OTP via Twilio: {e}. Check E.164 format (+CCNNNNNNNNN) and Twilio balance.")
+
+    def check(self, phone_number, otp_code):
+        verification_check = self.client_factory().verify.v2.services(TWILIO_VERIFY_SERVICE_SID) \
+            .verification_checks \
+            .create(to=phone_number, code=otp_code)
+        return verification_check.status == 'approved'
+
+
+class MockOtpProvider:
+    """Local stand-in for Twilio: codes are printed to the terminal and kept in the user's session.
+
+    The code is made on the request thread (see send_otp_via_twilio) so it can go into the
+    session, which lets any worker check it.
+    """
+
+    def new_code(self):
+        return str(random.randint(100000, 999999))
+
+    def send(self, phone_number, channel='sms', code=None):
+        if MOCK_OTP_LATENCY_SECONDS:
+            time.sleep(MOCK_OTP_LATENCY_SECONDS)
+        print("\n--- MOCK OTP ALERT (Using mock mode) ---")
+        print(f"MOCK OTP for {phone_number}: {code}")
+        print(f"-----------------------------------------\n")
+        return True
+
+    def check(self, phone_number, otp_code):
+        return bool(otp_code) and session.get('mock_otp_code') == otp_code
+
+
+class OtpDispatcher:
+    """In-process queue of OTP sends, drained by daemon worker threads started on first use.
+
+    Each send gets a dispatch ID whose status ('queued', 'sent' or 'failed') can be polled
+    from any worker.
+    """
+
+    def __init__(self, provider, workers, queue_size):
+        self.provider = provider
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._status_store = None
+        self._threads = []
+        self._lock = threading.Lock()
+
+    @property
+    def _statuses(self):
+        """The status store, created on first use (the session store classes are defined further down)."""
+        with self._lock:
+            if self._status_store is None:
+                if SESSION_BACKEND == 'memory':
+                    self._status_store = MemorySessionStore(self.queue_size * 10, OTP_STATUS_TTL_SECONDS)
+                else:
+                    self._status_store = SqliteSessionStore(OTP_STATUS_SQLITE_PATH, OTP_STATUS_TTL_SECONDS)
+            return self._status_store
+
+    def _ensure_workers(self):
+        with self._lock:
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._work, name=f"otp-dispatch-{i}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            dispatch_id, phone_number, channel, code = self._queue.get()
+            try:
+                sent = self.provider.send(phone_number, channel, code)
+                self._statuses.set(dispatch_id, {'status': 'sent' if sent else 'failed'})
+            except Exception as e:
+                print(f"Error sending OTP via Twilio: {e}. Check E.164 format (+CCNNNNNNNNN) and Twilio balance.")
+                self._statuses.set(dispatch_id, {'status': 'failed'})
+            finally:
+                self._queue.task_done()
+
+    def submit(self, phone_number, channel='sms', code=None):
+        """Queues a send and returns its dispatch ID, or None if the queue is full."""
+        self._ensure_workers()
+        dispatch_id = secrets.token_urlsafe(12)
+        self._statuses.set(dispatch_id, {'status': 'queued'})
+        try:
+            self._queue.put_nowait((dispatch_id, phone_number, channel, code))
+        except queue.Full:
+            self._statuses.delete(dispatch_id)
+            return None
+        return dispatch_id
+
+    def status(self, dispatch_id):
+        entry = self._statuses.get(dispatch_id)
+        return entry['status'] if entry else 'unknown'
+
+
+# 'mock' keeps everything local; by default the mock is used with the memory storage backend
+# or while the Verify SID is a placeholder.
+OTP_PROVIDER = os.environ.get('OTP_PROVIDER') or (
+    'mock' if STORAGE_BACKEND == 'memory' or not TWILIO_VERIFY_SERVICE_SID or TWILIO_VERIFY_SERVICE_SID.startswith('VAx') else 'twilio'
+)
+otp_provider = MockOtpProvider() if OTP_PROVIDER == 'mock' else TwilioVerifyProvider()
+otp_dispatcher = OtpDispatcher(otp_provider, OTP_DISPATCH_WORKERS, OTP_DISPATCH_QUEUE_SIZE)
+
+
+def send_otp_via_twilio(phone_number, channel='sms'):
+    """Queues an OTP send for background delivery. Returns False if the dispatch queue is full."""
+    code = otp_provider.new_code()
+    dispatch_id = otp_dispatcher.submit(phone_number, channel, code)
+    if dispatch_id is None:
+        print(f"OTP dispatch queue is full; could not queue a code for {phone_number}.")
         return False
+    session['otp_phone_number'] = phone_number
+    session['otp_dispatch_id'] = dispatch_id
+    if code:
+        session['mock_otp_code'] = code
+    return True
 
 def check_otp_via_twilio(phone_number, otp_code):
-    """Checks OTP via Twilio Verify API. Handles mock fallback."""
-    if 'mock_otp' in session: # Handle mock fallback check
-        if otp_code == session.get('mock_otp') and phone_number == session.get('otp_phone_number'):
-            session.pop('mock_otp')
-            session.pop('otp_phone_number')
-            return True
+    """Checks an OTP with the configured provider (Twilio Verify or the local mock)."""
+    if phone_number != session.get('otp_phone_number'):
         return False
 
     try:
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-        verification_check = client.verify.v2.services(TWILIO_VERIFY_SERVICE_SID) \
-            .verification_checks \
-            .create(to=phone_number, code=otp_code)
-        
-        if verification_check.status == 'approved':
+        if otp_provider.check(phone_number, otp_code):
             session.pop('otp_phone_number', None)
+            session.pop('otp_dispatch_id', None)
+            session.pop('mock_otp_code', None)
             return True
         return False
     except Exception as e:
@@ -122,9 +1570,9 @@ LOGIN_REGISTER_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Sai Health Care | Login/Register</title>
-    <script src="https://cdn.tailwindcss.com"></script>
+    {{ asset_tag('fonts.css') }}
+    {{ asset_tag('tailwind.css') }}
     <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
         body {
             font-family: 'Inter', sans-serif;
             background-color: #0f4c81;
@@ -280,9 +1728,9 @@ OTP_REGISTER_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Sai Health Care | Confirm Registration</title>
-    <script src="https://cdn.tailwindcss.com"></script>
+    {{ asset_tag('fonts.css') }}
+    {{ asset_tag('tailwind.css') }}
     <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
         body {
             font-family: 'Inter', sans-serif;
             background-color: #0f4c81;
@@ -315,6 +1763,9 @@ OTP_REGISTER_HTML = """
         <h2 class="text-3xl font-bold text-gray-800 mb-4">Confirm Registration</h2>
         <p class="text-gray-600 mb-2">A 6-digit verification code has been sent to **{{ phone_number }}**.</p>
         <p class="text-sm text-red-500 mb-6">If using the mock mode, check your terminal for the code.</p>
+        {% if dispatch_id %}
+            <p id="otp-status" class="text-sm font-semibold text-gray-500 mb-4">Sending your code...</p>
+        {% endif %}
         {% if error %}
             <p class="text-red-500 font-bold mb-4">{{ error }}</p>
         {% endif %}
@@ -328,10 +1779,39 @@ OTP_REGISTER_HTML = """
             </button>
         </form>
     </div>
+    {% if dispatch_id %}{% include 'otp_status_script.html' %}{% endif %}
 </body>
 </html>
 """
 
+# Shared by both OTP pages: the code is sent in the background, so the page polls for the outcome.
+OTP_STATUS_SCRIPT_HTML = """
+    <script>
+        // Poll until the code has gone out or failed. Keep going on 'unknown' for a while in case the
+        // status has not been written yet, then stop without claiming that sending failed.
+        (function pollOtpStatus(attempt) {
+            const statusEl = document.getElementById('otp-status');
+            const retry = () => setTimeout(() => pollOtpStatus(attempt + 1), attempt < 10 ? 1000 : 3000);
+            fetch("{{ url_for('otp_status', dispatch_id=dispatch_id) }}")
+                .then(response => response.json())
+                .then(data => {
+                    if (data.status === 'sent') {
+                        statusEl.textContent = 'Code sent.';
+                        statusEl.className = 'text-sm font-semibold text-green-600 mb-4';
+                    } else if (data.status === 'failed') {
+                        statusEl.innerHTML = 'We could not send the code. <a href="{{ retry_url }}" class="underline">Try again</a>';
+                        statusEl.className = 'text-sm font-semibold text-red-500 mb-4';
+                    } else if (attempt < 30) {
+                        retry();
+                    } else {
+                        statusEl.innerHTML = 'No code yet? <a href="{{ retry_url }}" class="underline">Send a new one</a>';
+                    }
+                })
+                .catch(retry);
+        })(0);
+    </script>
+"""
+
 OTP_APPOINTMENT_HTML = """
 <!DOCTYPE html>
 <html lang="en">
@@ -339,9 +1819,9 @@ OTP_APPOINTMENT_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Sai Health Care | Confirm Appointment</title>
-    <script src="https://cdn.tailwindcss.com"></script>
+    {{ asset_tag('fonts.css') }}
+    {{ asset_tag('tailwind.css') }}
     <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
         body {
             font-family: 'Inter', sans-serif;
             background-color: #0f4c81;
@@ -374,6 +1854,9 @@ OTP_APPOINTMENT_HTML = """
         <h2 class="text-3xl font-bold text-gray-800 mb-4">Confirm Appointment</h2>
         <p class="text-gray-600 mb-2">Enter the verification code sent to your phone number **{{ phone_number }}** to confirm your booking.</p>
         <p class="text-sm text-red-500 mb-6">If using the mock mode, check your terminal for the code.</p>
+        {% if dispatch_id %}
+            <p id="otp-status" class="text-sm font-semibold text-gray-500 mb-4">Sending your code...</p>
+        {% endif %}
         {% if error %}
             <p class="text-red-500 font-bold mb-4">{{ error }}</p>
         {% endif %}
@@ -387,6 +1870,7 @@ OTP_APPOINTMENT_HTML = """
             </button>
         </form>
     </div>
+    {% if dispatch_id %}{% include 'otp_status_script.html' %}{% endif %}
 </body>
 </html>
 """
@@ -398,9 +1882,9 @@ PAYMENT_SUCCESS_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Sai Health Care | Payment Successful</title>
-    <script src="https://cdn.tailwindcss.com"></script>
+    {{ asset_tag('fonts.css') }}
+    {{ asset_tag('tailwind.css') }}
     <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
         body {
             font-family: 'Inter', sans-serif;
             background-color: #f3f4f6;
@@ -435,10 +1919,9 @@ HOME_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Sai Health Care | Home Dashboard</title>
-    <script src="https://cdn.tailwindcss.com"></script>
+    {{ asset_tag('fonts.css') }}
+    {{ asset_tag('tailwind.css') }}
     <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
-        @import url('https://fonts.googleapis.com/css2?family=Playfair+Display:wght@700;900&display=swap');
         body {
             font-family: 'Inter', sans-serif;
             background-color: #f3f4f6;
@@ -521,161 +2004,6 @@ HOME_HTML = """
 </html>
 """
 
-OTP_REGISTER_HTML = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Sai Health Care | Confirm Registration</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
-        body {
-            font-family: 'Inter', sans-serif;
-            background-color: #0f4c81;
-            background-image: linear-gradient(135deg, #0f4c81 0%, #2980b9 100%);
-        }
-        .container {
-            background-color: rgba(255, 255, 255, 0.95);
-            backdrop-filter: blur(10px);
-            box-shadow: 0 10px 30px rgba(0, 0, 0, 0.2);
-        }
-        .btn-secondary {
-            background-color: #42b883;
-            transition: all 0.3s ease;
-        }
-        .btn-secondary:hover {
-            background-color: #3aa675;
-        }
-        .input-field {
-            border: 2px solid #ddd;
-        }
-        .input-field:focus {
-            border-color: #42b883;
-            outline: none;
-            box-shadow: 0 0 0 3px rgba(66, 184, 131, 0.2);
-        }
-    </style>
-</head>
-<body class="flex items-center justify-center min-h-screen p-4">
-    <div class="container rounded-2xl w-full max-w-md p-8 sm:p-10 text-center">
-        <h2 class="text-3xl font-bold text-gray-800 mb-4">Confirm Registration</h2>
-        <p class="text-gray-600 mb-2">A 6-digit verification code has been sent to **{{ phone_number }}**.</p>
-        <p class="text-sm text-red-500 mb-6">If using the mock mode, check your terminal for the code.</p>
-        {% if error %}
-            <p class="text-red-500 font-bold mb-4">{{ error }}</p>
-        {% endif %}
-        <form action="/confirm_otp_register" method="post" class="space-y-6">
-            <div>
-                <label for="otp_code" class="block text-sm font-medium text-gray-700 mb-1">Enter OTP Code</label>
-                <input type="text" id="otp_code" name="otp_code" required maxlength="6" class="input-field w-full px-4 py-3 text-center text-2xl tracking-widest rounded-lg">
-            </div>
-            <button type="submit" class="btn-secondary w-full text-white font-bold py-3 px-6 rounded-lg">
-                Verify and Complete Registration
-            </button>
-        </form>
-    </div>
-</body>
-</html>
-"""
-
-OTP_APPOINTMENT_HTML = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Sai Health Care | Confirm Appointment</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
-        body {
-            font-family: 'Inter', sans-serif;
-            background-color: #0f4c81;
-            background-image: linear-gradient(135deg, #0f4c81 0%, #2980b9 100%);
-        }
-        .container {
-            background-color: rgba(255, 255, 255, 0.95);
-            backdrop-filter: blur(10px);
-            box-shadow: 0 10px 30px rgba(0, 0, 0, 0.2);
-        }
-        .btn-secondary {
-            background-color: #42b883;
-            transition: all 0.3s ease;
-        }
-        .btn-secondary:hover {
-            background-color: #3aa675;
-        }
-        .input-field {
-            border: 2px solid #ddd;
-        }
-        .input-field:focus {
-            border-color: #42b883;
-            outline: none;
-            box-shadow: 0 0 0 3px rgba(66, 184, 131, 0.2);
-        }
-    </style>
-</head>
-<body class="flex items-center justify-center min-h-screen p-4">
-    <div class="container rounded-2xl w-full max-w-md p-8 sm:p-10 text-center">
-        <h2 class="text-3xl font-bold text-gray-800 mb-4">Confirm Appointment</h2>
-        <p class="text-gray-600 mb-2">Enter the verification code sent to your phone number **{{ phone_number }}** to confirm your booking.</p>
-        <p class="text-sm text-red-500 mb-6">If using the mock mode, check your terminal for the code.</p>
-        {% if error %}
-            <p class="text-red-500 font-bold mb-4">{{ error }}</p>
-        {% endif %}
-        <form action="/confirm_otp_appointment" method="post" class="space-y-6">
-            <div>
-                <label for="otp_code" class="block text-sm font-medium text-gray-700 mb-1">Enter OTP Code</label>
-                <input type="text" id="otp_code" name="otp_code" required maxlength="6" class="input-field w-full px-4 py-3 text-center text-2xl tracking-widest rounded-lg">
-            </div>
-            <button type="submit" class="btn-secondary w-full text-white font-bold py-3 px-6 rounded-lg">
-                Verify and Book
-            </button>
-        </form>
-    </div>
-</body>
-</html>
-"""
-
-PAYMENT_SUCCESS_HTML = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Sai Health Care | Payment Successful</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
-        body {
-            font-family: 'Inter', sans-serif;
-            background-color: #f3f4f6;
-        }
-        .bg-success { background-color: #42b883; }
-    </style>
-</head>
-<body class="flex items-center justify-center min-h-screen p-4">
-    <div class="bg-white p-12 rounded-2xl shadow-xl w-full max-w-lg text-center border-t-8 border-t-green-500">
-        <svg class="w-20 h-20 text-green-500 mx-auto mb-6" fill="none" stroke="currentColor" viewBox="0 0 24 24" xmlns="http://www.w3.org/2000/svg">
-            <path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M9 12l2 2 4-4m6 2a9 9 0 11-18 0 9 9 0 0118 0z"></path>
-        </svg>
-        <h1 class="text-3xl font-bold text-gray-800 mb-2">Payment Successful!</h1>
-        <p class="text-gray-600 mb-6">Thank you, your payment of **₹{{ amount }}** has been successfully processed.</p>
-        
-        <div class="bg-gray-100 p-4 rounded-lg mb-8">
-            <p class="text-sm font-semibold text-gray-700">Transaction Date: {{ datetime_now }}</p>
-        </div>
-
-        <a href="/home" class="bg-green-500 hover:bg-green-600 text-white font-bold py-3 px-8 rounded-full shadow-lg transition duration-200">
-            Go to Home Dashboard
-        </a>
-    </div>
-</body>
-</html>
-"""
-
 APPOINTMENT_HTML = """
 <!DOCTYPE html>
 <html lang="en">
@@ -683,9 +2011,9 @@ APPOINTMENT_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Sai Health Care | Book Appointment</title>
-    <script src="https://cdn.tailwindcss.com"></script>
+    {{ asset_tag('fonts.css') }}
+    {{ asset_tag('tailwind.css') }}
     <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
         body { font-family: 'Inter', sans-serif; background-color: #f3f4f6; }
         .bg-gradient { background-image: linear-gradient(135deg, #0f4c81 0%, #2980b9 100%); }
         .btn-primary { background-color: #42b883; transition: all 0.3s ease; transform: scale(1); }
@@ -709,6 +2037,17 @@ APPOINTMENT_HTML = """
         <div class="bg-white p-8 rounded-2xl shadow-xl w-full max-w-2xl mt-8">
             <h1 class="text-3xl font-bold text-center text-[#0f4c81] mb-6">Book an Appointment</h1>
             <p class="text-gray-600 text-center mb-8">Select an available doctor and a suitable time slot.</p>
+
+            <form action="/book_appointment" method="get" class="flex flex-col sm:flex-row gap-3 mb-6">
+                <input type="search" name="q" value="{{ request.args.get('q', '') }}" placeholder="Doctor name" class="input-field flex-grow px-4 py-2 rounded-lg">
+                <select name="specialty" class="input-field px-4 py-2 rounded-lg">
+                    <option value="">All specialties</option>
+                    {% for specialty in specialties %}
+                    <option value="{{ specialty }}" {% if specialty == request.args.get('specialty') %}selected{% endif %}>{{ specialty }}</option>
+                    {% endfor %}
+                </select>
+                <button type="submit" class="btn-primary text-white font-bold py-2 px-6 rounded-lg shadow-md">Search</button>
+            </form>
             
             <div class="space-y-6">
                 {% for doctor in doctors %}
@@ -720,11 +2059,14 @@ APPOINTMENT_HTML = """
                         <input type="hidden" name="doctor_id" value="{{ doctor.id }}">
                         <div>
                             <label for="date-{{ doctor.id }}" class="block text-sm font-medium text-gray-700 mb-1">Date</label>
-                            <input type="date" id="date-{{ doctor.id }}" name="date" required class="input-field w-full px-4 py-2 rounded-lg">
+                            <input type="date" id="date-{{ doctor.id }}" name="date" required class="input-field w-full px-4 py-2 rounded-lg"
+                                   data-slots-url="{{ url_for('doctor_free_slots', doctor_id=doctor.doctor_id) }}" data-slots-select="time-{{ doctor.id }}">
                         </div>
                         <div>
                             <label for="time-{{ doctor.id }}" class="block text-sm font-medium text-gray-700 mb-1">Time</label>
-                            <input type="time" id="time-{{ doctor.id }}" name="time" required class="input-field w-full px-4 py-2 rounded-lg">
+                            <select id="time-{{ doctor.id }}" name="time" required class="input-field w-full px-4 py-2 rounded-lg">
+                                <option value="">Choose a date first</option>
+                            </select>
                         </div>
                         <div class="flex justify-end">
                             <button type="submit" class="btn-primary w-full text-white font-bold py-3 px-6 rounded-lg shadow-md">
@@ -737,12 +2079,33 @@ APPOINTMENT_HTML = """
                 <p class="text-gray-500 text-center">No doctors are currently available for booking.</p>
                 {% endfor %}
             </div>
+            <div class="flex justify-between mt-4 text-sm font-semibold">
+                {% if request.args.after %}<a href="{{ url_for('book_appointment', q=request.args.get('q'), specialty=request.args.get('specialty')) }}" class="text-[#0f4c81] hover:underline">&larr; First</a>{% else %}<span></span>{% endif %}
+                {% if next_cursor %}<a href="{{ url_for('book_appointment', q=request.args.get('q'), specialty=request.args.get('specialty'), after=next_cursor) }}" class="text-[#0f4c81] hover:underline">More &rarr;</a>{% endif %}
+            </div>
             
             <div class="mt-8 text-center">
                 <a href="/home" class="text-[#0f4c81] hover:underline font-semibold">Go back to Home</a>
             </div>
         </div>
     </main>
+    <script>
+        // Offer only the chosen day's free slots for each doctor.
+        document.querySelectorAll('input[data-slots-url]').forEach(dateInput => {
+            dateInput.addEventListener('change', () => {
+                const select = document.getElementById(dateInput.dataset.slotsSelect);
+                select.replaceChildren(new Option('Loading...', ''));
+                fetch(dateInput.dataset.slotsUrl + '?date=' + encodeURIComponent(dateInput.value))
+                    .then(response => response.json())
+                    .then(data => {
+                        const slots = data.free || [];
+                        select.replaceChildren(new Option(slots.length ? 'Choose a time' : 'No free slots on this day', ''),
+                                               ...slots.map(slot => new Option(slot, slot)));
+                    })
+                    .catch(() => select.replaceChildren(new Option('Could not load slots', '')));
+            });
+        });
+    </script>
 </body>
 </html>
 """
@@ -754,9 +2117,9 @@ PENDING_PAYMENTS_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Sai Health Care | Pending Payments</title>
-    <script src="https://cdn.tailwindcss.com"></script>
+    {{ asset_tag('fonts.css') }}
+    {{ asset_tag('tailwind.css') }}
     <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
         body { font-family: 'Inter', sans-serif; background-color: #f3f4f6; }
         .bg-gradient { background-image: linear-gradient(135deg, #0f4c81 0%, #2980b9 100%); }
     </style>
@@ -818,9 +2181,9 @@ PROFILE_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Sai Health Care | Profile</title>
-    <script src="https://cdn.tailwindcss.com"></script>
+    {{ asset_tag('fonts.css') }}
+    {{ asset_tag('tailwind.css') }}
     <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
         body { font-family: 'Inter', sans-serif; background-color: #f3f4f6; }
         .bg-gradient { background-image: linear-gradient(135deg, #0f4c81 0%, #2980b9 100%); }
     </style>
@@ -903,86 +2266,14 @@ PROFILE_HTML = """
                         </div>
                         {% endfor %}
                     </div>
-                    {% else %}
-                    <p class="text-gray-500 text-center">No prescriptions available.</p>
-                    {% endif %}
-                </div>
-            </div>
-            
-            <div class="mt-8 text-center">
-                <a href="/home" class="text-[#0f4c81] hover:underline font-semibold">Go back to Home</a>
-            </div>
-        </div>
-    </main>
-    <script>
-        document.getElementById('profile_pic_url').addEventListener('change', function() {
-            document.getElementById('profile-img').src = this.value;
-        });
-    </script>
-</body>
-</html>
-"""
-
-APPOINTMENT_HTML = """
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Sai Health Care | Book Appointment</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
-        body { font-family: 'Inter', sans-serif; background-color: #f3f4f6; }
-        .bg-gradient { background-image: linear-gradient(135deg, #0f4c81 0%, #2980b9 100%); }
-        .btn-primary { background-color: #42b883; transition: all 0.3s ease; transform: scale(1); }
-        .btn-primary:hover { background-color: #3aa675; transform: scale(1.02); }
-        .input-field { border: 2px solid #ddd; transition: border-color 0.3s ease; }
-        .input-field:focus { border-color: #42b883; outline: none; box-shadow: 0 0 0 3px rgba(66, 184, 131, 0.2); }
-    </style>
-</head>
-<body class="flex flex-col min-h-screen">
-    <header class="bg-gradient text-white p-6 flex justify-between items-center shadow-lg">
-        <div class="flex items-center space-x-4">
-            <h1 class="text-2xl sm:text-3xl font-extrabold">SAI HEALTH CARE</h1>
-            <span class="text-sm opacity-80 hidden sm:block">Bringing Care to Life</span>
-        </div>
-        <nav class="flex items-center space-x-4">
-            <a href="/profile" class="text-white hover:text-gray-200 transition-colors duration-200">Profile</a>
-            <a href="/logout" class="bg-white text-[#0f4c81] font-semibold py-2 px-4 rounded-full shadow-md transition-transform duration-200 hover:scale-105">Log Out</a>
-        </nav>
-    </header>
-    <main class="flex-grow flex flex-col items-center p-6">
-        <div class="bg-white p-8 rounded-2xl shadow-xl w-full max-w-2xl mt-8">
-            <h1 class="text-3xl font-bold text-center text-[#0f4c81] mb-6">Book an Appointment</h1>
-            <p class="text-gray-600 text-center mb-8">Select an available doctor and a suitable time slot.</p>
-            
-            <div class="space-y-6">
-                {% for doctor in doctors %}
-                <div class="bg-gray-50 p-6 rounded-xl shadow-sm">
-                    <h2 class="text-xl font-semibold text-gray-800">{{ doctor.name }}</h2>
-                    <p class="text-gray-500 mb-4">{{ doctor.specialty }}</p>
-                    
-                    <form action="/book_appointment" method="post" class="space-y-4">
-                        <input type="hidden" name="doctor_id" value="{{ doctor.id }}">
-                        <div>
-                            <label for="date-{{ doctor.id }}" class="block text-sm font-medium text-gray-700 mb-1">Date</label>
-                            <input type="date" id="date-{{ doctor.id }}" name="date" required class="input-field w-full px-4 py-2 rounded-lg">
-                        </div>
-                        <div>
-                            <label for="time-{{ doctor.id }}" class="block text-sm font-medium text-gray-700 mb-1">Time</label>
-                            <input type="time" id="time-{{ doctor.id }}" name="time" required class="input-field w-full px-4 py-2 rounded-lg">
-                        </div>
-                        <div class="flex justify-end">
-                            <button type="submit" class="btn-primary w-full text-white font-bold py-3 px-6 rounded-lg shadow-md">
-                                Book Now (Requires OTP)
-                            </button>
-                        </div>
-                    </form>
+                    <div class="flex justify-between mt-4 text-sm font-semibold">
+                        {% if not is_first_page %}<a href="{{ url_for('profile') }}" class="text-[#0f4c81] hover:underline">&larr; Newest</a>{% else %}<span></span>{% endif %}
+                        {% if next_cursor %}<a href="{{ url_for('profile', after=next_cursor) }}" class="text-[#0f4c81] hover:underline">Older &rarr;</a>{% endif %}
+                    </div>
+                    {% else %}
+                    <p class="text-gray-500 text-center">No prescriptions available.</p>
+                    {% endif %}
                 </div>
-                {% else %}
-                <p class="text-gray-500 text-center">No doctors are currently available for booking.</p>
-                {% endfor %}
             </div>
             
             <div class="mt-8 text-center">
@@ -990,6 +2281,11 @@ APPOINTMENT_HTML = """
             </div>
         </div>
     </main>
+    <script>
+        document.getElementById('profile_pic_url').addEventListener('change', function() {
+            document.getElementById('profile-img').src = this.value;
+        });
+    </script>
 </body>
 </html>
 """
@@ -1001,9 +2297,9 @@ PAYMENT_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Sai Health Care | Make a Payment</title>
-    <script src="https://cdn.tailwindcss.com"></script>
+    {{ asset_tag('fonts.css') }}
+    {{ asset_tag('tailwind.css') }}
     <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
         body {
             font-family: 'Inter', sans-serif;
             background-color: #f3f4f6;
@@ -1182,10 +2478,10 @@ DOCTOR_DASHBOARD_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Sai Health Care | Doctor Dashboard</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
+    {{ asset_tag('fonts.css') }}
+    {{ asset_tag('tailwind.css') }}
+    {{ asset_tag('chart.js') }}
     <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
         body { font-family: 'Inter', sans-serif; background-color: #f3f4f6; }
         .bg-gradient { background-image: linear-gradient(135deg, #0f4c81 0%, #2980b9 100%); }
     </style>
@@ -1228,9 +2524,13 @@ DOCTOR_DASHBOARD_HTML = """
 
             <hr class="my-6 border-t-2 border-gray-200">
 
+            {% if error %}
+                <p class="text-red-500 font-bold mb-4">{{ error }}</p>
+            {% endif %}
+
             <div class="grid grid-cols-1 lg:grid-cols-2 gap-8">
                 <div>
-                    <h2 class="text-2xl font-bold text-gray-800 mb-4">Upcoming Appointments ({{ appointments_booked|length }})</h2>
+                    <h2 class="text-2xl font-bold text-gray-800 mb-4">Upcoming Appointments ({{ appointments_booked|length }}{% if booked_next %}+{% endif %})</h2>
                     <div class="overflow-x-auto rounded-xl shadow-sm">
                         <table class="min-w-full bg-white rounded-xl">
                             <thead class="bg-gray-200">
@@ -1260,6 +2560,10 @@ DOCTOR_DASHBOARD_HTML = """
                         <p class="text-gray-500 text-center py-4">No upcoming appointments.</p>
                         {% endif %}
                     </div>
+                    <div class="flex justify-between mt-2 text-sm font-semibold">
+                        {% if request.args.booked_after %}<a href="{{ url_for('doctor_dashboard', completed_after=request.args.get('completed_after')) }}" class="text-[#0f4c81] hover:underline">&larr; Newest</a>{% else %}<span></span>{% endif %}
+                        {% if booked_next %}<a href="{{ url_for('doctor_dashboard', booked_after=booked_next, completed_after=request.args.get('completed_after')) }}" class="text-[#0f4c81] hover:underline">Older &rarr;</a>{% endif %}
+                    </div>
     
                     <div id="prescription-form-container" class="hidden mt-8 bg-gray-100 p-6 rounded-xl shadow-inner">
                         <h3 class="text-xl font-bold text-gray-800 mb-4">Write Prescription for Patient <span id="patient-id-display" class="text-[#42b883] font-bold"></span></h3>
@@ -1285,7 +2589,7 @@ DOCTOR_DASHBOARD_HTML = """
                         </form>
                     </div>
 
-                    <h2 class="text-2xl font-bold text-gray-800 mt-8 mb-4">Completed Appointments ({{ appointments_completed|length }})</h2>
+                    <h2 class="text-2xl font-bold text-gray-800 mt-8 mb-4">Completed Appointments ({{ stats.appointments_completed }})</h2>
                     <div class="overflow-x-auto rounded-xl shadow-sm">
                         <table class="min-w-full bg-white rounded-xl">
                             <thead class="bg-gray-200">
@@ -1309,6 +2613,10 @@ DOCTOR_DASHBOARD_HTML = """
                         <p class="text-gray-500 text-center py-4">No completed appointments yet.</p>
                         {% endif %}
                     </div>
+                    <div class="flex justify-between mt-2 text-sm font-semibold">
+                        {% if request.args.completed_after %}<a href="{{ url_for('doctor_dashboard', booked_after=request.args.get('booked_after')) }}" class="text-[#0f4c81] hover:underline">&larr; Newest</a>{% else %}<span></span>{% endif %}
+                        {% if completed_next %}<a href="{{ url_for('doctor_dashboard', booked_after=request.args.get('booked_after'), completed_after=completed_next) }}" class="text-[#0f4c81] hover:underline">Older &rarr;</a>{% endif %}
+                    </div>
                 </div>
     
                 <div>
@@ -1410,10 +2718,10 @@ DOCTOR_MONTHLY_STATS_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Sai Health Care | Monthly Earnings</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
+    {{ asset_tag('fonts.css') }}
+    {{ asset_tag('tailwind.css') }}
+    {{ asset_tag('chart.js') }}
     <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
         body { font-family: 'Inter', sans-serif; background-color: #f3f4f6; }
         .bg-gradient { background-image: linear-gradient(135deg, #0f4c81 0%, #2980b9 100%); }
     </style>
@@ -1470,7 +2778,23 @@ DOCTOR_MONTHLY_STATS_HTML = """
             </div>
 
             <div class="mt-8 text-center">
-                <form action="/export_monthly_stats" method="get" class="inline-block">
+                <form action="/export_monthly_stats" method="get" class="inline-flex flex-wrap items-end justify-center gap-3">
+                    <div class="text-left">
+                        <label for="granularity" class="block text-sm font-medium text-gray-700 mb-1">Rows</label>
+                        <select id="granularity" name="granularity" class="px-4 py-2 border rounded-lg focus:outline-none focus:ring-2 focus:ring-[#42b883]">
+                            <option value="month">Per month</option>
+                            <option value="day">Per day</option>
+                            <option value="payment">Per payment</option>
+                        </select>
+                    </div>
+                    <div class="text-left">
+                        <label for="start" class="block text-sm font-medium text-gray-700 mb-1">From</label>
+                        <input type="date" id="start" name="start" class="px-4 py-2 border rounded-lg focus:outline-none focus:ring-2 focus:ring-[#42b883]">
+                    </div>
+                    <div class="text-left">
+                        <label for="end" class="block text-sm font-medium text-gray-700 mb-1">To</label>
+                        <input type="date" id="end" name="end" class="px-4 py-2 border rounded-lg focus:outline-none focus:ring-2 focus:ring-[#42b883]">
+                    </div>
                     <button type="submit" class="bg-[#0f4c81] hover:bg-[#125591] text-white font-bold py-3 px-6 rounded-full shadow-md transition-transform duration-200 hover:scale-105">
                         Download CSV
                     </button>
@@ -1514,9 +2838,9 @@ PATIENT_HISTORY_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Sai Health Care | Medical History</title>
-    <script src="https://cdn.tailwindcss.com"></script>
+    {{ asset_tag('fonts.css') }}
+    {{ asset_tag('tailwind.css') }}
     <style>
-        @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
         body { font-family: 'Inter', sans-serif; background-color: #f3f4f6; }
         .bg-gradient { background-image: linear-gradient(135deg, #0f4c81 0%, #2980b9 100%); }
     </style>
@@ -1536,7 +2860,7 @@ PATIENT_HISTORY_HTML = """
 
             <hr class="my-6 border-t-2 border-gray-200">
 
-            <h2 class="text-2xl font-bold text-gray-800 mb-4">Prescription & Payment History ({{ history|length }} Records)</h2>
+            <h2 class="text-2xl font-bold text-gray-800 mb-4">Prescription & Payment History</h2>
             <div class="space-y-6">
                 {% if history %}
                     {% for record in history %}
@@ -1577,6 +2901,11 @@ PATIENT_HISTORY_HTML = """
                 {% endif %}
             </div>
 
+            <div class="flex justify-between mt-6 font-semibold">
+                {% if not is_first_page %}<a href="{{ url_for('patient_history') }}" class="text-[#0f4c81] hover:underline">&larr; Newest</a>{% else %}<span></span>{% endif %}
+                {% if next_cursor %}<a href="{{ url_for('patient_history', after=next_cursor) }}" class="text-[#0f4c81] hover:underline">Older &rarr;</a>{% endif %}
+            </div>
+
             <div class="mt-8 text-center">
                 <a href="/home" class="text-[#0f4c81] hover:underline font-semibold">Go back to Home</a>
             </div>
@@ -1587,11 +2916,524 @@ PATIENT_HISTORY_HTML = """
 """
 
 
+# --- Template Registry ---
+# Each page template is registered under a name and served through Jinja's loader, so it is
+# parsed and compiled once per process and then rendered from Jinja's template cache.
+TEMPLATES = {
+    'login_register.html': LOGIN_REGISTER_HTML,
+    'otp_register.html': OTP_REGISTER_HTML,
+    'otp_appointment.html': OTP_APPOINTMENT_HTML,
+    'otp_status_script.html': OTP_STATUS_SCRIPT_HTML,
+    'payment_success.html': PAYMENT_SUCCESS_HTML,
+    'home.html': HOME_HTML,
+    'appointment.html': APPOINTMENT_HTML,
+    'pending_payments.html': PENDING_PAYMENTS_HTML,
+    'profile.html': PROFILE_HTML,
+    'payment.html': PAYMENT_HTML,
+    'doctor_dashboard.html': DOCTOR_DASHBOARD_HTML,
+    'doctor_monthly_stats.html': DOCTOR_MONTHLY_STATS_HTML,
+    'patient_history.html': PATIENT_HISTORY_HTML,
+}
+
+# Optional on-disk cache of compiled template bytecode, shared across restarts and workers.
+TEMPLATE_BYTECODE_CACHE_DIR = os.environ.get('TEMPLATE_BYTECODE_CACHE_DIR')
+
+
+def configure_templates(flask_app):
+    """Puts the registry in front of the app's template loader (and enables the bytecode cache if configured)."""
+    flask_app.jinja_env.loader = ChoiceLoader([DictLoader(TEMPLATES), flask_app.jinja_env.loader])
+    flask_app.jinja_env.globals['asset_tag'] = asset_tag
+    if TEMPLATE_BYTECODE_CACHE_DIR:
+        os.makedirs(TEMPLATE_BYTECODE_CACHE_DIR, exist_ok=True)
+        flask_app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_BYTECODE_CACHE_DIR)
+
+
+def precompile_templates(flask_app):
+    """Compiles every registered template up front instead of on first use."""
+    for name in TEMPLATES:
+        flask_app.jinja_env.get_template(name)
+
+
+# --- Static Assets ---
+# `flask build-assets` compiles one purged, minified Tailwind stylesheet from the templates above
+# and copies in a local Chart.js build and the web fonts. Each file is written under a
+# content-hashed name with gzip (and, if the brotli package is installed, brotli) variants next
+# to it, and manifest.json maps the logical names to the hashed ones. Until a bundle has been
+# built, pages keep loading the CDN copies.
+ASSET_BUILD_DIR = os.environ.get('ASSET_BUILD_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'dist'))
+ASSET_MAX_AGE_SECONDS = 365 * 24 * 60 * 60 # Hashed names change with content, so browsers may cache forever
+ASSET_CDN_FALLBACKS = {
+    'tailwind.css': 'https://cdn.tailwindcss.com',
+    'chart.js': 'https://cdn.jsdelivr.net/npm/chart.js',
+    'fonts.css': 'https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&family=Playfair+Display:wght@700;900&display=swap',
+}
+# Input for the Tailwind v3 standalone CLI; v4 dropped both these directives and --content.
+TAILWIND_INPUT_CSS = "@tailwind base;\n@tailwind components;\n@tailwind utilities;\n"
+TAILWIND_SUPPORTED_MAJOR_VERSION = '3'
+FONT_FAMILIES = ('Inter', 'Playfair Display') # Used by the page templates
+mimetypes.add_type('font/woff2', '.woff2')
+
+
+def load_asset_manifest():
+    try:
+        with open(os.path.join(ASSET_BUILD_DIR, 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+asset_manifest = load_asset_manifest()
+
+
+def asset_tag(name):
+    """Returns the <link>/<script> tag for a built asset, or for its CDN copy if none has been built."""
+    hashed = asset_manifest.get(name)
+    if hashed is None:
+        url = ASSET_CDN_FALLBACKS[name]
+        stylesheet = name == 'fonts.css' # The Tailwind CDN build is a script that styles the page in the browser
+    else:
+        url = url_for('asset', filename=hashed)
+        stylesheet = name.endswith('.css')
+    if stylesheet:
+        return Markup(f'<link rel="stylesheet" href="{url}">')
+    return Markup(f'<script src="{url}"></script>')
+
+
+def _write_hashed_asset(name, data):
+    """Writes data as name.<hash>.ext plus its compressed variants. Returns the hashed file name."""
+    stem, ext = os.path.splitext(name)
+    hashed = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+    path = os.path.join(ASSET_BUILD_DIR, hashed)
+    with open(path, 'wb') as f:
+        f.write(data)
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+    return hashed
+
+
+def _check_tailwind_version(tailwind_cli):
+    """Raises RuntimeError unless tailwind_cli is a v3 CLI (v4 rejects the input and options used here)."""
+    try:
+        result = subprocess.run([tailwind_cli, '--help'], capture_output=True, text=True)
+    except OSError as e: # FileNotFoundError when the CLI is not installed or not on PATH
+        raise RuntimeError(f"Cannot run the Tailwind CSS CLI {tailwind_cli!r} ({e.strerror or e}). Install the "
+                           f"v{TAILWIND_SUPPORTED_MAJOR_VERSION}.4.x standalone CLI from "
+                           f"https://github.com/tailwindlabs/tailwindcss/releases and pass it with --tailwind-cli "
+                           f"or TAILWIND_CLI.") from e
+    match = re.search(r'tailwindcss v(\d+)\.', result.stdout + result.stderr)
+    if match and match.group(1) != TAILWIND_SUPPORTED_MAJOR_VERSION:
+        raise RuntimeError(f"{tailwind_cli} is Tailwind CSS v{match.group(1)}; build-assets needs the "
+                           f"v{TAILWIND_SUPPORTED_MAJOR_VERSION}.4.x standalone CLI.")
+
+
+def build_fonts_css(fonts):
+    """Returns @font-face rules for {family: hashed woff2 name}; the URLs are relative to /assets/."""
+    return ''.join(
+        f"@font-face{{font-family:'{family}';font-style:normal;font-weight:100 900;font-display:swap;"
+        f"src:url('{hashed}') format('woff2')}}\n"
+        for family, hashed in sorted(fonts.items())
+    )
+
+
+def build_assets(tailwind_cli='tailwindcss', chartjs_path=None, font_paths=None):
+    """Builds the asset bundle into ASSET_BUILD_DIR and returns the updated manifest.
+
+    tailwind_cli is the Tailwind CSS v3 standalone executable; it scans every registered
+    template so only the classes actually used end up in the stylesheet. chartjs_path is a
+    local chart.umd.js, and font_paths maps font families ('Inter', 'Playfair Display') to
+    local variable-weight .woff2 files; without them, previously built copies are kept.
+    """
+    _check_tailwind_version(tailwind_cli)
+    os.makedirs(ASSET_BUILD_DIR, exist_ok=True)
+    manifest = load_asset_manifest()
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name, source in TEMPLATES.items():
+            with open(os.path.join(work_dir, name), 'w', encoding='utf-8') as f:
+                f.write(source)
+        input_path = os.path.join(work_dir, 'input.css')
+        output_path = os.path.join(work_dir, 'tailwind.css')
+        with open(input_path, 'w') as f:
+            f.write(TAILWIND_INPUT_CSS)
+        subprocess.run([tailwind_cli, '--input', input_path, '--output', output_path,
+                        '--content', os.path.join(work_dir, '*.html'), '--minify'], check=True)
+        with open(output_path, 'rb') as f:
+            manifest['tailwind.css'] = _write_hashed_asset('tailwind.css', f.read())
+    if chartjs_path:
+        with open(chartjs_path, 'rb') as f:
+            manifest['chart.js'] = _write_hashed_asset('chart.js', f.read())
+    if font_paths:
+        fonts = dict(manifest.get('fonts', {}))
+        for family, path in font_paths.items():
+            with open(path, 'rb') as f:
+                fonts[family] = _write_hashed_asset(family.lower().replace(' ', '-') + '.woff2', f.read())
+        manifest['fonts'] = fonts
+        manifest['fonts.css'] = _write_hashed_asset('fonts.css', build_fonts_css(fonts).encode('utf-8'))
+
+    manifest_path = os.path.join(ASSET_BUILD_DIR, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+# --- Server-Side Sessions ---
+# The session cookie only carries a random session ID; the data itself (pending registrations
+# with their password hash, pending appointments, OTP bookkeeping) stays on the server.
+# SESSION_BACKEND picks where: 'sqlite' (a local file shared by every worker on the host),
+# 'memory' (this process only, so single-worker setups) or 'cookie' (Flask's signed cookie).
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'sqlite')
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', 24 * 60 * 60))
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', 10000)) # memory backend only
+SESSION_SQLITE_PATH = os.environ.get('SESSION_SQLITE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'sessions.sqlite3'))
+SESSION_PURGE_INTERVAL_SECONDS = 300 # How often each process deletes expired SQLite rows
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session dict that remembers its ID and whether it was changed during the request."""
+
+    def __init__(self, initial=None, sid=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.previous_sid = None
+        self.modified = False
+
+    def regenerate(self):
+        """Moves the data to a new session ID when saved and deletes the old entry."""
+        if self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+
+def regenerate_session():
+    """Issues a new session ID whenever the user's privileges change (login, logout).
+
+    Otherwise an ID planted in the browser before login would become an authenticated session.
+    Flask's signed cookie sessions need nothing here: their content is the credential.
+    """
+    if isinstance(session._get_current_object(), ServerSideSession):
+        session.regenerate()
+
+
+class MemorySessionStore:
+    """Sessions held in this process's memory, least recently used evicted first."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self._cache = TTLCache(max_entries, ttl_seconds)
+
+    def get(self, sid):
+        return self._cache.get(sid)
+
+    def set(self, sid, data):
+        self._cache.set(sid, data)
+
+    def touch(self, sid):
+        data = self._cache.get(sid)
+        if data is not None:
+            self._cache.set(sid, data)
+
+    def delete(self, sid):
+        self._cache.invalidate(sid)
+
+
+class SqliteSessionStore:
+    """Sessions in a local SQLite file (WAL mode), with one connection per thread."""
+
+    def __init__(self, path, ttl_seconds):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._serializer = TaggedJSONSerializer()
+        self._local = threading.local()
+        self._next_purge = 0
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)')
+            self._local.conn = conn
+        return conn
+
+    def get(self, sid):
+        row = self._connection().execute(
+            'SELECT data FROM sessions WHERE sid = ? AND expires_at > ?', (sid, time.time())).fetchone()
+        return self._serializer.loads(row[0]) if row else None
+
+    def set(self, sid, data):
+        now = time.time()
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO sessions (sid, data, expires_at) VALUES (?, ?, ?)',
+                     (sid, self._serializer.dumps(data), now + self.ttl_seconds))
+        if now >= self._next_purge:
+            self._next_purge = now + SESSION_PURGE_INTERVAL_SECONDS
+            conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (now,))
+
+    def touch(self, sid):
+        """Extends the session's expiry. Writes only once at least half of the TTL has passed."""
+        now = time.time()
+        self._connection().execute('UPDATE sessions SET expires_at = ? WHERE sid = ? AND expires_at > ? AND expires_at < ?',
+                                   (now + self.ttl_seconds, sid, now, now + self.ttl_seconds / 2))
+
+    def delete(self, sid):
+        self._connection().execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Loads and saves sessions through a session store, keyed by the ID in the session cookie."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        data = self.store.get(sid) if sid else None
+        if data is None:
+            return ServerSideSession() # Unknown or expired IDs are never reused; a new one is issued on save
+        return ServerSideSession(data, sid)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+        if session.previous_sid:
+            self.store.delete(session.previous_sid)
+
+        if not session:
+            if session.modified and (session.sid or session.previous_sid):
+                if session.sid:
+                    self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly)
+            return
+
+        if not session.modified and session.sid:
+            # Sessions in use stay alive even when nothing in them changes.
+            self.store.touch(session.sid)
+        if not self.should_set_cookie(app, session):
+            return
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(16)
+        self.store.set(session.sid, dict(session))
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=httponly, domain=domain, path=path, secure=secure, samesite=samesite)
+
+
+def make_session_interface(backend):
+    """Returns the session interface for a SESSION_BACKEND value, or None to keep Flask's cookie sessions."""
+    if backend == 'cookie':
+        return None
+    if backend == 'memory':
+        return ServerSideSessionInterface(MemorySessionStore(SESSION_MAX_ENTRIES, SESSION_TTL_SECONDS))
+    if backend == 'sqlite':
+        return ServerSideSessionInterface(SqliteSessionStore(SESSION_SQLITE_PATH, SESSION_TTL_SECONDS))
+    raise ValueError(f"Unknown SESSION_BACKEND {backend!r}; expected 'sqlite', 'memory' or 'cookie'.")
+
+
+# --- Secret Key ---
+# Every worker process must sign with the same key, and the key must survive restarts, or
+# users get logged out. SECRET_KEY_FALLBACKS lists retired keys (comma-separated, newest first)
+# that are still accepted when verifying, so a key can be rotated without logging anyone out.
+SECRET_KEY_PATH = os.environ.get('SECRET_KEY_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'secret_key'))
+
+
+def load_secret_keys():
+    """Returns (secret_key, fallback_keys).
+
+    The key comes from the SECRET_KEY environment variable. Without one, a random key is
+    generated on first start and kept in SECRET_KEY_PATH, which suits a single host.
+    """
+    fallbacks = [k.strip() for k in os.environ.get('SECRET_KEY_FALLBACKS', '').split(',') if k.strip()]
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY'], fallbacks
+
+    if not os.path.exists(SECRET_KEY_PATH):
+        os.makedirs(os.path.dirname(SECRET_KEY_PATH) or '.', exist_ok=True)
+        temp_path = f'{SECRET_KEY_PATH}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(secrets.token_hex(32))
+        os.chmod(temp_path, 0o600)
+        try:
+            os.link(temp_path, SECRET_KEY_PATH) # Atomic: if several workers race, the first one wins
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    with open(SECRET_KEY_PATH) as f:
+        return f.read().strip(), fallbacks
+
+
+# --- Conditional Responses ---
+# Pages that only change when their data does get an ETag (and Last-Modified) derived from version
+# stamps: per-scope change counters bumped by the save_*/update_* helpers once their writes are in.
+# Scopes are 'user:{email}', 'patient:{patient_id}', 'doctor:{doctor_id}' and 'doctors' (the
+# directory of available doctors). A request whose validators still match gets 304 Not Modified
+# before the view runs, so nothing is read from the database or rendered.
+# Stamps are shared by the workers of one host through VERSION_STAMP_PATH ('memory' storage keeps
+# them per process like its data). Writes made on another host are not seen, so multi-host
+# deployments should set CONDITIONAL_RESPONSES=0. Process-wide caches that pages read from reload
+# once a stamp moves past the version they were loaded at (see current_version).
+CONDITIONAL_RESPONSES = os.environ.get('CONDITIONAL_RESPONSES', '1') == '1'
+VERSION_STAMP_PATH = os.environ.get('VERSION_STAMP_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'versions.sqlite3'))
+
+
+class MemoryVersionStamps:
+    """Version stamps held in this process."""
+
+    def __init__(self):
+        self.epoch = secrets.token_hex(8) # Distinguishes this process's counters from a previous run's
+        self._stamps = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, scopes):
+        """Returns a (version, updated_at) pair per scope; (0, None) for scopes never bumped."""
+        with self._lock:
+            return [self._stamps.get(scope, (0, None)) for scope in scopes]
+
+    def bump(self, *scopes):
+        now = time.time()
+        with self._lock:
+            for scope in scopes:
+                self._stamps[scope] = (self._stamps.get(scope, (0, None))[0] + 1, now)
+
+
+class SqliteVersionStamps:
+    """Version stamps in a SQLite file shared by every worker on the host."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._epoch = None
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS stamps (scope TEXT PRIMARY KEY, version INTEGER NOT NULL, updated_at REAL)')
+            # The epoch row is written once per file, so counters restarting in a new file never repeat an ETag
+            conn.execute("INSERT OR IGNORE INTO stamps (scope, version, updated_at) VALUES ('__epoch__', ?, NULL)",
+                         (secrets.randbits(62),))
+            self._local.conn = conn
+        return conn
+
+    @property
+    def epoch(self):
+        if self._epoch is None:
+            self._epoch = self._connection().execute("SELECT version FROM stamps WHERE scope = '__epoch__'").fetchone()[0]
+        return self._epoch
+
+    def get_many(self, scopes):
+        """Returns a (version, updated_at) pair per scope; (0, None) for scopes never bumped."""
+        placeholders = ', '.join('?' * len(scopes))
+        rows = self._connection().execute(
+            f'SELECT scope, version, updated_at FROM stamps WHERE scope IN ({placeholders})', scopes).fetchall()
+        found = {scope: (version, updated_at) for scope, version, updated_at in rows}
+        return [found.get(scope, (0, None)) for scope in scopes]
+
+    def bump(self, *scopes):
+        now = time.time()
+        conn = self._connection()
+        for scope in scopes:
+            conn.execute('INSERT INTO stamps (scope, version, updated_at) VALUES (?, 1, ?) '
+                         'ON CONFLICT(scope) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at',
+                         (scope, now))
+
+
+version_stamps = MemoryVersionStamps() if STORAGE_BACKEND == 'memory' else SqliteVersionStamps(VERSION_STAMP_PATH)
+
+
+def bump_versions(*scopes):
+    """Marks the given scopes as changed, invalidating ETags of pages built from them."""
+    if CONDITIONAL_RESPONSES:
+        version_stamps.bump(*scopes)
+
+
+def current_version(scope):
+    """Returns the scope's current version (0 when conditional responses are off).
+
+    Process-wide caches that pages are built from (user_cache, doctor_directory) remember the
+    version they loaded at and reload once it moves, so a page is never older than its ETag.
+    """
+    return version_stamps.get_many([scope])[0][0] if CONDITIONAL_RESPONSES else 0
+
+
+# Anything besides data that changes rendered pages (templates, built asset names) goes into every ETag
+RESPONSE_CACHE_SALT = hashlib.sha256(
+    json.dumps([TEMPLATES, asset_manifest], sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def conditional_response(scopes_for_request, cache_control='private, no-cache'):
+    """Decorator answering GET requests with 304 Not Modified while the page's version stamps are unchanged.
+
+    scopes_for_request() returns the scopes the page is built from for the current session, or
+    None to skip conditional handling (e.g. when the user is not logged in).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            scopes = scopes_for_request() if CONDITIONAL_RESPONSES and request.method == 'GET' else None
+            if not scopes:
+                return view(*args, **kwargs)
+
+            # Stamps are read before the view reads its data, so a concurrent write can only make the ETag stale, never wrong
+            stamps = version_stamps.get_many(scopes)
+            etag = hashlib.sha256(json.dumps(
+                [RESPONSE_CACHE_SALT, version_stamps.epoch, storage.epoch,
+                 session.get('user_id'), request.full_path, stamps]
+            ).encode('utf-8')).hexdigest()[:32]
+            updated = [updated_at for _, updated_at in stamps if updated_at is not None]
+            last_modified = datetime.fromtimestamp(int(max(updated)), timezone.utc) if updated else None
+
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            response.headers['Cache-Control'] = cache_control
+            return response
+        return wrapper
+    return decorator
+
+
+def _session_scopes(id_field):
+    """Scopes for a page built from the logged-in user and their patient/doctor records."""
+    if 'user_id' not in session or not session.get(id_field):
+        return None
+    return [f"user:{session['user_id']}", f"{id_field.split('_')[0]}:{session[id_field]}"]
+
+
 # --- Routes ---
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = secrets.token_hex(16)
+app.config['SECRET_KEY'], app.config['SECRET_KEY_FALLBACKS'] = load_secret_keys()
+app.config['BCRYPT_LOG_ROUNDS'] = PASSWORD_HASH_ROUNDS
 bcrypt = Bcrypt(app)
+configure_templates(app)
+session_interface = make_session_interface(SESSION_BACKEND)
+if session_interface:
+    app.session_interface = session_interface
+if os.environ.get('PRECOMPILE_TEMPLATES') == '1':
+    precompile_templates(app)
 
 @app.route('/')
 def root():
@@ -1599,8 +3441,6 @@ def root():
 
 @app.route('/login_register', methods=['GET', 'POST'])
 def login_register():
-    global PATIENT_ID_COUNTER, DOCTOR_ID_COUNTER
-
     if request.method == 'POST':
         form_type = request.form.get('form_type')
         email = request.form.get('email')
@@ -1608,10 +3448,18 @@ def login_register():
         if form_type == 'login':
             password = request.form.get('password')
             user_data = get_user(email)
-            if user_data and bcrypt.check_password_hash(user_data['password_hash'], password):
+            try:
+                password_ok = bool(user_data) and password_hasher.check(user_data['password_hash'], password)
+            except PasswordPoolBusy:
+                return BUSY_RESPONSE
+            if password_ok:
+                regenerate_session()
                 session['user_id'] = user_data['id']
                 session['user_name'] = user_data['name']
                 session['user_role'] = user_data['role']
+                # Lets conditional_response find the user's version stamps without loading the user
+                session['patient_id'] = user_data.get('patient_id')
+                session['doctor_id'] = user_data.get('doctor_id')
                 if user_data['role'] == 'patient':
                     return redirect(url_for('home'))
                 elif user_data['role'] == 'doctor':
@@ -1628,7 +3476,10 @@ def login_register():
             if get_user(email):
                 return "Registration failed. User with this email already exists."
             
-            password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+            try:
+                password_hash = password_hasher.hash(password)
+            except PasswordPoolBusy:
+                return BUSY_RESPONSE
             
             user_data = {
                 'id': email,
@@ -1648,13 +3499,11 @@ def login_register():
                 session.pop('pending_registration', None)
                 return "Registration failed. Could not send OTP. Check phone format (E.164: +CCNNNNNNNNN) or Twilio setup."
 
-    return render_template_string(LOGIN_REGISTER_HTML)
+    return render_template('login_register.html')
 
 
 @app.route('/confirm_otp_register', methods=['GET', 'POST'])
 def confirm_otp_register():
-    global PATIENT_ID_COUNTER, DOCTOR_ID_COUNTER
-    
     user_data = session.get('pending_registration')
     if not user_data:
         return redirect(url_for('login_register'))
@@ -1666,8 +3515,7 @@ def confirm_otp_register():
         
         if check_otp_via_twilio(phone_number, user_otp):
             if user_data['role'] == 'patient':
-                patient_id = f"PAT-{PATIENT_ID_COUNTER}"
-                PATIENT_ID_COUNTER += 1
+                patient_id = f"PAT-{patient_id_allocator.next_id()}"
                 user_data.update({
                     'patient_id': patient_id,
                     'age': 'Not specified',
@@ -1676,8 +3524,7 @@ def confirm_otp_register():
                     'profile_pic_url': PROFILE_PIC_CHOICES['default'] 
                 })
             elif user_data['role'] == 'doctor':
-                doctor_id = f"DOC-{DOCTOR_ID_COUNTER}"
-                DOCTOR_ID_COUNTER += 1
+                doctor_id = f"DOC-{doctor_id_allocator.next_id()}"
                 user_data.update({
                     'doctor_id': doctor_id,
                     'available': True,
@@ -1691,14 +3538,22 @@ def confirm_otp_register():
 
             return redirect(url_for('login_register'))
         else:
-            return render_template_string(OTP_REGISTER_HTML, phone_number=phone_number, error="Invalid OTP. Please try again.")
+            return render_template('otp_register.html', phone_number=phone_number, error="Invalid OTP. Please try again.")
+
+    return render_template('otp_register.html', phone_number=phone_number,
+                           dispatch_id=session.get('otp_dispatch_id'), retry_url=url_for('login_register'))
 
-    return render_template_string(OTP_REGISTER_HTML, phone_number=phone_number)
+@app.route('/otp_status/<dispatch_id>')
+def otp_status(dispatch_id):
+    """Delivery status of the OTP queued for this session: queued, sent, failed or unknown."""
+    if dispatch_id != session.get('otp_dispatch_id'):
+        return jsonify({'status': 'unknown'}), 404
+    return jsonify({'status': otp_dispatcher.status(dispatch_id)})
 
 @app.route('/home')
 def home():
     if 'user_id' in session and session['user_role'] == 'patient':
-        return render_template_string(HOME_HTML)
+        return render_template('home.html')
     return redirect(url_for('login_register'))
 
 @app.route('/pending_payments')
@@ -1706,10 +3561,11 @@ def pending_payments():
     if 'user_id' in session and session['user_role'] == 'patient':
         user = get_user(session['user_id'])
         pending_prescriptions = get_pending_prescriptions_for_patient(user['patient_id'])
-        return render_template_string(PENDING_PAYMENTS_HTML, prescriptions=pending_prescriptions)
+        return render_template('pending_payments.html', prescriptions=pending_prescriptions)
     return redirect(url_for('login_register'))
 
 @app.route('/profile')
+@conditional_response(lambda: _session_scopes('patient_id'))
 def profile():
     if 'user_id' in session and session['user_role'] == 'patient':
         user = get_user(session['user_id'])
@@ -1718,10 +3574,14 @@ def profile():
         # Ensure profile_pic_url is set, defaulting if missing
         user['profile_pic_url'] = user.get('profile_pic_url', PROFILE_PIC_CHOICES['default'])
         
-        prescriptions = get_prescriptions_for_patient(user['patient_id'])
+        try:
+            prescriptions, next_cursor = get_prescriptions_page_for_patient(user['patient_id'], request.args.get('after'))
+        except ValueError:
+            return "Error: Invalid page cursor.", 400
         
         # Pass the map of choices to the template
-        return render_template_string(PROFILE_HTML, user=user, prescriptions=prescriptions, pic_choices=PROFILE_PIC_CHOICES)
+        return render_template('profile.html', user=user, prescriptions=prescriptions, pic_choices=PROFILE_PIC_CHOICES,
+                               next_cursor=next_cursor, is_first_page='after' not in request.args)
     return redirect(url_for('login_register'))
 
 @app.route('/update_profile', methods=['POST'])
@@ -1733,19 +3593,14 @@ def update_profile():
         # Retrieve the selected URL from the dropdown
         profile_pic_url = request.form.get('profile_pic_url') 
 
-        user['age'] = age
-        user['gender'] = gender
-        user['profile_pic_url'] = profile_pic_url # Update with selected URL
-
-        if db:
-            user_ref = db.collection('users').document(user['id'])
-            user_ref.update({'age': age, 'gender': gender, 'profile_pic_url': profile_pic_url})
+        update_user(user['id'], {'age': age, 'gender': gender, 'profile_pic_url': profile_pic_url})
         
         return redirect(url_for('profile'))
     return "Error: Could not update profile."
 
 
 @app.route('/book_appointment', methods=['GET', 'POST'])
+@conditional_response(lambda: ['doctors'] if session.get('patient_id') else None)
 def book_appointment():
     if 'user_id' in session and session['user_role'] == 'patient':
         if request.method == 'POST':
@@ -1755,14 +3610,22 @@ def book_appointment():
             doctor = get_user(doctor_email)
             
             if doctor and doctor.get('available'):
+                if session.get('slot_hold'):
+                    release_slot_hold(*session.pop('slot_hold'))
                 patient = get_user(session['user_id'])
+                try:
+                    start, end = validate_slot(doctor, date, time)
+                    session['slot_hold'] = place_slot_hold(doctor.get('doctor_id', doctor['id']), date, start, end, patient['patient_id'])
+                except SlotUnavailable as error:
+                    return str(error), 409
                 
                 new_appointment = {
                     'patient_id': patient['patient_id'],
                     'doctor_id': doctor.get('doctor_id', doctor['id']),
                     'patient_name': patient['name'],
                     'date': date,
-                    'time': time,
+                    'time': format_hhmm(start),
+                    'end_time': format_hhmm(end),
                     'status': 'Booked' # Status is set to 'Booked'
                 }
                 
@@ -1773,12 +3636,18 @@ def book_appointment():
                     return redirect(url_for('confirm_otp_appointment'))
                 else:
                     session.pop('pending_appointment', None)
+                    release_slot_hold(*session.pop('slot_hold'))
                     return "Appointment failed. Could not send OTP. Check your phone number format (E.164) or Twilio setup."
             
             return "Doctor is not available or not found."
 
-        doctors = get_available_doctors()
-        return render_template_string(APPOINTMENT_HTML, doctors=doctors)
+        try:
+            doctors, next_cursor = doctor_directory.search(request.args.get('q', ''), request.args.get('specialty'),
+                                                           request.args.get('after'))
+        except ValueError:
+            return "Error: Invalid page cursor.", 400
+        return render_template('appointment.html', doctors=doctors, next_cursor=next_cursor,
+                               specialties=doctor_directory.specialties())
     return redirect(url_for('login_register'))
 
 
@@ -1796,16 +3665,24 @@ def confirm_otp_appointment():
         user_otp = request.form.get('otp_code')
         
         if patient_phone and check_otp_via_twilio(patient_phone, user_otp):
-            save_appointment(appointment_data)
+            hold = session.pop('slot_hold', None)
+            try:
+                save_appointment(appointment_data, reserve_slot=True, hold_id=hold[1] if hold else None)
+            except SlotUnavailable as error:
+                if hold:
+                    release_slot_hold(*hold) # Free the patient's held slot now rather than when the hold expires
+                session.pop('pending_appointment', None)
+                return str(error), 409
             print(f"Appointment confirmed and saved after OTP verification: {appointment_data}")
 
             session.pop('pending_appointment', None)
             
             return redirect(url_for('profile'))
         else:
-            return render_template_string(OTP_APPOINTMENT_HTML, phone_number=patient_phone, error="Invalid OTP. Please try again.")
+            return render_template('otp_appointment.html', phone_number=patient_phone, error="Invalid OTP. Please try again.")
 
-    return render_template_string(OTP_APPOINTMENT_HTML, phone_number=patient_phone)
+    return render_template('otp_appointment.html', phone_number=patient_phone,
+                           dispatch_id=session.get('otp_dispatch_id'), retry_url=url_for('book_appointment'))
 
 
 @app.route('/payment', methods=['GET'])
@@ -1819,7 +3696,7 @@ def payment():
         if not prescription:
             return "Error: Prescription not found."
             
-        return render_template_string(PAYMENT_HTML, prescription=prescription)
+        return render_template('payment.html', prescription=prescription)
     return redirect(url_for('login_register'))
 
 @app.route('/process_payment', methods=['POST'])
@@ -1846,12 +3723,15 @@ def process_payment():
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'date': datetime.now().strftime('%Y-%m-%d'),
             'doctor_id': doctor_id,
+            'prescription_id': prescription_id,
             'payment_method': payment_method,
             'status': 'Completed'
         }
         
-        save_payment(payment_data)
-        update_prescription_payment_status(prescription_id, 'completed')
+        # The payment and the prescription's paid status are committed together
+        with write_batch() as batch:
+            save_payment(payment_data, batch)
+            update_prescription_payment_status(prescription_id, 'completed', batch)
         
         return redirect(url_for('payment_success', amount=amount)) # Pass amount to success page 
     return "Error: Could not process payment."
@@ -1866,7 +3746,7 @@ def payment_success():
         except ValueError:
             amount = DEFAULT_PRESCRIPTION_FEE
             
-        return render_template_string(PAYMENT_SUCCESS_HTML, datetime_now=datetime.now().strftime('%Y-%m-%d %H:%M:%S'), amount=amount)
+        return render_template('payment_success.html', datetime_now=datetime.now().strftime('%Y-%m-%d %H:%M:%S'), amount=amount)
     return redirect(url_for('login_register'))
 
 
@@ -1874,50 +3754,51 @@ def payment_success():
 def doctor_dashboard():
     if 'user_id' in session and session['user_role'] == 'doctor':
         doctor = get_user(session['user_id'])
-        doctor_id = doctor.get('doctor_id', doctor['id'])
-        
-        appointments = get_appointments_for_doctor(doctor_id)
-        
-        # Separate appointments into Booked and Completed
-        appointments_booked = [a for a in appointments if a['status'] == 'Booked']
-        appointments_completed = [a for a in appointments if a['status'] == 'Completed']
-        
-        today = datetime.now().strftime('%Y-%m-%d')
-        today_payments = get_payments_by_doctor_and_date(doctor_id, today)
-        total_earnings = sum(p['amount'] for p in today_payments)
-
-        # Build hourly earnings for today's chart (00-23)
-        hourly_map = {f"{h:02d}": 0 for h in range(24)}
-        for p in today_payments:
-            try:
-                hour = p['timestamp'].split(' ')[1].split(':')[0]
-                hourly_map[hour] = hourly_map.get(hour, 0) + p.get('amount', 0)
-            except Exception:
-                pass
-        today_chart_labels = list(hourly_map.keys())
-        today_chart_values = [hourly_map[h] for h in today_chart_labels]
-
-        stats = {
-            'patients_assigned': len(get_patients_for_doctor(doctor_id)),
-            'prescriptions_written': len(get_prescriptions_by_doctor(doctor_id)),
-            'appointments_completed': len(appointments_completed), # Use the separated list
-            'total_earnings': total_earnings
-        }
-        
-        return render_template_string(
-            DOCTOR_DASHBOARD_HTML,
-            doctor=doctor,
-            appointments_booked=appointments_booked, # Pass separated lists
-            appointments_completed=appointments_completed, # Pass separated lists
-            stats=stats,
-            today_payments=today_payments,
-            today_chart_labels=today_chart_labels,
-            today_chart_values=today_chart_values,
-            DEFAULT_PRESCRIPTION_FEE=DEFAULT_PRESCRIPTION_FEE
-        )
+        try:
+            return render_doctor_dashboard(doctor)
+        except ValueError:
+            return "Error: Invalid page cursor.", 400
     return redirect(url_for('login_register'))
 
+
+def render_doctor_dashboard(doctor, error=None):
+    """Renders the dashboard page for a doctor. Raises ValueError for a malformed page cursor."""
+    doctor_id = doctor.get('doctor_id', doctor['id'])
+
+    # Booked and Completed appointments are paged independently
+    appointments_booked, booked_next = get_appointments_page_for_doctor(doctor_id, 'Booked', request.args.get('booked_after'))
+    appointments_completed, completed_next = get_appointments_page_for_doctor(doctor_id, 'Completed', request.args.get('completed_after'))
+
+    today = datetime.now().strftime('%Y-%m-%d')
+    today_payments = get_payments_by_doctor_and_date(doctor_id, today)
+
+    # Today's total and hourly chart (00-23) come from the precomputed daily earnings document
+    today_earnings = get_daily_earnings(doctor_id, today)
+    today_chart_labels = list(today_earnings['hourly'].keys())
+    today_chart_values = [today_earnings['hourly'][h] for h in today_chart_labels]
+
+    stats = {
+        **get_doctor_counters(doctor_id),
+        'total_earnings': today_earnings['total_earnings']
+    }
+
+    return render_template(
+        'doctor_dashboard.html',
+        doctor=doctor,
+        appointments_booked=appointments_booked, # Pass separated lists
+        appointments_completed=appointments_completed, # Pass separated lists
+        booked_next=booked_next,
+        completed_next=completed_next,
+        stats=stats,
+        today_payments=today_payments,
+        today_chart_labels=today_chart_labels,
+        today_chart_values=today_chart_values,
+        DEFAULT_PRESCRIPTION_FEE=DEFAULT_PRESCRIPTION_FEE,
+        error=error
+    )
+
 @app.route('/doctor_monthly_stats')
+@conditional_response(lambda: _session_scopes('doctor_id'))
 def doctor_monthly_stats():
     if 'user_id' in session and session['user_role'] == 'doctor':
         doctor = get_user(session['user_id'])
@@ -1930,8 +3811,8 @@ def doctor_monthly_stats():
         monthly_chart_labels = [s['month_year'] for s in monthly_stats]
         monthly_chart_values = [s['total_earnings'] for s in monthly_stats]
         
-        return render_template_string(
-            DOCTOR_MONTHLY_STATS_HTML,
+        return render_template(
+            'doctor_monthly_stats.html',
             doctor=doctor,
             monthly_stats=monthly_stats,
             monthly_chart_labels=monthly_chart_labels,
@@ -1946,10 +3827,7 @@ def toggle_availability():
         doctor = get_user(session['user_id'])
         if doctor:
             new_availability = not doctor.get('available', True)
-            doctor['available'] = new_availability
-            if db:
-                doc_ref = db.collection('users').document(doctor['id'])
-                doc_ref.update({'available': new_availability})
+            update_user(doctor['id'], {'available': new_availability})
             return redirect(url_for('doctor_dashboard'))
     return "Error: Could not toggle availability."
 
@@ -1982,182 +3860,456 @@ def add_prescription():
             'payment_status': 'pending'
         }
         
-        save_prescription(new_prescription)
-        
-        # --- LOGIC SHIFT: Mark Appointment as Completed immediately upon writing Rx ---
-        if appointment_doc_id:
-            update_appointment_status_by_id(appointment_doc_id, 'Completed')
-            print(f"Appointment {appointment_doc_id} marked as Completed by doctor's action (Prescription issued).")
-        # --- END LOGIC SHIFT ---
+        # The prescription and the appointment's completion are committed together
+        try:
+            with write_batch() as batch:
+                save_prescription(new_prescription, batch)
+
+                # --- LOGIC SHIFT: Mark Appointment as Completed immediately upon writing Rx ---
+                if appointment_doc_id:
+                    update_appointment_status_by_id(appointment_doc_id, 'Completed', batch)
+                    batch.after_commit(print, f"Appointment {appointment_doc_id} marked as Completed by doctor's action (Prescription issued).")
+                # --- END LOGIC SHIFT ---
+        except WriteConflict:
+            # The appointment changed between the status read and the commit; nothing was saved.
+            error = "This appointment was updated while you were writing the prescription, so it was not saved. Please check the appointment and try again."
+            return render_doctor_dashboard(doctor, error=error), 409
         
         return redirect(url_for('doctor_dashboard'))
     return "Error: Could not add prescription."
 
 @app.route('/patient_history')
+@conditional_response(lambda: _session_scopes('patient_id'))
 def patient_history():
     if 'user_id' in session and session['user_role'] == 'patient':
         patient = get_user(session['user_id'])
         
         # Fetch detailed history
-        history = get_full_patient_history(patient['patient_id'])
+        try:
+            history, next_cursor = get_patient_history_page(patient['patient_id'], request.args.get('after'))
+        except ValueError:
+            return "Error: Invalid page cursor.", 400
         
-        return render_template_string(PATIENT_HISTORY_HTML, patient=patient, history=history)
+        return render_template('patient_history.html', patient=patient, history=history,
+                               next_cursor=next_cursor, is_first_page='after' not in request.args)
     return redirect(url_for('login_register'))
 
 
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    """Serves a built asset with long-lived cache headers, preferring a precompressed variant."""
+    mimetype = mimetypes.guess_type(filename)[0]
+    response = None
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        variant = safe_join(ASSET_BUILD_DIR, filename + suffix)
+        if request.accept_encodings[encoding] and variant and os.path.isfile(variant):
+            response = send_from_directory(ASSET_BUILD_DIR, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    if response is None:
+        response = send_from_directory(ASSET_BUILD_DIR, filename, mimetype=mimetype)
+    response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE_SECONDS}, immutable'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/admin/cache_stats')
+def cache_stats():
+    """Hit/miss/eviction counters for this worker's process-wide caches (admins only)."""
+    if session.get('user_id') not in ADMIN_EMAILS:
+        return "Error: Not authorized.", 403
+    return jsonify({
+        'users': user_cache.stats(),
+        'doctor_directory': doctor_directory.stats(),
+        'slot_holds_released': slot_hold_reaper.released,
+    })
+
+
 @app.route('/logout')
 def logout():
     session.clear()
+    regenerate_session()
     return redirect(url_for('login_register'))
 
 
+# --- Request-Scoped Unit of Work ---
+
+class RequestUnitOfWork:
+    """Identity map for a single request, stored on flask.g.
+
+    Each document is fetched from the database at most once per request; query results
+    are memoised per collection and dropped whenever that collection is written, and
+    writes are applied to the mapped documents so later reads see them without a fetch.
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.queries = {}
+
+    def get(self, collection, key, loader):
+        if (collection, key) not in self.documents:
+            self.documents[(collection, key)] = loader()
+        return self.documents[(collection, key)]
+
+    def remember(self, collection, key, doc):
+        """Maps a document read by a query, returning the instance already mapped for its key."""
+        existing = self.documents.get((collection, key))
+        if existing is None:
+            self.documents[(collection, key)] = doc
+            return doc
+        return existing
+
+    def query(self, collections, signature, loader, key_field=None):
+        if signature not in self.queries:
+            result = loader()
+            if key_field and isinstance(result, list):
+                result = [self.remember(collections[0], d[key_field], d) if d.get(key_field) else d for d in result]
+            elif key_field and isinstance(result, dict) and result.get(key_field):
+                result = self.remember(collections[0], result[key_field], result)
+            self.queries[signature] = (collections, result)
+        return self.queries[signature][1]
+
+    def invalidate_queries(self, collection):
+        self.queries = {sig: entry for sig, entry in self.queries.items() if collection not in entry[0]}
+
+    def record_write(self, collection, key, doc):
+        if key is not None:
+            self.documents[(collection, key)] = doc
+        self.invalidate_queries(collection)
+
+    def record_update(self, collection, key, changes):
+        doc = self.documents.get((collection, key))
+        if doc is not None:
+            doc.update(changes)
+        self.invalidate_queries(collection)
+
+
+def current_unit_of_work():
+    """Returns the unit of work for the active request, or None outside a request."""
+    if not has_request_context():
+        return None
+    if 'unit_of_work' not in g:
+        g.unit_of_work = RequestUnitOfWork()
+    return g.unit_of_work
+
+
+def request_cached(collections, document=False, key_field=None):
+    """Routes a read helper through the request's unit of work.
+
+    document=True treats the first argument as the document key in collections[0];
+    otherwise the call is memoised as a query that depends on all given collections.
+    """
+    if isinstance(collections, str):
+        collections = (collections,)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            uow = current_unit_of_work()
+            if uow is None:
+                return func(*args)
+            if document:
+                return uow.get(collections[0], args[0], lambda: func(*args))
+            return uow.query(collections, (func.__name__,) + args, lambda: func(*args), key_field)
+        return wrapper
+    return decorator
+
+
+def record_write(collection, key, doc):
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow.record_write(collection, key, doc)
+
+
+def record_update(collection, key, changes):
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow.record_update(collection, key, changes)
+
+
+# --- Atomic Write Batches ---
+# Flows that touch several documents (writing a prescription and completing its appointment,
+# taking a payment and marking its prescription paid) pass one WriteBatch through the save
+# helpers, so all their writes land in a single Firestore commit or not at all. On the local
+# backends the same batch queues the writes and applies them together in one
+# local_store.transaction().
+
+
+class WriteConflict(Exception):
+    """Raised when a batch write's precondition failed because the document changed after it was read."""
+
+
+class WriteBatch:
+    """Collects related writes and commits them atomically in one commit.
+
+    The batch itself is a single write; any reads a helper does to decide what to write (such as
+    update_appointment_status_by_id's) are separate round-trips made before the commit. Such
+    writes carry a last-update-time precondition, and commit() raises WriteConflict if it failed.
+    Batches are created by the storage backend (storage.batch()).
+    """
+
+    def __init__(self, firestore_batch=None, store=None):
+        self._batch = firestore_batch
+        self._store = store
+        self._memory_writes = []
+        self._after_commit = []
+
+    def set(self, doc_ref, data, merge=False):
+        self._batch.set(doc_ref, data, merge=merge)
+
+    def update(self, doc_ref, changes, option=None):
+        self._batch.update(doc_ref, changes, option=option)
+
+    def apply(self, func, *args, **kwargs):
+        """Queues a local write to run at commit time."""
+        if self._batch is not None:
+            raise RuntimeError('Local writes cannot join a Firestore batch; they would not commit atomically with it.')
+        self._memory_writes.append(functools.partial(func, *args, **kwargs))
+
+    def after_commit(self, func, *args, **kwargs):
+        """Queues bookkeeping (cache invalidation, logging) that must only happen once the writes are in."""
+        self._after_commit.append(functools.partial(func, *args, **kwargs))
+
+    def commit(self):
+        """Commits the Firestore batch or, on a local backend, the queued local writes; a batch
+        only ever holds one kind (set()/update() need Firestore and apply() refuses it). The
+        after-commit callbacks run only once the writes are in."""
+        if self._batch is not None:
+            try:
+                self._batch.commit()
+            except google_exceptions.FailedPrecondition as error:
+                raise WriteConflict(str(error)) from error
+        else:
+            with self._store.transaction():
+                for write in self._memory_writes:
+                    write()
+        for callback in self._after_commit:
+            callback()
+
+
+@contextmanager
+def write_batch(batch=None):
+    """Yields a WriteBatch and commits it when the block finishes; nothing is written if it raises.
+
+    Given an existing batch, yields it unchanged and leaves committing to its owner, which lets
+    the save helpers either write on their own or join a caller's batch.
+    """
+    if batch is not None:
+        yield batch
+        return
+    batch = storage.batch()
+    yield batch
+    batch.commit()
+
+
 # --- Database Helper Functions (UPDATED FOR APPOINTMENT STATUS BY ID) ---
 
+@request_cached('users', document=True)
 def get_user(email):
-    if db:
-        user_ref = db.collection('users').document(email)
-        doc = user_ref.get()
-        if doc.exists:
-            return doc.to_dict()
-    for user in in_memory_db['users']:
-        if user['email'] == email:
-            return user
-    return None
+    return storage.get_user(email)
 
 def save_user(user_data):
-    if db:
-        user_ref = db.collection('users').document(user_data['email'])
-        data_to_save = user_data.copy()
-        data_to_save.pop('specialty', None)
-        user_ref.set(data_to_save)
-        print(f"User {user_data['name']} saved to Firestore.")
+    storage.save_user(user_data)
+    record_write('users', user_data['email'], dict(user_data))
+    print(f"User {user_data['name']} saved to {storage.label}.")
+    invalidate_cached_user(user_data['email'], doctor=user_data.get('role') == 'doctor')
+
+def update_user(email, changes):
+    """Updates selected fields of a user document (keeps local indexes current)."""
+    user = get_user(email) # Request-cached: the callers have already loaded it
+    storage.update_user(email, changes)
+    record_update('users', email, changes)
+    invalidate_cached_user(email, doctor=bool(user) and user.get('role') == 'doctor')
+
+def invalidate_cached_user(email, doctor=False):
+    """Drops a user from the process-wide caches; a doctor also from the doctor list."""
+    user_cache.invalidate(email)
+    if doctor:
+        doctor_directory.invalidate()
+        bump_versions(f'user:{email}', 'doctors')
     else:
-        existing_index = next((i for i, user in enumerate(in_memory_db['users']) if user['email'] == user_data['email']), -1)
-        if existing_index != -1:
-            in_memory_db['users'][existing_index] = user_data
-        else:
-            if user_data['role'] == 'patient' and 'profile_pic_url' not in user_data:
-                user_data['profile_pic_url'] = PROFILE_PIC_CHOICES['default']
-            in_memory_db['users'].append(user_data)
-        print(f"User {user_data['name']} saved to in-memory database.")
+        bump_versions(f'user:{email}')
 
+@request_cached('users', key_field='email')
 def get_doctor(doctor_id):
-    if db:
-        docs = db.collection('users').where('doctor_id', '==', doctor_id).where('role', '==', 'doctor').limit(1).stream()
-        for doc in docs:
-            return doc.to_dict()
-    for user in in_memory_db['users']:
-        if user.get('doctor_id') == doctor_id and user['role'] == 'doctor':
-            return user
-    return None
+    return storage.find_doctor(doctor_id)
 
 def get_available_doctors():
-    if db:
-        docs = db.collection('users').where('role', '==', 'doctor').where('available', '==', True).stream()
-        return [doc.to_dict() for doc in docs]
-    return [user for user in in_memory_db['users'] if user['role'] == 'doctor' and user.get('available') == True]
+    """Every available doctor, ordered by name (public profile fields only)."""
+    return doctor_directory.all()
+
+# --- Cursor Pagination ---
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 20)) # Rows per page on the dashboard, profile and history lists
+
+
+def encode_page_cursor(values):
+    """Packs the sort values of a page's last document into an opaque, URL-safe token."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_page_cursor(token):
+    """Inverse of encode_page_cursor. Raises ValueError for a malformed token."""
+    values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+        raise ValueError('Invalid page cursor')
+    return values
+
+
+def _get_page(collection, filters, sort_fields, cursor=None, page_size=None):
+    """Returns (docs, next_cursor) for one page of a collection, newest first.
+
+    Documents are ordered by sort_fields and then document ID, all descending, and the page
+    starts after the document the cursor was taken from. next_cursor is None on the last page.
+    """
+    page_size = page_size or PAGE_SIZE
+    after = decode_page_cursor(cursor) if cursor else None
+    if after is not None and len(after) != len(sort_fields) + 1:
+        raise ValueError('Invalid page cursor')
+
+    def sort_key(doc):
+        return [str(doc.get(field, '')) for field in sort_fields] + [doc['_id']]
+
+    docs = storage.page(collection, filters, sort_fields, after, page_size + 1)
+    next_cursor = encode_page_cursor(sort_key(docs[page_size - 1])) if len(docs) > page_size else None
+    return docs[:page_size], next_cursor
+
 
+@request_cached('appointments', key_field='_id')
 def get_appointments_for_doctor(doctor_id):
-    if db:
-        appointments = db.collection('appointments').where('doctor_id', '==', doctor_id).stream()
-        # Include the document ID for update purposes
-        return [{'_id': a.id, **a.to_dict()} for a in appointments]
-    return [a for a in in_memory_db['appointments'] if a.get('doctor_id') == doctor_id]
+    return storage.appointments_for_doctor(doctor_id)
+
+def get_appointments_page_for_doctor(doctor_id, status=None, cursor=None, page_size=None):
+    """One page of a doctor's appointments (optionally only one status), newest first.
+
+    Returns (appointments, next_cursor).
+    """
+    filters = {'doctor_id': doctor_id}
+    if status:
+        filters['status'] = status
+    return _get_page('appointments', filters, ['date', 'time'], cursor, page_size)
 
 def get_patients_for_doctor(doctor_id):
     appointments = get_appointments_for_doctor(doctor_id)
-    patient_ids = {a['patient_id'] for a in appointments}
-    
-    patients = []
-    for pid in patient_ids:
-        if db:
-            patient_docs = db.collection('users').where('patient_id', '==', pid).where('role', '==', 'patient').limit(1).stream()
-            for doc in patient_docs:
-                patients.append(doc.to_dict())
-        else:
-            for user in in_memory_db['users']:
-                if user.get('patient_id') == pid and user['role'] == 'patient':
-                    patients.append(user)
-                    break
-    return patients
+    patient_ids = tuple(sorted({a['patient_id'] for a in appointments}))
+    return get_patients_by_ids(patient_ids)
+
+@request_cached('users', key_field='email')
+def get_patients_by_ids(patient_ids):
+    """Loads patient documents for a tuple of patient IDs (in batches of FIRESTORE_IN_QUERY_LIMIT on Firestore)."""
+    patients = storage.find_patients(patient_ids)
+    return [patients[pid] for pid in patient_ids if pid in patients]
 
 
+@request_cached('prescriptions', key_field='_id')
 def get_prescriptions_for_patient(patient_id):
-    if db:
-        docs = db.collection('prescriptions').where('patient_id', '==', patient_id).stream()
-        # Ensure amount is an integer, default to 200 if missing
-        return [{'_id': doc.id, 'amount': int(doc.to_dict().get('amount', DEFAULT_PRESCRIPTION_FEE)), **doc.to_dict()} for doc in docs]
-    # Handle in-memory fallback
-    return [{**p, 'amount': int(p.get('amount', DEFAULT_PRESCRIPTION_FEE))} for p in in_memory_db['prescriptions'] if p['patient_id'] == patient_id]
+    # Ensure amount is an integer, default to 200 if missing
+    return [{**p, 'amount': int(p.get('amount', DEFAULT_PRESCRIPTION_FEE))} for p in storage.prescriptions_for_patient(patient_id)]
 
+def get_prescriptions_page_for_patient(patient_id, cursor=None, page_size=None):
+    """One page of a patient's prescriptions, newest first. Returns (prescriptions, next_cursor)."""
+    prescriptions, next_cursor = _get_page('prescriptions', {'patient_id': patient_id}, ['date'], cursor, page_size)
+    return [{**p, 'amount': int(p.get('amount', DEFAULT_PRESCRIPTION_FEE))} for p in prescriptions], next_cursor
+
+@request_cached('prescriptions', key_field='_id')
 def get_pending_prescriptions_for_patient(patient_id):
-    if db:
-        docs = db.collection('prescriptions').where('patient_id', '==', patient_id).where('payment_status', '==', 'pending').stream()
-        # Ensure amount is an integer, default to 200 if missing
-        return [{'_id': doc.id, 'amount': int(doc.to_dict().get('amount', DEFAULT_PRESCRIPTION_FEE)), **doc.to_dict()} for doc in docs]
-    # Handle in-memory fallback
-    return [{**p, 'amount': int(p.get('amount', DEFAULT_PRESCRIPTION_FEE))} for p in in_memory_db['prescriptions'] if p['patient_id'] == patient_id and p.get('payment_status') == 'pending']
+    # Ensure amount is an integer, default to 200 if missing
+    return [{**p, 'amount': int(p.get('amount', DEFAULT_PRESCRIPTION_FEE))}
+            for p in storage.prescriptions_for_patient(patient_id, payment_status='pending')]
     
+@request_cached('prescriptions', document=True)
 def get_prescription_by_id(prescription_id):
-    if db:
-        doc_ref = db.collection('prescriptions').document(prescription_id)
-        doc = doc_ref.get()
-        if doc.exists:
-            data = doc.to_dict()
-            data['amount'] = int(data.get('amount', DEFAULT_PRESCRIPTION_FEE))
-            return {'_id': doc.id, **data}
-    for p in in_memory_db['prescriptions']:
-        if p.get('_id') == prescription_id:
-            p['amount'] = int(p.get('amount', DEFAULT_PRESCRIPTION_FEE))
-            return p
-    return None
+    p = storage.get_prescription(prescription_id)
+    if p:
+        p['amount'] = int(p.get('amount', DEFAULT_PRESCRIPTION_FEE))
+    return p
+
+@request_cached('payments')
+def get_payments_for_patient(patient_id):
+    """Returns every completed payment made by a patient in a single query."""
+    return storage.completed_payments_for_patient(patient_id)
+
+
+def index_payments_by_prescription(payments):
+    """Groups payments by prescription_id; older payments without one are grouped by (doctor_id, date)."""
+    by_prescription = {}
+    legacy = {}
+    for payment in payments:
+        if payment.get('prescription_id'):
+            by_prescription.setdefault(payment['prescription_id'], payment)
+        else:
+            legacy.setdefault((payment.get('doctor_id'), payment.get('date')), []).append(payment)
+    return by_prescription, legacy
+
+
+def match_payment_to_prescription(prescription, by_prescription, legacy):
+    """Finds a prescription's payment by reference, else by doctor/date (preferring the same amount)."""
+    payment = by_prescription.get(prescription.get('_id'))
+    if payment:
+        return payment
+    candidates = legacy.get((prescription.get('doctor_id'), prescription.get('date')), [])
+    for candidate in candidates:
+        if int(candidate.get('amount', DEFAULT_PRESCRIPTION_FEE)) == prescription.get('amount'):
+            return candidate
+    return candidates[0] if candidates else None
+
+
+def _in_memory_mock_payment(prescription):
+    """Placeholder shown for completed in-memory prescriptions that have no payment record."""
+    return {
+        'payment_method': 'Unknown (In-Memory)',
+        'timestamp': prescription['date'] + ' 12:00:00',
+        'amount': prescription['amount']
+    }
+
 
 def get_payments_for_prescription(prescription_id):
-    if db:
-        # For simplicity, we assume the first completed payment for the doctor on the prescription date is the correct one.
-        prescription = get_prescription_by_id(prescription_id)
-        if not prescription: return None
-        
-        docs = db.collection('payments')\
-                 .where('patient_id', '==', prescription['patient_id'])\
-                 .where('doctor_id', '==', prescription['doctor_id'])\
-                 .where('date', '==', prescription['date'])\
-                 .where('status', '==', 'Completed')\
-                 .limit(1).stream()
-        for doc in docs:
-            return doc.to_dict()
-    
-    # In-memory lookup/mock
     prescription = get_prescription_by_id(prescription_id)
-    if prescription and prescription.get('payment_status') == 'completed':
-        for p in in_memory_db['payments']:
-            if p.get('patient_id') == prescription['patient_id'] and \
-               p.get('doctor_id') == prescription['doctor_id'] and \
-               p.get('date') == prescription['date'] and \
-               p.get('amount') == prescription['amount']:
-                return p
-        
-        # Fallback Mock record
-        return {
-            'payment_method': 'Unknown (In-Memory)',
-            'timestamp': prescription['date'] + ' 12:00:00',
-            'amount': prescription['amount']
-        }
-    return None
+    if not prescription or (storage.local and prescription.get('payment_status') != 'completed'):
+        return None
+
+    by_prescription, legacy = index_payments_by_prescription(get_payments_for_patient(prescription['patient_id']))
+    payment = match_payment_to_prescription(prescription, by_prescription, legacy)
+    if payment is None and storage.local:
+        return _in_memory_mock_payment(prescription)
+    return payment
 
 
 def get_full_patient_history(patient_id):
-    """Combines prescription data with payment data for history view."""
-    prescriptions = get_prescriptions_for_patient(patient_id)
+    """Combines prescription data with payment data for history view.
+
+    Uses one prescriptions query and one payments query, joined in memory.
+    """
+    return build_patient_history(get_prescriptions_for_patient(patient_id), get_payments_for_patient(patient_id))
+
+
+def get_patient_history_page(patient_id, cursor=None, page_size=None):
+    """One page of get_full_patient_history, newest first. Returns (history, next_cursor).
+
+    Only the payments that can match this page's prescriptions are loaded.
+    """
+    prescriptions, next_cursor = get_prescriptions_page_for_patient(patient_id, cursor, page_size)
+    return build_patient_history(prescriptions, get_payments_for_prescriptions(patient_id, prescriptions)), next_cursor
+
+
+def get_payments_for_prescriptions(patient_id, prescriptions):
+    """Returns the patient's completed payments that reference these prescriptions, or share a date with one."""
+    return storage.completed_payments_for_prescriptions(patient_id, [p['_id'] for p in prescriptions],
+                                                        sorted({p['date'] for p in prescriptions}))
+
+
+def build_patient_history(prescriptions, payments):
+    """Attaches each prescription's payment details. Returns the records sorted by date, newest first."""
+    by_prescription, legacy = index_payments_by_prescription(payments)
     history = []
     
     for p_data in prescriptions:
-        # Fetch payment details only if payment status is completed
+        # Attach payment details only if payment status is completed
+        payment_record = None
         if p_data.get('payment_status') == 'completed':
-            payment_record = get_payments_for_prescription(p_data.get('_id'))
-            p_data['payment'] = payment_record if payment_record else {'payment_method': 'N/A', 'timestamp': 'N/A'}
-        else:
-            p_data['payment'] = {'payment_method': 'N/A', 'timestamp': 'N/A'}
+            payment_record = match_payment_to_prescription(p_data, by_prescription, legacy)
+            if payment_record is None and storage.local:
+                payment_record = _in_memory_mock_payment(p_data)
+        p_data['payment'] = payment_record if payment_record else {'payment_method': 'N/A', 'timestamp': 'N/A'}
         
         history.append(p_data)
         
@@ -2165,160 +4317,1102 @@ def get_full_patient_history(patient_id):
     return sorted(history, key=lambda x: x['date'], reverse=True)
 
 
-def update_prescription_payment_status(prescription_id, status):
-    if db:
-        doc_ref = db.collection('prescriptions').document(prescription_id)
-        doc_ref.update({'payment_status': status})
-    else:
-        for p in in_memory_db['prescriptions']:
-            if p.get('_id') == prescription_id:
-                p['payment_status'] = status
-                break
+def update_prescription_payment_status(prescription_id, status, batch=None):
+    with write_batch(batch) as batch:
+        storage.set_prescription_payment_status(prescription_id, status, batch)
+        batch.after_commit(record_update, 'prescriptions', prescription_id, {'payment_status': status})
 
+@request_cached('prescriptions')
 def get_prescriptions_by_doctor(doctor_id):
-    if db:
-        docs = db.collection('prescriptions').where('doctor_id', '==', doctor_id).stream()
-        return [doc.to_dict() for doc in docs]
-    return [p for p in in_memory_db['prescriptions'] if p['doctor_id'] == doctor_id]
+    return storage.prescriptions_for_doctor(doctor_id)
 
+@request_cached('payments')
 def get_payments_by_doctor_and_date(doctor_id, date):
-    if db:
-        docs = db.collection('payments').where('doctor_id', '==', doctor_id).where('date', '==', date).stream()
-        # Ensure amount is an integer
-        return [{**doc.to_dict(), 'amount': int(doc.to_dict().get('amount', DEFAULT_PRESCRIPTION_FEE))} for doc in docs]
-    # Handle in-memory fallback
-    return [{**p, 'amount': int(p.get('amount', DEFAULT_PRESCRIPTION_FEE))} for p in in_memory_db['payments'] if p.get('doctor_id') == doctor_id and p.get('date') == date]
+    # Ensure amount is an integer
+    return [{**p, 'amount': int(p.get('amount', DEFAULT_PRESCRIPTION_FEE))} for p in storage.payments_for_doctor_on(doctor_id, date)]
 
+@request_cached('monthly_earnings')
 def get_monthly_payments_for_doctor(doctor_id):
-    """Aggregates payments by month and year for a specific doctor."""
-    monthly_summary = {}
-    
-    if db:
-        docs = db.collection('payments').where('doctor_id', '==', doctor_id).stream()
-        payments = [doc.to_dict() for doc in docs]
-    else:
-        payments = [p for p in in_memory_db['payments'] if p.get('doctor_id') == doctor_id]
-
-    for payment in payments:
-        amount = int(payment.get('amount', DEFAULT_PRESCRIPTION_FEE)) # Use stored or default amount
-        date_obj = datetime.strptime(payment['date'], '%Y-%m-%d')
-        month_year_key = date_obj.strftime('%Y-%m') 
-        
-        if month_year_key not in monthly_summary:
-            monthly_summary[month_year_key] = {'count': 0, 'total_earnings': 0, 'month_year': month_year_key}
-        
-        monthly_summary[month_year_key]['count'] += 1
-        monthly_summary[month_year_key]['total_earnings'] += amount
-        
-    sorted_stats = sorted(monthly_summary.values(), key=lambda x: x['month_year'], reverse=True)
+    """Returns a doctor's per-month payment count and earnings, newest month first.
+
+    Reads the rollup documents maintained by save_payment (one small document per month)
+    instead of scanning every payment the doctor has received.
+    """
+    rollups = storage.monthly_earnings(doctor_id)
+
+    monthly_summary = [
+        {'month_year': r['month_year'], 'count': int(r.get('count', 0)), 'total_earnings': int(r.get('total_earnings', 0))}
+        for r in rollups
+    ]
+    sorted_stats = sorted(monthly_summary, key=lambda x: x['month_year'], reverse=True)
     return sorted_stats
 
 
-def save_appointment(appointment_data):
-    if db:
-        db.collection('appointments').add(appointment_data)
-        print("Appointment saved to Firestore.")
-    else:
-        import uuid
-        appointment_data['_id'] = str(uuid.uuid4())
-        in_memory_db['appointments'].append(appointment_data)
-        print("Appointment saved to in-memory database.")
+def monthly_rollup_id(doctor_id, month_year):
+    return f"{doctor_id}_{month_year}"
+
+
+# --- Doctor Directory ---
+DOCTOR_DIRECTORY_REFRESH_SECONDS = int(os.environ.get('DOCTOR_DIRECTORY_REFRESH_SECONDS', 30)) # Local stores only
+DOCTOR_DIRECTORY_LISTEN_TIMEOUT = float(os.environ.get('DOCTOR_DIRECTORY_LISTEN_TIMEOUT', 10))
+DOCTOR_SEARCH_MAX_LIMIT = 100
+DOCTOR_PUBLIC_FIELDS = ('id', 'email', 'name', 'specialty', 'doctor_id', 'profile_pic_url')
+
+
+class DoctorDirectory:
+    """In-process snapshot of the available doctors, indexed by specialty and by name prefix.
+
+    With Firestore a snapshot listener on the doctor documents pushes every change into the
+    snapshot, so searches never query the users collection. The local stores are re-read at most
+    every refresh_seconds, and on the next search after any worker on the host changes a doctor
+    (the shared 'doctors' version moved past the one the snapshot was loaded at).
+    """
+
+    def __init__(self, refresh_seconds):
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._doctors = {}       # email -> public fields
+        self._by_name = []       # sorted [(name_key, email)]
+        self._by_specialty = {}  # specialty_key -> sorted [(name_key, email)]
+        self._specialties = []
+        self._stale = True
+        self._loaded_at = None
+        self._loaded_version = None
+        self._watch = None
+        self._listening = False
+        self.reloads = 0
+        self.changes = 0
+        self.fallbacks = 0
+
+    @staticmethod
+    def _key(text):
+        return ' '.join((text or '').split()).casefold()
+
+    @staticmethod
+    def _public(user):
+        return {field: user.get(field) for field in DOCTOR_PUBLIC_FIELDS}
+
+    def _replace(self, users):
+        with self._lock:
+            self._doctors = {u['email']: self._public(u) for u in users}
+            self._stale = True
+            self.reloads += 1
+
+    def _on_snapshot(self, docs, changes, read_time):
+        """Listener callback: applies added/modified/removed doctor documents to the snapshot."""
+        with self._lock:
+            if not self._listening:
+                # The first snapshot is the full result set; it supersedes a fallback read.
+                users = (doc.to_dict() or {} for doc in docs)
+                self._doctors = {u['email']: self._public(u) for u in users if u.get('available')}
+                self._listening = True
+            else:
+                for change in changes:
+                    user = change.document.to_dict() or {}
+                    email = user.get('email', change.document.id)
+                    if change.type.name == 'REMOVED' or not user.get('available'):
+                        self._doctors.pop(email, None)
+                    else:
+                        self._doctors[email] = self._public(user)
+            self._stale = True
+            self.changes += len(changes)
+        if self._ready.is_set() and changes:
+            bump_versions('doctors')
+        self._ready.set()
+
+    def _sync(self):
+        if not storage.local:
+            with self._lock:
+                if self._watch is None:
+                    self._watch = storage.watch_doctors(self._on_snapshot)
+            if not self._ready.is_set() and not self._ready.wait(DOCTOR_DIRECTORY_LISTEN_TIMEOUT):
+                # The listener has not delivered its first snapshot yet; fall back to one read
+                # and serve it until the listener catches up, so only the first request waits.
+                doctors = {u['email']: self._public(u) for u in storage.available_doctors()}
+                with self._lock:
+                    if not self._ready.is_set():
+                        self._doctors = doctors
+                        self._stale = True
+                        self._reindex()
+                        self.reloads += 1
+                        self.fallbacks += 1
+                        self._ready.set()
+            return
+        now = time.monotonic()
+        version = current_version('doctors') # Read before the doctors, like conditional_response's stamps
+        if self._loaded_at is None or now - self._loaded_at >= self.refresh_seconds or version != self._loaded_version:
+            self._replace(storage.available_doctors())
+            self._loaded_at = now
+            self._loaded_version = version
+
+    def _reindex(self):
+        """Rebuilds the sorted indexes after the snapshot changed. Called with the lock held."""
+        if not self._stale:
+            return
+        self._by_name = sorted((self._key(d['name']), email) for email, d in self._doctors.items())
+        by_specialty = {}
+        for entry in self._by_name:
+            by_specialty.setdefault(self._key(self._doctors[entry[1]]['specialty']), []).append(entry)
+        self._by_specialty = by_specialty
+        self._specialties = sorted({d['specialty'] for d in self._doctors.values() if d['specialty']}, key=self._key)
+        self._stale = False
+
+    def invalidate(self):
+        """Forces the local stores to be re-read on the next search (the Firestore listener needs no help)."""
+        self._loaded_at = None
+
+    def all(self):
+        self._sync()
+        with self._lock:
+            self._reindex()
+            return [dict(self._doctors[email]) for _, email in self._by_name]
+
+    def specialties(self):
+        self._sync()
+        with self._lock:
+            self._reindex()
+            return list(self._specialties)
+
+    def search(self, query='', specialty=None, cursor=None, limit=None):
+        """Returns (doctors, next_cursor): doctors whose name starts with query, ordered by name.
+
+        Raises ValueError for a malformed cursor.
+        """
+        after = decode_page_cursor(cursor) if cursor else None
+        if after is not None and len(after) != 2:
+            raise ValueError('Invalid page cursor')
+        limit = limit or PAGE_SIZE
+        prefix = self._key(query)
+        self._sync()
+        with self._lock:
+            self._reindex()
+            entries = self._by_specialty.get(self._key(specialty), []) if specialty else self._by_name
+            start = bisect.bisect_left(entries, (prefix,))
+            if after is not None:
+                start = max(start, bisect.bisect_right(entries, tuple(after)))
+            page = []
+            for entry in itertools.islice(entries, start, None):
+                if not entry[0].startswith(prefix):
+                    break
+                if len(page) == limit:
+                    return [dict(self._doctors[email]) for _, email in page], encode_page_cursor(list(page[-1]))
+                page.append(entry)
+            return [dict(self._doctors[email]) for _, email in page], None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'mode': 'listener' if self._watch is not None else 'polling',
+                'doctors': len(self._doctors),
+                'specialties': len(self._specialties),
+                'reloads': self.reloads,
+                'changes': self.changes,
+                'fallbacks': self.fallbacks,
+            }
+
+
+doctor_directory = DoctorDirectory(DOCTOR_DIRECTORY_REFRESH_SECONDS)
+
+
+@app.route('/doctors/search')
+def search_doctors():
+    """JSON doctor search for logged-in users: ?q=<name prefix>&specialty=&after=<cursor>&limit="""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in.'}), 401
+    limit = min(request.args.get('limit', PAGE_SIZE, type=int) or PAGE_SIZE, DOCTOR_SEARCH_MAX_LIMIT)
+    try:
+        doctors, next_cursor = doctor_directory.search(request.args.get('q', ''), request.args.get('specialty'),
+                                                       request.args.get('after'), limit)
+    except ValueError:
+        return jsonify({'error': 'Invalid page cursor.'}), 400
+    return jsonify({'doctors': doctors, 'next': next_cursor})
+
+
+# --- Appointment Slots ---
+# Doctors are booked in fixed-length slots inside weekly working hours. working_hours on a doctor's
+# user document maps a weekday ('0' is Monday) to ["HH:MM", "HH:MM"] windows, and slot_minutes sets
+# the slot length; doctors without them use DEFAULT_WORKING_HOURS and SLOT_MINUTES.
+# doctor_schedules/{doctor_id}_{date} maps each booked slot's start time to its end and appointment,
+# so the free slots of a day take one point read and a reservation rewrites one document.
+# While a patient confirms a booking by OTP, the slot is held: 'held' in the same document maps
+# its start time to the hold, which blocks the slot for other patients until it expires.
+SLOT_MINUTES = int(os.environ.get('SLOT_MINUTES', 30))
+SLOT_BOOKING_DAYS = int(os.environ.get('SLOT_BOOKING_DAYS', 60)) # How far ahead patients may book
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+
+class SlotUnavailable(Exception):
+    """Raised when an appointment time is outside the doctor's hours or overlaps a booking."""
+
+
+def parse_hhmm(text):
+    """'09:30' -> 570 (minutes after midnight). Raises ValueError for anything else."""
+    hours, minutes = text.strip().split(':')
+    value = int(hours) * 60 + int(minutes)
+    if not (0 <= int(minutes) < 60 and 0 <= value <= 24 * 60):
+        raise ValueError(f'Invalid time: {text}')
+    return value
+
+
+def format_hhmm(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def parse_working_hours(spec):
+    """Parses 'mon-fri=09:00-13:00,14:00-17:00;sat=09:00-13:00' into a working_hours map.
+
+    Raises ValueError for a malformed spec or overlapping windows.
+    """
+    hours = {}
+    for part in filter(None, (p.strip() for p in spec.split(';'))):
+        days, _, windows = part.partition('=')
+        first, _, last = days.strip().lower().partition('-')
+        first_day = WEEKDAYS.index(first)
+        last_day = WEEKDAYS.index(last) if last else first_day
+        parsed = []
+        for window in windows.split(','):
+            start, _, end = window.partition('-')
+            parsed.append((parse_hhmm(start), parse_hhmm(end)))
+        parsed.sort()
+        if any(start >= end for start, end in parsed) or any(a[1] > b[0] for a, b in zip(parsed, parsed[1:])):
+            raise ValueError(f'Empty or overlapping working-hours windows: {windows}')
+        for day in range(first_day, last_day + 1):
+            hours[str(day)] = [[format_hhmm(start), format_hhmm(end)] for start, end in parsed]
+    return hours
+
+
+DEFAULT_WORKING_HOURS = parse_working_hours(os.environ.get('DEFAULT_WORKING_HOURS', 'mon-fri=09:00-13:00,14:00-17:00;sat=09:00-13:00'))
+
+
+def doctor_slot_minutes(doctor):
+    return int(doctor.get('slot_minutes') or SLOT_MINUTES)
+
+
+def doctor_slots(doctor, day):
+    """The (start, end) minutes of every slot in the doctor's template on day, excluding past ones."""
+    length = doctor_slot_minutes(doctor)
+    now = datetime.now()
+    earliest = now.hour * 60 + now.minute if day == now.date() else 0
+    slots = []
+    for start, end in (doctor.get('working_hours') or DEFAULT_WORKING_HOURS).get(str(day.weekday()), []):
+        slots.extend((m, m + length) for m in range(parse_hhmm(start), parse_hhmm(end) - length + 1, length) if m >= earliest)
+    return slots
+
+
+class BookedIntervals:
+    """A day's booked [start, end) intervals in minutes, sorted so overlap checks are a bisect."""
+
+    def __init__(self, booked):
+        intervals = sorted((parse_hhmm(start), parse_hhmm(slot['end'])) for start, slot in booked.items())
+        self.starts = [start for start, _ in intervals]
+        self.ends = [end for _, end in intervals]
+
+    def overlaps(self, start, end):
+        # Bookings never overlap each other, so ends are sorted too: of the bookings starting
+        # before `end`, only the last one can reach past `start`.
+        i = bisect.bisect_left(self.starts, end)
+        return i > 0 and self.ends[i - 1] > start
+
+
+def schedule_id(doctor_id, date):
+    return f"{doctor_id}_{date}"
+
+
+@request_cached('doctor_schedules', document=True)
+def get_doctor_schedule(schedule_key):
+    """Returns a doctor_schedules document ({'doctor_id', 'date', 'booked'}) or None."""
+    return storage.get_schedule(schedule_key)
+
+
+def _live_holds(schedule, exclude=None):
+    """The schedule's unexpired holds, leaving out the hold with id exclude."""
+    now = time.time()
+    return {start: hold for start, hold in (schedule or {}).get('held', {}).items()
+            if hold['expires_at'] > now and hold['hold_id'] != exclude}
+
+
+def _booked_intervals(doctor, date):
+    schedule = get_doctor_schedule(schedule_id(doctor.get('doctor_id', doctor['id']), date)) or {}
+    return BookedIntervals({**schedule.get('booked', {}), **_live_holds(schedule)})
+
+
+def _bookable_day(date):
+    try:
+        day = datetime.strptime(date or '', '%Y-%m-%d').date()
+    except ValueError:
+        raise SlotUnavailable("Please choose a valid date.")
+    today = datetime.now().date()
+    if not today <= day <= today + timedelta(days=SLOT_BOOKING_DAYS):
+        raise SlotUnavailable(f"Appointments can be booked from today up to {SLOT_BOOKING_DAYS} days ahead.")
+    return day
+
+
+def get_free_slots(doctor, date):
+    """The 'HH:MM' start times at which the doctor can still be booked on date."""
+    try:
+        day = _bookable_day(date)
+    except SlotUnavailable:
+        return []
+    booked = _booked_intervals(doctor, date)
+    return [format_hhmm(start) for start, end in doctor_slots(doctor, day) if not booked.overlaps(start, end)]
+
+
+def validate_slot(doctor, date, time):
+    """Returns the (start, end) minutes of a free slot starting at time; raises SlotUnavailable otherwise."""
+    day = _bookable_day(date)
+    try:
+        start = parse_hhmm(time or '')
+    except ValueError:
+        raise SlotUnavailable("Please choose a time slot.")
+    slot = next((slot for slot in doctor_slots(doctor, day) if slot[0] == start), None)
+    if slot is None:
+        raise SlotUnavailable("The doctor does not see patients at that time.")
+    if _booked_intervals(doctor, date).overlaps(*slot):
+        raise SlotUnavailable("That time slot is already taken. Please choose another.")
+    return slot
+
+
+def _add_booking(schedule, appointment_id, appointment_data, hold_id=None):
+    """Returns the schedule document with the appointment's slot booked; raises SlotUnavailable on overlap.
+
+    The hold with id hold_id, if any, is converted into the booking; expired holds are dropped.
+    """
+    booked = dict((schedule or {}).get('booked', {}))
+    held = _live_holds(schedule, exclude=hold_id)
+    if BookedIntervals({**booked, **held}).overlaps(parse_hhmm(appointment_data['time']), parse_hhmm(appointment_data['end_time'])):
+        raise SlotUnavailable("That time slot has just been booked by another patient. Please choose another.")
+    booked[appointment_data['time']] = {'end': appointment_data['end_time'], 'appointment_id': appointment_id}
+    return {'doctor_id': appointment_data['doctor_id'], 'date': appointment_data['date'], 'booked': booked, 'held': held}
+
+
+@app.route('/doctors/<doctor_id>/free_slots')
+def doctor_free_slots(doctor_id):
+    """JSON list of a doctor's free slot start times on ?date=YYYY-MM-DD (logged-in users only)."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in.'}), 401
+    doctor = get_doctor(doctor_id)
+    if not doctor or not doctor.get('available'):
+        return jsonify({'error': 'Doctor not found.'}), 404
+    date = request.args.get('date', '')
+    return jsonify({'date': date, 'slot_minutes': doctor_slot_minutes(doctor), 'free': get_free_slots(doctor, date)})
+
+
+# --- Slot Holds ---
+# A hold is placed when book_appointment sends the OTP and is converted into the booking (or
+# released) when the OTP is verified. Holds are only honoured until expires_at, so a patient who
+# abandons the OTP step blocks the slot for SLOT_HOLD_SECONDS at most; the reaper below just
+# removes expired holds from the schedule documents. With Firestore each hold also gets a
+# slot_holds/{hold_id} document so holds left by other workers can be found by expiry.
+SLOT_HOLD_SECONDS = int(os.environ.get('SLOT_HOLD_SECONDS', 300))
+SLOT_HOLD_SWEEP_SECONDS = int(os.environ.get('SLOT_HOLD_SWEEP_SECONDS', 60))
+SLOT_HOLD_SWEEP_BATCH = 100
+
+
+def _add_hold(schedule, hold):
+    """Returns the schedule document with hold added; raises SlotUnavailable if the slot is taken."""
+    booked = (schedule or {}).get('booked', {})
+    held = _live_holds(schedule)
+    if BookedIntervals({**booked, **held}).overlaps(parse_hhmm(hold['time']), parse_hhmm(hold['end'])):
+        raise SlotUnavailable("That time slot is already taken. Please choose another.")
+    held[hold['time']] = {'end': hold['end'], 'hold_id': hold['hold_id'], 'patient_id': hold['patient_id'], 'expires_at': hold['expires_at']}
+    return {'doctor_id': hold['doctor_id'], 'date': hold['date'], 'booked': booked, 'held': held}
+
+
+def _without_hold(schedule, hold_id):
+    """Returns the schedule document with the hold (and any expired ones) removed, or None if it holds nothing."""
+    if not schedule or not any(hold['hold_id'] == hold_id for hold in schedule.get('held', {}).values()):
+        return None
+    return {**schedule, 'held': _live_holds(schedule, exclude=hold_id)}
+
+
+def place_slot_hold(doctor_id, date, start, end, patient_id):
+    """Holds a slot for a patient for SLOT_HOLD_SECONDS. Returns (schedule_key, hold_id).
+
+    Raises SlotUnavailable if the slot is booked or held by someone else.
+    """
+    hold = {'hold_id': secrets.token_urlsafe(12), 'doctor_id': doctor_id, 'date': date, 'time': format_hhmm(start),
+            'end': format_hhmm(end), 'patient_id': patient_id, 'expires_at': time.time() + SLOT_HOLD_SECONDS}
+    schedule_key = schedule_id(doctor_id, date)
+    schedule = storage.place_hold(schedule_key, hold)
+    record_write('doctor_schedules', schedule_key, schedule)
+    slot_hold_reaper.track(hold['expires_at'], schedule_key, hold['hold_id'])
+    return schedule_key, hold['hold_id']
+
+
+def release_slot_hold(schedule_key, hold_id):
+    """Releases a hold. Does nothing if it was already converted, released or dropped."""
+    schedule = storage.release_hold(schedule_key, hold_id)
+    if schedule is not None:
+        record_write('doctor_schedules', schedule_key, schedule)
+    slot_hold_reaper.forget(hold_id)
+
+
+class SlotHoldReaper:
+    """Releases expired slot holds from a daemon thread started by the first hold.
+
+    Holds placed by this process sit in a min-heap keyed by expiry, so each pass only looks at
+    the earliest ones. With Firestore it also sweeps slot_holds every SLOT_HOLD_SWEEP_SECONDS
+    with a range query on expires_at, a page at a time, to release holds left by other workers.
+    """
+
+    def __init__(self, sweep_seconds):
+        self.sweep_seconds = sweep_seconds
+        self._heap = []        # (expires_at, schedule_key, hold_id)
+        self._pending = set()  # hold ids in the heap that have not been converted or released
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._next_sweep = 0
+        self.released = 0
+
+    def track(self, expires_at, schedule_key, hold_id):
+        with self._lock:
+            heapq.heappush(self._heap, (expires_at, schedule_key, hold_id))
+            self._pending.add(hold_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='slot-hold-reaper', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def forget(self, hold_id):
+        """Stops tracking a hold that was converted or released; its heap entry is skipped when it expires."""
+        with self._lock:
+            self._pending.discard(hold_id)
+
+    def _next_expiry(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def reap(self):
+        """Releases every expired hold. Returns how many were released."""
+        now = time.time()
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, schedule_key, hold_id = heapq.heappop(self._heap)
+                if hold_id in self._pending:
+                    self._pending.discard(hold_id)
+                    expired.append((schedule_key, hold_id))
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_seconds
+            expired.extend(storage.expired_holds(now, SLOT_HOLD_SWEEP_BATCH))
+        for schedule_key, hold_id in expired:
+            release_slot_hold(schedule_key, hold_id)
+        self.released += len(expired)
+        return len(expired)
+
+    def _run(self):
+        while True:
+            next_expiry = self._next_expiry()
+            timeout = self.sweep_seconds if next_expiry is None else min(self.sweep_seconds, max(0, next_expiry - time.time()))
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            try:
+                self.reap()
+            except Exception as e:
+                print(f"Error releasing expired slot holds: {e}")
+
+
+slot_hold_reaper = SlotHoldReaper(SLOT_HOLD_SWEEP_SECONDS)
+
+
+# --- Doctor Dashboard Counters ---
+# doctor_stats/{doctor_id} holds running totals for the dashboard; doctor_daily_earnings/{doctor_id}_{date}
+# holds the day's total and per-hour buckets. Both are maintained by the write helpers below, so the
+# dashboard needs point reads only. doctor_patients/{doctor_id}_{patient_id} records which patients
+# have already been counted for a doctor.
+
+def daily_earnings_id(doctor_id, date):
+    return f"{doctor_id}_{date}"
+
+
+def doctor_patient_link_id(doctor_id, patient_id):
+    return f"{doctor_id}_{patient_id}"
+
+
+def completed_delta(old_status, new_status):
+    """+1/-1 when an appointment enters/leaves 'Completed', otherwise 0."""
+    return int(new_status == 'Completed') - int(old_status == 'Completed')
+
+
+@request_cached('doctor_stats')
+def get_doctor_counters(doctor_id):
+    """Returns the precomputed patients/prescriptions/completed-appointments counters for a doctor."""
+    counters = storage.doctor_counters(doctor_id)
+    return {
+        'patients_assigned': int(counters.get('patients_assigned', 0)),
+        'prescriptions_written': int(counters.get('prescriptions_written', 0)),
+        'appointments_completed': int(counters.get('appointments_completed', 0))
+    }
+
+
+@request_cached('daily_earnings')
+def get_daily_earnings(doctor_id, date):
+    """Returns {'total_earnings', 'hourly'} for a doctor's day, with hourly keyed '00'..'23'."""
+    earnings = storage.daily_earnings(doctor_id, date)
+    hourly = {f"{h:02d}": int(earnings.get('hourly', {}).get(f"{h:02d}", 0)) for h in range(24)}
+    return {'total_earnings': int(earnings.get('total_earnings', 0)), 'hourly': hourly}
+
+
+def _payment_hour(payment_data):
+    try:
+        return payment_data['timestamp'].split(' ')[1].split(':')[0]
+    except (KeyError, IndexError, AttributeError):
+        return None
+
+
+def save_appointment(appointment_data, reserve_slot=False, hold_id=None):
+    """Saves an appointment, counting the patient for the doctor the first time they book.
+
+    With reserve_slot, the appointment's date/time/end_time slot is booked in the doctor's
+    schedule in the same transaction, converting the patient's hold hold_id if given;
+    SlotUnavailable is raised (and nothing is saved) if an overlapping appointment or another
+    patient's hold got there first.
+    """
+    appointment_id, schedule = storage.save_appointment(appointment_data, reserve_slot, hold_id)
+    record_write('appointments', appointment_id, {**appointment_data, '_id': appointment_id})
+    print(f"Appointment saved to {storage.label}.")
+    if schedule is not None:
+        record_write('doctor_schedules', schedule_id(appointment_data['doctor_id'], appointment_data['date']), schedule)
+    if hold_id:
+        slot_hold_reaper.forget(hold_id)
+    record_write('doctor_stats', None, None)
+
+
         
 # Helper function to update status just by ID (used by doctor when writing Rx)
-def update_appointment_status_by_id(doc_id, status):
-    """Updates the appointment status directly by its ID."""
-    if db:
-        doc_ref = db.collection('appointments').document(doc_id)
-        doc_ref.update({'status': status})
-    else:
-        # For in-memory, we must find the object by the passed ID
-        for a in in_memory_db['appointments']:
-            if a.get('_id') == doc_id:
-                a['status'] = status
-                print(f"In-memory appointment {doc_id} updated to {status}.")
-                return
+def update_appointment_status_by_id(doc_id, status, batch=None):
+    """Updates the appointment status directly by its ID (and the doctor's completed counter)."""
+    with write_batch(batch) as batch:
+        storage.set_appointment_status(doc_id, status, batch)
+        batch.after_commit(record_update, 'appointments', doc_id, {'status': status})
+        batch.after_commit(record_write, 'doctor_stats', None, None)
     
+@request_cached('appointments')
 def find_appointment_by_patient_and_doctor(patient_id, doctor_id):
-    """Finds a 'Booked' appointment by patient and doctor ID. Returns (doc_id, appointment_data)"""
-    if db:
-        # NOTE: This complex query REQUIRES a composite index in Firestore.
-        appointments = db.collection('appointments')\
-                             .where('patient_id', '==', patient_id)\
-                             .where('doctor_id', '==', doctor_id)\
-                             .where('status', '==', 'Booked')\
-                             .order_by('date', direction=firestore.Query.DESCENDING)\
-                             .order_by('time', direction=firestore.Query.DESCENDING)\
-                             .limit(1).stream()
-        
-        for doc in appointments:
-            return doc.id, doc.to_dict()
-    
-    # In-memory lookup
-    for a in reversed(in_memory_db['appointments']):
-        if a.get('patient_id') == patient_id and a.get('doctor_id') == doctor_id and a.get('status') == 'Booked':
-            return a.get('_id'), a 
+    """Finds the latest 'Booked' appointment by patient and doctor ID. Returns (doc_id, appointment_data)"""
+    appointment = storage.find_booked_appointment(patient_id, doctor_id)
+    if appointment:
+        return appointment['_id'], appointment
     return None, None
 
 # This function is now OBSOLETE but kept for backwards compatibility with payment process.
 def update_appointment_status(doc_id, appointment_data, status):
     """Updates the appointment status in database or memory. (Deprecated: use update_appointment_status_by_id)"""
-    if db and doc_id:
-        doc_ref = db.collection('appointments').document(doc_id)
-        doc_ref.update({'status': status})
-    elif appointment_data:
+    if doc_id:
+        update_appointment_status_by_id(doc_id, status)
+    if appointment_data:
         appointment_data['status'] = status
-        print(f"In-memory appointment updated to {status}.")
 
 
-def save_prescription(prescription_data):
-    if db:
-        doc_ref = db.collection('prescriptions').document()
-        doc_ref.set(prescription_data)
-        print("Prescription saved to Firestore.")
-    else:
-        import uuid
-        prescription_data['_id'] = str(uuid.uuid4())
-        # Ensure 'amount' is set, default if missing
-        prescription_data['amount'] = int(prescription_data.get('amount', DEFAULT_PRESCRIPTION_FEE)) 
-        in_memory_db['prescriptions'].append(prescription_data)
-        print("Prescription saved to in-memory database.")
-
-def save_payment(payment_data):
-    if db:
-        db.collection('payments').add(payment_data)
-        print("Payment saved to Firestore.")
+def save_prescription(prescription_data, batch=None):
+    """Saves a prescription and bumps the doctor's prescriptions_written counter atomically."""
+    with write_batch(batch) as batch:
+        prescription_id = storage.save_prescription(prescription_data, batch)
+        batch.after_commit(record_write, 'prescriptions', prescription_id, {**prescription_data, '_id': prescription_id})
+        batch.after_commit(print, f"Prescription saved to {storage.label}.")
+        batch.after_commit(record_write, 'doctor_stats', None, None)
+        batch.after_commit(bump_versions, f"patient:{prescription_data['patient_id']}")
+
+def save_payment(payment_data, batch=None):
+    """Saves a payment and bumps the doctor's monthly rollup and daily earnings in the same atomic write."""
+    doctor_id = payment_data.get('doctor_id')
+    with write_batch(batch) as batch:
+        payment_id = storage.save_payment(payment_data, batch)
+        batch.after_commit(record_write, 'payments', payment_id, {**payment_data, '_id': payment_id})
+        batch.after_commit(print, f"Payment saved to {storage.label}.")
+        batch.after_commit(record_write, 'monthly_earnings', None, None)
+        batch.after_commit(record_write, 'daily_earnings', None, None)
+        batch.after_commit(bump_versions, f"patient:{payment_data.get('patient_id')}", f"doctor:{doctor_id}")
+
+
+def backfill_monthly_earnings(doctor_id=None):
+    """Rebuilds the monthly earnings rollups from the payments collection.
+
+    Existing rollups for the affected doctors (every doctor when doctor_id is None) are
+    deleted or overwritten, so run it while no payments are being taken. Returns the number
+    of rollup documents written.
+    """
+    totals = {}
+    for payment in storage.stream('payments', doctor_id, ['doctor_id', 'date', 'amount']):
+        key = (payment.get('doctor_id'), payment['date'][:7])
+        count, total = totals.get(key, (0, 0))
+        totals[key] = (count + 1, total + int(payment.get('amount', DEFAULT_PRESCRIPTION_FEE)))
+
+    storage.replace_doctor_documents('monthly_earnings', doctor_id, {
+        monthly_rollup_id(rollup_doctor_id, month_year): {'doctor_id': rollup_doctor_id, 'month_year': month_year, 'count': count, 'total_earnings': total}
+        for (rollup_doctor_id, month_year), (count, total) in totals.items()
+    })
+    bump_versions(*{f'doctor:{rollup_doctor_id}' for rollup_doctor_id, _ in totals} | ({f'doctor:{doctor_id}'} if doctor_id else set()))
+    return len(totals)
+
+
+EXPORT_GRANULARITIES = {
+    'month': ('monthly_earnings.csv', ['month_year', 'year', 'month', 'count', 'total_earnings']),
+    'day': ('daily_earnings.csv', ['date', 'count', 'total_earnings']),
+    'payment': ('payments.csv', ['date', 'timestamp', 'patient_id', 'patient_name', 'amount', 'payment_method', 'status', 'prescription_id']),
+}
+
+
+def iter_payments_for_doctor(doctor_id, start=None, end=None):
+    """Yields a doctor's payments newest first, optionally limited to start <= date <= end.
+
+    On Firestore the rows come straight off the query's streaming cursor, so nothing is buffered.
+    """
+    return storage.iter_payments_for_doctor(doctor_id, start, end)
+
+
+def iter_earnings_rows(payments, period_length):
+    """Groups a date-ordered payment stream into (period, count, total) rows, one period at a time."""
+    period, count, total = None, 0, 0
+    for payment in payments:
+        payment_period = payment['date'][:period_length]
+        if payment_period != period:
+            if period is not None:
+                yield period, count, total
+            period, count, total = payment_period, 0, 0
+        count += 1
+        total += int(payment.get('amount', DEFAULT_PRESCRIPTION_FEE))
+    if period is not None:
+        yield period, count, total
+
+
+def iter_earnings_export(doctor_id, granularity, start=None, end=None):
+    """Yields the CSV rows (header first) of a doctor's earnings export."""
+    yield EXPORT_GRANULARITIES[granularity][1]
+    if granularity == 'payment':
+        for p in iter_payments_for_doctor(doctor_id, start, end):
+            yield [p.get('date'), p.get('timestamp'), p.get('patient_id'), p.get('patient_name'),
+                   int(p.get('amount', DEFAULT_PRESCRIPTION_FEE)), p.get('payment_method'), p.get('status'), p.get('prescription_id', '')]
+    elif granularity == 'day':
+        for day, count, total in iter_earnings_rows(iter_payments_for_doctor(doctor_id, start, end), 10):
+            yield [day, count, total]
+    elif start or end:
+        # Exact month totals for an arbitrary date range have to come from the payments themselves
+        for month_year, count, total in iter_earnings_rows(iter_payments_for_doctor(doctor_id, start, end), 7):
+            year, month = month_year.split('-')
+            yield [month_year, year, month, count, total]
     else:
-        in_memory_db['payments'].append(payment_data)
-        print("Payment saved to in-memory database.")
+        for s in get_monthly_payments_for_doctor(doctor_id):
+            year, month = s['month_year'].split('-')
+            yield [s['month_year'], year, month, s['count'], s['total_earnings']]
+
+
+def iter_csv(rows):
+    """Encodes rows as CSV text one line at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _parse_export_date(value):
+    if not value:
+        return None
+    datetime.strptime(value, '%Y-%m-%d') # Raises ValueError for anything but YYYY-MM-DD
+    return value
+
 
 @app.route('/export_monthly_stats', methods=['GET'])
 def export_monthly_stats():
-    """Export the logged-in doctor's monthly stats as CSV without external deps."""
+    """Streams the logged-in doctor's earnings as CSV.
+
+    Query parameters: granularity=month|day|payment (default month) and optional
+    start/end dates (YYYY-MM-DD, inclusive).
+    """
     if 'user_id' not in session or session['user_role'] != 'doctor':
         return redirect(url_for('login_register'))
 
+    granularity = request.args.get('granularity', 'month')
+    if granularity not in EXPORT_GRANULARITIES:
+        return "Error: granularity must be one of month, day or payment.", 400
+    try:
+        start = _parse_export_date(request.args.get('start'))
+        end = _parse_export_date(request.args.get('end'))
+    except ValueError:
+        return "Error: start and end must be dates in YYYY-MM-DD format.", 400
+
     doctor = get_user(session['user_id'])
     doctor_id = doctor.get('doctor_id', doctor['id'])
-    monthly_stats = get_monthly_payments_for_doctor(doctor_id)
-
-    # Build CSV content
-    lines = ["month_year,year,month,count,total_earnings"]
-    for s in monthly_stats:
-        year, month = s['month_year'].split('-')
-        lines.append(f"{s['month_year']},{year},{month},{s['count']},{s['total_earnings']}")
-    csv_data = "\n".join(lines)
-
-    response = make_response(csv_data)
-    response.headers['Content-Type'] = 'text/csv'
-    response.headers['Content-Disposition'] = 'attachment; filename=monthly_earnings.csv'
+
+    rows = iter_earnings_export(doctor_id, granularity, start, end)
+    response = Response(stream_with_context(iter_csv(rows)), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename={EXPORT_GRANULARITIES[granularity][0]}'
+    return response
+
+# --- Payments Ledger Export ---
+LEDGER_PAGE_SIZE = int(os.environ.get('LEDGER_PAGE_SIZE', 500)) # Payments fetched per cursor page
+LEDGER_FIELDS = ['payment_id', 'date', 'timestamp', 'doctor_id', 'patient_id', 'patient_name',
+                 'prescription_id', 'amount', 'payment_method', 'status']
+LEDGER_FORMATS = {'csv': ('text/csv', 'csv'), 'ndjson': ('application/x-ndjson', 'ndjson')}
+
+
+def iter_payments_ledger(start=None, end=None, page_size=LEDGER_PAGE_SIZE):
+    """Yields every payment across all doctors in (date, timestamp) order, one page at a time.
+
+    Each page resumes after the last document of the previous one, so at most page_size
+    payments are held in memory no matter how large the collection is.
+    """
+    return storage.iter_payments_ledger(start, end, page_size)
+
+
+def iter_ndjson(records):
+    """Encodes records as newline-delimited JSON, one line per record."""
+    for record in records:
+        yield json.dumps(record, default=str) + '\n'
+
+
+def iter_gzip(chunks):
+    """Gzip-compresses a stream of byte chunks as it is consumed."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits=31 writes a gzip header and trailer
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_ledger_export(fmt='csv', compress=False, start=None, end=None, page_size=LEDGER_PAGE_SIZE):
+    """Yields the payments ledger as encoded bytes in the given format ('csv' or 'ndjson')."""
+    records = ({field: p.get(field, '') for field in LEDGER_FIELDS}
+               for p in iter_payments_ledger(start, end, page_size))
+    if fmt == 'ndjson':
+        text = iter_ndjson(records)
+    else:
+        text = iter_csv(itertools.chain([LEDGER_FIELDS], ([r[field] for field in LEDGER_FIELDS] for r in records)))
+    chunks = (line.encode('utf-8') for line in text)
+    return iter_gzip(chunks) if compress else chunks
+
+
+@app.route('/admin/export_payments', methods=['GET'])
+def export_payments():
+    """Streams the full payments ledger (admins only).
+
+    Query parameters: format=csv|ndjson (default csv), gzip=1 to compress the download,
+    and optional start/end dates (YYYY-MM-DD, inclusive).
+    """
+    if session.get('user_id') not in ADMIN_EMAILS:
+        return "Error: Not authorized.", 403
+
+    fmt = request.args.get('format', 'csv')
+    if fmt not in LEDGER_FORMATS:
+        return "Error: format must be csv or ndjson.", 400
+    try:
+        start = _parse_export_date(request.args.get('start'))
+        end = _parse_export_date(request.args.get('end'))
+    except ValueError:
+        return "Error: start and end must be dates in YYYY-MM-DD format.", 400
+    compress = request.args.get('gzip') == '1'
+
+    mimetype, extension = LEDGER_FORMATS[fmt]
+    filename = f'payments_ledger.{extension}'
+    if compress:
+        mimetype, filename = 'application/gzip', filename + '.gz'
+    response = Response(stream_with_context(iter_ledger_export(fmt, compress, start, end)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
     return response
 
+
+def backfill_dashboard_counters(doctor_id=None):
+    """Rebuilds doctor_stats, doctor_patients and doctor_daily_earnings from stored records.
+
+    Like backfill_monthly_earnings, this replaces the affected documents, so run it while
+    the doctors concerned are not writing prescriptions or taking payments.
+    Returns the number of doctors whose counters were rebuilt.
+    """
+    counters, links, daily = {}, set(), {}
+    def counters_for(d_id):
+        return counters.setdefault(d_id, {'doctor_id': d_id, 'patients_assigned': 0, 'prescriptions_written': 0, 'appointments_completed': 0})
+
+    for appointment in storage.stream('appointments', doctor_id, ['doctor_id', 'patient_id', 'status']):
+        stats = counters_for(appointment['doctor_id'])
+        if (appointment['doctor_id'], appointment['patient_id']) not in links:
+            links.add((appointment['doctor_id'], appointment['patient_id']))
+            stats['patients_assigned'] += 1
+        stats['appointments_completed'] += completed_delta(None, appointment.get('status'))
+    for prescription in storage.stream('prescriptions', doctor_id, ['doctor_id']):
+        counters_for(prescription['doctor_id'])['prescriptions_written'] += 1
+    for payment in storage.stream('payments', doctor_id, ['doctor_id', 'date', 'timestamp', 'amount']):
+        day = daily.setdefault((payment['doctor_id'], payment['date']), {'doctor_id': payment['doctor_id'], 'date': payment['date'], 'total_earnings': 0, 'hourly': {}})
+        amount = int(payment.get('amount', DEFAULT_PRESCRIPTION_FEE))
+        day['total_earnings'] += amount
+        hour = _payment_hour(payment)
+        if hour is not None:
+            day['hourly'][hour] = day['hourly'].get(hour, 0) + amount
+
+    storage.replace_doctor_documents('doctor_stats', doctor_id, counters)
+    storage.replace_doctor_documents('doctor_patients', doctor_id, {
+        doctor_patient_link_id(d_id, p_id): {'doctor_id': d_id, 'patient_id': p_id} for d_id, p_id in links})
+    storage.replace_doctor_documents('daily_earnings', doctor_id, {
+        daily_earnings_id(d_id, date): day for (d_id, date), day in daily.items()})
+    return len(counters)
+
+
+def backfill_doctor_schedules(doctor_id=None):
+    """Rebuilds doctor_schedules from the stored appointments.
+
+    Appointments booked before slot scheduling existed get a SLOT_MINUTES-long slot; ones whose
+    time cannot be parsed, or that overlap an earlier booking, are skipped and counted.
+    Returns (schedules written, appointments skipped).
+    """
+    appointments = storage.stream('appointments', doctor_id, ['doctor_id', 'date', 'time', 'end_time'])
+
+    schedules, skipped = {}, 0
+    for appointment in sorted(appointments, key=lambda a: (a.get('date') or '', a.get('time') or '')):
+        try:
+            start = parse_hhmm(appointment.get('time') or '')
+            end = parse_hhmm(appointment['end_time']) if appointment.get('end_time') else start + SLOT_MINUTES
+            key = schedule_id(appointment['doctor_id'], appointment['date'])
+            slot = {'doctor_id': appointment['doctor_id'], 'date': appointment['date'], 'time': format_hhmm(start), 'end_time': format_hhmm(end)}
+            schedules[key] = _add_booking(schedules.get(key), appointment['_id'], slot)
+        except (KeyError, ValueError, SlotUnavailable):
+            skipped += 1
+
+    storage.replace_doctor_documents('doctor_schedules', doctor_id, schedules)
+    return len(schedules), skipped
+
+
+def benchmark_storage(backend, users=50, records=20, reads=500, seed=0):
+    """Runs the same workload against a storage backend. Returns {operation: microseconds per call}.
+
+    Writes users doctors and patients, then users * records appointments and prescriptions
+    (each committed with its payment in one batch), then times dashboard reads for random
+    doctors and patients. The records are left behind, so use a scratch backend.
+    """
+    rng = random.Random(seed)
+    prefix = f"BENCH-{secrets.token_hex(4)}"
+    doctors = [f"{prefix}-DOC-{i}" for i in range(users)]
+    patients = [f"{prefix}-PAT-{i}" for i in range(users)]
+    timings = {}
+
+    def timed(operation, func, calls):
+        started = time.perf_counter()
+        for args in calls:
+            func(*args)
+        timings[operation] = (time.perf_counter() - started) * 1e6 / max(len(calls), 1)
+
+    def save_prescription_with_payment(prescription, payment):
+        batch = backend.batch()
+        payment['prescription_id'] = backend.save_prescription(prescription, batch)
+        backend.save_payment(payment, batch)
+        batch.commit()
+
+    visits = []
+    for _ in range(users * records):
+        day = datetime(2026, 1, 1) + timedelta(days=rng.randrange(365), minutes=30 * rng.randrange(16, 34))
+        visits.append((rng.choice(doctors), rng.choice(patients), day.strftime('%Y-%m-%d'), day.strftime('%H:%M')))
+
+    timed('save_user', backend.save_user, [
+        ({'email': f"{d.lower()}@bench.test", 'name': d, 'role': 'doctor', 'doctor_id': d, 'specialty': 'Bench', 'available': True},)
+        for d in doctors] + [
+        ({'email': f"{p.lower()}@bench.test", 'name': p, 'role': 'patient', 'patient_id': p},) for p in patients])
+    timed('save_appointment', backend.save_appointment, [
+        ({'doctor_id': d, 'patient_id': p, 'patient_name': p, 'date': date, 'time': at, 'status': 'Completed'},)
+        for d, p, date, at in visits])
+    timed('save_prescription + payment', save_prescription_with_payment, [
+        ({'doctor_id': d, 'patient_id': p, 'date': date, 'medication': 'Bench', 'notes': '', 'amount': DEFAULT_PRESCRIPTION_FEE, 'payment_status': 'completed'},
+         {'doctor_id': d, 'patient_id': p, 'date': date, 'timestamp': f"{date} {at}:00", 'amount': DEFAULT_PRESCRIPTION_FEE, 'status': 'completed'})
+        for d, p, date, at in visits])
+
+    sample_doctors = [rng.choice(doctors) for _ in range(reads)]
+    sample_patients = [rng.choice(patients) for _ in range(reads)]
+    timed('get_user', backend.get_user, [(f"{p.lower()}@bench.test",) for p in sample_patients])
+    timed('page appointments', backend.page, [('appointments', {'doctor_id': d}, ['date', 'time'], None, PAGE_SIZE + 1) for d in sample_doctors])
+    timed('prescriptions_for_patient', backend.prescriptions_for_patient, [(p,) for p in sample_patients])
+    timed('doctor_counters', backend.doctor_counters, [(d,) for d in sample_doctors])
+    timed('monthly_earnings', backend.monthly_earnings, [(d,) for d in sample_doctors])
+    return timings
+
+
+# --- Maintenance Commands ---
+
+@app.cli.command('backfill-monthly-earnings')
+@click.option('--doctor-id', default=None, help='Only rebuild rollups for this doctor (e.g. DOC-2000).')
+def backfill_monthly_earnings_command(doctor_id):
+    """Rebuild the per-doctor monthly earnings rollups from existing payments."""
+    written = backfill_monthly_earnings(doctor_id)
+    click.echo(f"Wrote {written} monthly earnings rollup(s).")
+
+
+@app.cli.command('backfill-dashboard-counters')
+@click.option('--doctor-id', default=None, help='Only rebuild counters for this doctor (e.g. DOC-2000).')
+def backfill_dashboard_counters_command(doctor_id):
+    """Rebuild the doctor dashboard counters and daily earnings buckets from existing records."""
+    rebuilt = backfill_dashboard_counters(doctor_id)
+    click.echo(f"Rebuilt dashboard counters for {rebuilt} doctor(s).")
+
+
+@app.cli.command('backfill-doctor-schedules')
+@click.option('--doctor-id', default=None, help='Only rebuild schedules for this doctor (e.g. DOC-2000).')
+def backfill_doctor_schedules_command(doctor_id):
+    """Rebuild the booked-slot schedules from existing appointments."""
+    written, skipped = backfill_doctor_schedules(doctor_id)
+    click.echo(f"Wrote {written} doctor schedule(s); skipped {skipped} appointment(s) without a usable slot.")
+
+
+@app.cli.command('set-working-hours')
+@click.argument('email')
+@click.argument('spec')
+@click.option('--slot-minutes', type=click.IntRange(5, 240), default=None, help='Slot length for this doctor (default: SLOT_MINUTES).')
+def set_working_hours_command(email, spec, slot_minutes):
+    """Set a doctor's weekly hours, e.g. 'mon-fri=09:00-13:00,14:00-17:00;sat=09:00-12:00'."""
+    doctor = get_user(email)
+    if not doctor or doctor.get('role') != 'doctor':
+        raise click.BadParameter(f'No doctor with email {email}.')
+    try:
+        changes = {'working_hours': parse_working_hours(spec)}
+    except ValueError as error:
+        raise click.BadParameter(str(error))
+    if slot_minutes:
+        changes['slot_minutes'] = slot_minutes
+    update_user(email, changes)
+    click.echo(f"Updated working hours for {doctor['name']}.")
+
+
+@app.cli.command('export-payments')
+@click.option('--format', 'fmt', type=click.Choice(sorted(LEDGER_FORMATS)), default='csv', show_default=True)
+@click.option('--gzip', 'compress', is_flag=True, help='Gzip-compress the output.')
+@click.option('--start', default=None, help='Only payments on or after this date (YYYY-MM-DD).')
+@click.option('--end', default=None, help='Only payments on or before this date (YYYY-MM-DD).')
+@click.option('--page-size', default=LEDGER_PAGE_SIZE, show_default=True, help='Payments fetched per page.')
+@click.option('--output', type=click.File('wb'), default='-', help='File to write to (default: stdout).')
+def export_payments_command(fmt, compress, start, end, page_size, output):
+    """Export the payments ledger for all doctors as CSV or newline-delimited JSON."""
+    try:
+        start, end = _parse_export_date(start), _parse_export_date(end)
+    except ValueError:
+        raise click.BadParameter('start and end must be dates in YYYY-MM-DD format.')
+    for chunk in iter_ledger_export(fmt, compress, start, end, page_size):
+        output.write(chunk)
+
+
+@app.cli.command('benchmark-storage')
+@click.option('--users', default=50, show_default=True, help='Doctors (and patients) to create.')
+@click.option('--records', default=20, show_default=True, help='Appointments and prescriptions per doctor.')
+@click.option('--reads', default=500, show_default=True, help='Calls timed for each read.')
+@click.option('--sqlite-path', default=None, help='SQLite file to benchmark against (default: a temporary file).')
+@click.option('--firestore', 'include_firestore', is_flag=True, help='Also run against the Firestore emulator (FIRESTORE_EMULATOR_HOST).')
+def benchmark_storage_command(users, records, reads, sqlite_path, include_firestore):
+    """Run the same workload against each storage backend and print the cost per call side by side."""
+    with tempfile.TemporaryDirectory() as scratch:
+        backends = [MemoryBackend(MemoryStore(LOCAL_SCHEMA)),
+                    SqliteBackend(SqliteStore(sqlite_path or os.path.join(scratch, 'benchmark.db'), LOCAL_SCHEMA))]
+        if include_firestore:
+            if not os.environ.get('FIRESTORE_EMULATOR_HOST'):
+                raise click.UsageError('--firestore writes benchmark records, so it only runs against the emulator; set FIRESTORE_EMULATOR_HOST.')
+            if not db:
+                raise click.UsageError('--firestore needs the Firestore client; run with STORAGE_BACKEND=firestore.')
+            backends.append(FirestoreBackend(db))
+        results = []
+        for backend in backends:
+            click.echo(f"Benchmarking the {backend.label}...", err=True)
+            results.append(benchmark_storage(backend, users, records, reads))
+    click.echo(f"{'operation (us/call)':<30}" + ''.join(f"{backend.name:>12}" for backend in backends))
+    for operation in results[0]:
+        click.echo(f"{operation:<30}" + ''.join(f"{timings[operation]:>12.1f}" for timings in results))
+
+class _VerifyStubHandler(BaseHTTPRequestHandler):
+    """Answers Verify create calls the way Twilio does: new verifications are pending, checks approved."""
+    protocol_version = 'HTTP/1.1' # Keep-alive, so connection reuse shows up as a repeated client port
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.calls.append((self.path, self.client_address[1]))
+        delay, self.server.delay_next = self.server.delay_next, 0
+        time.sleep(delay)
+        status = 'approved' if self.path.endswith('/VerificationCheck') else 'pending'
+        body = json.dumps({'sid': 'VE' + '0' * 32, 'service_sid': TWILIO_VERIFY_SERVICE_SID, 'status': status}).encode('utf-8')
+        try:
+            self.send_response(201)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            pass # The client gave up waiting (the read-timeout check below)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@app.cli.command('twilio-stub-check')
+@click.option('--timeout', default=0.5, show_default=True, help='Client read timeout used against the stub, in seconds.')
+def twilio_stub_check_command(timeout):
+    """Run the Twilio Verify client against a local stand-in server.
+
+    Checks that a send and a check each reach the server once over one reused connection,
+    and that a send whose response times out is not retried (which would send a second SMS).
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _VerifyStubHandler)
+    server.calls, server.delay_next = [], 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    client = make_twilio_client(base_url, timeout)
+    provider = TwilioVerifyProvider(lambda: client)
+    try:
+        if not provider.send('+15550000000') or not provider.check('+15550000000', '123456'):
+            raise click.ClickException('Unexpected verification status from the stub.')
+        paths = [path for path, _ in server.calls]
+        if paths != [f'/v2/Services/{TWILIO_VERIFY_SERVICE_SID}/Verifications',
+                     f'/v2/Services/{TWILIO_VERIFY_SERVICE_SID}/VerificationCheck']:
+            raise click.ClickException(f'Unexpected requests: {paths}')
+        click.echo(f"Send and check reached {base_url} over {len({port for _, port in server.calls})} connection(s).")
+
+        server.calls.clear()
+        server.delay_next = timeout * 3
+        try:
+            provider.send('+15550000000')
+            outcome = 'succeeded'
+        except Exception as e:
+            outcome = f'failed with {type(e).__name__}'
+        time.sleep(timeout * 3)
+        if len(server.calls) != 1:
+            raise click.ClickException(f'The timed-out send reached the server {len(server.calls)} times; it must not be retried.')
+        click.echo(f"The timed-out send {outcome} and was not retried.")
+    finally:
+        server.shutdown()
+
+
+@app.cli.command('build-assets')
+@click.option('--tailwind-cli', default=lambda: os.environ.get('TAILWIND_CLI', 'tailwindcss'), show_default='tailwindcss',
+              help='Path to the Tailwind CSS standalone executable.')
+@click.option('--chartjs', 'chartjs_path', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Local Chart.js UMD build (chart.umd.js) to serve instead of the CDN copy.')
+@click.option('--font', 'fonts', multiple=True, metavar='FAMILY=PATH',
+              help="Local variable-weight .woff2 for a font family, e.g. 'Inter=./InterVariable.woff2'. Repeatable.")
+def build_assets_command(tailwind_cli, chartjs_path, fonts):
+    """Build the hashed, precompressed CSS/JS/font bundle served from /assets/."""
+    font_paths = {}
+    for font in fonts:
+        family, _, path = font.partition('=')
+        if family not in FONT_FAMILIES or not os.path.isfile(path):
+            raise click.BadParameter(f"expected FAMILY=PATH with FAMILY one of {', '.join(FONT_FAMILIES)} and an existing file.", param_hint='--font')
+        font_paths[family] = path
+    try:
+        manifest = build_assets(tailwind_cli, chartjs_path, font_paths)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    for name, hashed in sorted(manifest.items()):
+        if name != 'fonts':
+            click.echo(f"{name} -> {hashed}")
+    if 'chart.js' not in manifest:
+        click.echo("Chart.js is still loaded from the CDN; pass --chartjs to serve it locally.")
+    missing = [family for family in FONT_FAMILIES if family not in manifest.get('fonts', {})]
+    if missing:
+        click.echo(f"Fonts still loaded from Google Fonts: {', '.join(missing)}; pass --font to serve them locally.")
+
 # --- Running the application ---
 if __name__ == '__main__':
-    if not in_memory_db['users']:
+    # Demo data and the rollups built from it only ever go into a local store; on Firestore the
+    # backfills are run deliberately through the CLI commands (see README).
+    if storage.local and not local_store['users']:
         # Mock Patient 
         patient_hash = bcrypt.generate_password_hash('password').decode('utf-8')
-        in_memory_db['users'].append({
+        local_store['users'].put({
             'id': 'patient@example.com',
             'name': 'Patient User',
             'email': 'patient@example.com',
@@ -2331,7 +5425,7 @@ if __name__ == '__main__':
             'profile_pic_url': PROFILE_PIC_CHOICES['avatar_1'] # Initial profile pic from store
         })
         # Mock Doctors
-        in_memory_db['users'].append({
+        local_store['users'].put({
             'id': 'jane.smith@example.com',
             'email': 'jane.smith@example.com',
             'name': 'Dr. Jane Smith',
@@ -2343,7 +5437,7 @@ if __name__ == '__main__':
             'doctor_id': 'DOC-2000',
             'profile_pic_url': PROFILE_PIC_CHOICES['default']
         })
-        in_memory_db['users'].append({
+        local_store['users'].put({
             'id': 'alan.turing@example.com',
             'email': 'alan.turing@example.com',
             'name': 'Dr. Alan Turing',
@@ -2355,12 +5449,11 @@ if __name__ == '__main__':
             'doctor_id': 'DOC-2001',
             'profile_pic_url': PROFILE_PIC_CHOICES['default']
         })
-        PATIENT_ID_COUNTER = 1001
-        DOCTOR_ID_COUNTER = 2002
+        patient_id_allocator.skip_past(1000)
+        doctor_id_allocator.skip_past(2001)
         
         # Add a mock prescription for PAT-1000
-        import uuid
-        in_memory_db['prescriptions'].append({
+        local_store['prescriptions'].put({
             '_id': str(uuid.uuid4()),
             'patient_id': 'PAT-1000',
             'doctor_id': 'DOC-2000',
@@ -2371,7 +5464,7 @@ if __name__ == '__main__':
             'amount': 250, 
             'payment_status': 'pending'
         })
-        in_memory_db['prescriptions'].append({
+        local_store['prescriptions'].put({
             '_id': str(uuid.uuid4()),
             'patient_id': 'PAT-1000',
             'doctor_id': 'DOC-2000',
@@ -2383,7 +5476,8 @@ if __name__ == '__main__':
             'payment_status': 'completed'
         })
         # Add a mock payment for the completed prescription
-        in_memory_db['payments'].append({
+        local_store['payments'].put({
+            '_id': str(uuid.uuid4()),
             'patient_id': 'PAT-1000',
             'patient_name': 'Patient User',
             'amount': 150,
@@ -2394,7 +5488,7 @@ if __name__ == '__main__':
             'status': 'Completed'
         })
         # Add a booked appointment for PAT-1000
-        in_memory_db['appointments'].append({
+        local_store['appointments'].put({
             '_id': str(uuid.uuid4()),
             'patient_id': 'PAT-1000',
             'doctor_id': 'DOC-2000',
@@ -2403,5 +5497,7 @@ if __name__ == '__main__':
             'time': '16:00',
             'status': 'Booked' 
         })
+        backfill_monthly_earnings()
+        backfill_dashboard_counters()
         
     app.run(debug=True)
\ No newline at end of file